@@ -2,16 +2,34 @@ import sys
 import socket
 import threading
 import os
+import time
+import random
+import queue
 
 import sys
 sys.path.append('..')
 from utils import *
+import codec
+from partitions import parsePartitionMap, clientPort
 
 # The client is at a high level composed of two threads which handle sending and receiving
 # respectively over a socket. After establishing a connection, listen() monitors the socket
 # for incoming data from the server and handles it according to the wire protocol. serve()
 # reads user input, applies client-side checks to operations if applicable, and sends data
-# to the server according to the wire protocol. 
+# to the server according to the wire protocol. The client speaks the framed protocol (see
+# codec.py), which it negotiates with the server whenever it connects. Requests are tagged with
+# IDs that the server echoes back in its responses, so serve() never waits for a response before
+# sending the next request, and listen() matches each response up with the request it answers.
+# The users may be split between several partitions, each served by its own group of servers (see
+# partitions.py): the client is sent the partition map whenever it connects, and switches to the
+# servers of a user's partition before registering or logging them in.
+# Searches and presence lookups don't change any state, so rather than the primary, the client asks
+# a secondary of its partition, over a read-only session (see OP_READ_ONLY), as long as one is up to
+# date enough; the results say how out of date they may be.
+# Only one server of a partition acts as the primary at a time (see leases.py): the client asks the
+# servers which one it is when it connects, and the servers tell it whenever that changes, over
+# both its connection to the primary and its read-only session, so that it can switch to the new
+# primary without waiting to notice that the old one failed.
 
 # *** CONSTS *** (or variables set once during initialization)
 # we deterministically set server ports in advance
@@ -22,20 +40,48 @@ SERVER_HOSTS = ["", "", ""]
 # we use this as a proxy for detecting if the client code has someone logged in or not
 username = None
 
-# empty variable for specifying recipient
-recipient = None
-
-# connected socket accessed by all threads
+# connected socket accessed by all threads, and the protocol version negotiated over it
 sock = None
+protocolVersion = None
 
-# ID of the current primary replica server, with which the client maintains a streaming connection
+# ID of the current primary replica server, with which the client maintains a streaming connection,
+# and the server to switch to on the next reconnect, if any (the primary, as we were told)
 primaryServer = -1
+targetServer = None
+
+# the map of every partition (None until a server sends it), the partition of the servers we're
+# connecting to, and the partition to switch to on the next reconnect, if any; reconnected is set
+# once a switch is done
+partitionMap = None
+partition = 0
+targetPartition = None
+reconnected = threading.Event()
+
+# the read-only session with a secondary that searches and presence lookups are made over (None
+# until one is opened), and the protocol version negotiated over it; requests on it are made one at
+# a time, holding readLock, and answered before the next one. listenRead() receives the responses,
+# and queues them in readResponses along with the socket they came in on
+readSock = None
+readVersion = None
+readLock = threading.Lock()
+readResponses = queue.Queue()
+
+# requests that haven't been fully answered yet: map of request IDs to the operation code and a
+# dictionary of details of the request needed to make sense of the responses (e.g. the recipient
+# of a message, or the number of search results received so far), along with the next ID to use
+pendingRequests = {}
+nextRequestId = 1
+requestsLock = threading.Lock()
+# held while writing to the server: the serving, listening and keepalive threads all send requests,
+# so each is written whole rather than interleaved with another on the wire
+sendLock = threading.Lock()
 
 def listen():
     """ Services all receiving functionality over the client socket. Over the lifetime of 
-    the connection, it loops and reads from the socket. It first reads a 1-byte status 
-    code as specified by the wire protocol, followed by status-specific data. It processes
-    the output and displays the results to the user in the terminal. """
+    the connection, it loops and reads from the socket. It reads one frame at a time, 
+    holding a 1-byte status code as specified by the wire protocol, followed by 
+    status-specific data. It processes the output and displays the results to the user 
+    in the terminal. """
     
     global username, primaryServer, sock
     
@@ -50,17 +96,29 @@ def listen():
     # loop until socket closed or program interrupted; the overall message from the server
     # is a status code followed by status-specific data
     while True:
-        # get the status code and decode it into a 1 byte integer
+        # get the next frame, i.e. the status code and its data
         try:
-            code = sock.recv(CODE_LENGTH)
-            code = int.from_bytes(code, "big")
+            frame = codec.recvFrame(sock)
         # if try fails, there's an error communicating with the server; exit
         except: stop()
-        # if the server disconnects, it sends back a None or 0; connect to the next available server
-        if not code:
+        # if the server disconnects, connect to the next available server
+        if frame is None:
             connectToServer()
             print("connected to a new server (if you just sent a request, it may have not gone through)")
             continue
+        code, payload = frame
+        # find the request the response answers; every response but a page of search results
+        # with more to follow is the last one to the request
+        try:
+            requestId, payload = codec.decodeTagged(protocolVersion, payload)
+        except: stop()
+        with requestsLock:
+            if code == SEARCH_OK_MORE:
+                request = pendingRequests.get(requestId)
+            else:
+                request = pendingRequests.pop(requestId, None)
+        # responses that don't answer a request (e.g. incoming messages) have no details
+        opcode, details = request if request else (None, {})
 
         # all status codes map a unique server response to a particular operation
         # all receives are try-excepted; in the case of ANY error, we exit
@@ -68,77 +126,129 @@ def listen():
         # *** REGISTER ***
         # don't "login" (set the username) yet; the user should explicitly login
         if code == REGISTER_OK:
-            print(f"<< {username} successfully registered, please login")
+            print(f"<< {details.get('username')} successfully registered, please login")
             username = None
         elif code == REGISTER_USERNAME_EXISTS:
-            print(f"<< {username} is already registered, please login")
+            print(f"<< {details.get('username')} is already registered, please login")
             username = None
         
         # *** LOGIN ***
         elif code == LOGIN_OK_NO_UNREAD_MSG:
-            print(f"<< welcome {username}, you have no new messages")
-        # with unread messages, receive the number of messages and then the messages themselves
-        elif code == LOGIN_OK_UNREAD_MSG:
-            # we first read the number of messages from the header
+            print(f"<< welcome {details.get('username')}, you have no new messages")
+        # with unread messages, they arrive in chunks, the first along with the login status;
+        # every chunk but the last has a status ending in _MORE. Each chunk is printed as it comes
+        # in and acknowledged, after which the server sends the next one
+        elif code in { LOGIN_OK_UNREAD_MSG, LOGIN_OK_UNREAD_MSG_MORE, RECEIVE_UNREAD, RECEIVE_UNREAD_MORE }:
+            # read the number of messages, then the messages themselves; each message has the
+            # form <sender>|<message>, and messages are separated by newlines
             try:
-                numMessages = sock.recv(MSG_HEADER_LENGTH)
-                numMessages = int.from_bytes(numMessages, "big")
-                # receive the buffered messages; each message has the form <sender>|<message>\n, so 
-                # assuming newlines are encoded in DELIMITER_LENGTH bytes, the overall size of the 
-                # response is at most MESSAGE_LENGTH + USERNAME_LENGTH + 2 * DELIMITER_LENGTH
-                messages = sock.recv(numMessages * (MESSAGE_LENGTH + USERNAME_LENGTH + 2 * DELIMITER_LENGTH)).decode('ascii')
+                numMessages, messages = codec.decodeCountedPayload(payload)
+                messages = messages.decode('ascii')
             except: stop()
-            # print the buffered messages
-            if numMessages == 1:
-                print(f"<< welcome {username}, you have one new message:")
-            else:
-                print(f"<< welcome {username}, you have {numMessages} new messages:")
+            if code == LOGIN_OK_UNREAD_MSG and numMessages == 1:
+                print(f"<< welcome {details.get('username')}, you have one new message:")
+            elif code == LOGIN_OK_UNREAD_MSG:
+                print(f"<< welcome {details.get('username')}, you have {numMessages} new messages:")
+            elif code == LOGIN_OK_UNREAD_MSG_MORE:
+                print(f"<< welcome {details.get('username')}, you have many new messages:")
+            # the number of messages received in the delivery so far is passed along from the
+            # acknowledgement of each chunk to the next one
+            numUnreadMessages = details.get("numMessages", 0) + numMessages
             print(parseMessages(messages), end="")
+            # acknowledge the chunk, so the messages are removed from our mailbox on the server
+            try:
+                sendRequest(OP_ACK_MESSAGES, username, numMessages=numUnreadMessages)
+            except: stop()
+            # print the total number of messages after a multi-chunk delivery
+            if code == RECEIVE_UNREAD:
+                print(f"<< you received {numUnreadMessages} new messages")
+        # every unread message was acknowledged
+        elif code == ACK_OK:
+            pass
+        # the server answered a keepalive ping (see keepAlive())
+        elif code == PING_OK:
+            pass
+
+        # *** PRIMARY ***
+        # the server tells us whenever the primary changes, and refuses requests if it's no longer
+        # the primary itself; either way, we switch to the primary if it's another server
+        elif code == PRIMARY_IS:
+            followPrimary(payload)
+        elif code == NOT_PRIMARY:
+            print("<< the server is no longer the primary, switching servers (please try again)")
+            followPrimary(payload, True)
         # if there's an error, clear the global username variable; login did not succeed
         elif code == LOGIN_NOT_REGISTERED:
-            print(f"<< {username} is not registered. please register before logging in")
+            print(f"<< {details.get('username')} is not registered. please register before logging in")
             username = None
         elif code == LOGIN_ALREADY_LOGGED_IN:
-            print(f"<< {username} is already logged in")
+            print(f"<< {details.get('username')} is already logged in")
+            username = None
+        # the partition map we were sent is out of date (the servers' map changed since)
+        elif code == WRONG_PARTITION:
+            print(f"<< {details.get('username')} is served by other servers, please reconnect and try again")
             username = None
             
         # *** SEARCH ***
-        elif code == SEARCH_OK:
-            # read the number of results from the header
+        # results arrive in pages, which are printed as they come in; every page but the last has
+        # the SEARCH_OK_MORE status
+        elif code in { SEARCH_OK, SEARCH_OK_MORE }:
+            # read the number of results, then the page itself, of the form <username>|<username>|...
             try:
-                numResults = sock.recv(MSG_HEADER_LENGTH)
-                numResults = int.from_bytes(numResults, "big")
-                # receive the number of results themselves; each result has the form <username>|, so
-                # the overall size of the response is at most USERNAME_LENGTH + DELIMITER_LENGTH
-                results = sock.recv(numResults * (USERNAME_LENGTH + DELIMITER_LENGTH)).decode('ascii')
+                numResults, results = codec.decodeCountedPayload(payload)
+                results = results.decode('ascii')
             except: stop()
-            # print the results
-            if numResults == 1:
-                print("<< 1 username matched your query:")
-            else:
-                print(f"{numResults} usernames matched your query:")
+            numSearchResults = details.get("numResults", 0)
+            if numSearchResults == 0:
+                print("<< usernames matching your query:")
+            numSearchResults += numResults
+            details["numResults"] = numSearchResults
             print(parseSearchResults(results))
+            # print the total number of results after the last page
+            if code == SEARCH_OK:
+                if numSearchResults == 1:
+                    print("<< 1 username matched your query")
+                else:
+                    print(f"<< {numSearchResults} usernames matched your query")
         elif code == SEARCH_NO_RESULTS:
             print("<< no usernames matched your query")
         
+        # *** PRESENCE ***
+        elif code in { PRESENCE_ONLINE, PRESENCE_OFFLINE, PRESENCE_NOT_REGISTERED }:
+            print(describePresence(code, details.get("username")))
+        
         # *** SEND ***
         elif code == SEND_OK_DELIVERED:
-            print(f"<< message delivered to {recipient}")
+            print(f"<< message delivered to {details.get('recipient')}")
         elif code == SEND_OK_BUFFERED:
-            print(f"<< your message to {recipient} will be delivered when they log in")
+            print(f"<< your message to {details.get('recipient')} will be delivered when they log in")
         elif code == SEND_RECIPIENT_DNE:
-            print(f"<< the user {recipient} does not exist, or has deleted their account")
+            print(f"<< the user {details.get('recipient')} does not exist, or has deleted their account")
         elif code == SEND_FAILED:
-            print(f"<< your message to {recipient} could not be delivered, please try again later")
+            print(f"<< your message to {details.get('recipient')} could not be delivered, please try again later")
+        # a batch send is answered with a status code for each recipient, in order
+        elif code == SEND_BATCH_OK:
+            try:
+                _, statuses = codec.decodeCountedPayload(payload)
+            except: stop()
+            for recipient, status in zip(details.get("recipients", []), statuses):
+                if status == SEND_OK_DELIVERED:
+                    print(f"<< message delivered to {recipient}")
+                elif status == SEND_OK_BUFFERED:
+                    print(f"<< your message to {recipient} will be delivered when they log in")
+                elif status == UPDATE_NOT_REPLICATED:
+                    print(f"<< your message to {recipient} could not be saved, please try again")
+                else:
+                    print(f"<< the user {recipient} does not exist, or has deleted their account")
             
         # *** RECEIVE ***
         # this status code corresponds to a client RECEIVING an incoming messsage, which will be
         # formatted as <sender>|<message>
         elif code == RECEIVE_OK:
             try:
-                message = sock.recv(MESSAGE_LENGTH + USERNAME_LENGTH + DELIMITER_LENGTH).decode('ascii')
+                message = payload.decode('ascii')
             except: stop()
-            if username == recipient:
+            if message.split("|")[0] == username:
                 print("<< congratulations, you sent a message to yourself")
             print(parseMessages(message), end="")
         
@@ -152,6 +262,13 @@ def listen():
             print("<< successfully logged out and deleted account")
             username = None
         
+        # the servers couldn't replicate the change the request made in time, so it was rolled back;
+        # a delete still logged us out
+        elif code == UPDATE_NOT_REPLICATED:
+            print("<< the servers couldn't replicate your request, so it didn't go through; please try again")
+            if opcode == OP_DELETE:
+                username = None
+        
         # this should never happen
         elif code == BAD_OPERATION:
             print("<< invalid command given to server")
@@ -167,14 +284,16 @@ def serve():
     the connection, it loops and reads from the input (in the terminal). It reads an 
     operation, followed by operation-specific data. It processes the client input, applies
     client-side checks if applicable, and sends data over the socket. """
-    global username, recipient
-    print(">> type a command to begin: {register, login, search, send, logout, delete, quit}")
+    global username
+    print(">> type a command to begin: {register, login, search, online, send, sendmany, logout, delete, quit}")
     
     # loop while reading user input: the overall message to send to the server will comprise of
     # the operation code, then operation-specific data
     while True:
         # the first input is the desired operation
         messageBody = None
+        # details of the request that listen() needs to make sense of the responses to it
+        details = {}
         command = input("").lower().strip()
         if command not in commandToOpcode:
             print("<< please type an actual command")
@@ -194,8 +313,13 @@ def serve():
             if not isValidUsername(usernameInput):
                 print("<< usernames must not be blank, must be under 50 characters, and must be alphanumeric, please try again")
                 continue
+            # the user registers and logs in with the servers of their partition
+            if not connectToPartitionOf(usernameInput):
+                print("<< could not reach the servers of this user, please try again")
+                continue
             # also send the username to the server
             messageBody = usernameInput
+            details["username"] = usernameInput
             
             # tentatively set username to be the input, marking the user as logged in on the 
             # client side; if there's an error, the listen() function will handle it and set the
@@ -209,8 +333,25 @@ def serve():
             if not isValidQuery(query):
                 print("<< search queries must not be blank, must be under 50 characters, and must be comprised of alphanumerics and wildcards (*), please try again")
                 continue
-            # send the query to the server
+            # ask a secondary if one is up to date enough, and otherwise send the query to the primary
+            if searchSecondary(query):
+                continue
             messageBody = query
+        
+        # *** PRESENCE ***
+        elif opcode == OP_PRESENCE:
+            usernameInput = input(">> username to look up: ").strip()
+            if not isValidUsername(usernameInput):
+                print("<< usernames must not be blank, must be under 50 characters, and must be alphanumeric, please try again")
+                continue
+            # like searches, presence lookups are made with a secondary if possible
+            answer = readFromSecondary(OP_PRESENCE, usernameInput)
+            if answer is not None:
+                staleness, [(code, _)] = answer
+                print(describePresence(code, usernameInput) + describeStaleness(staleness))
+                continue
+            messageBody = usernameInput
+            details["username"] = usernameInput
             
         # *** SEND ***
         elif opcode == OP_SEND:
@@ -227,11 +368,28 @@ def serve():
             if not isValidMessage(message):
                 print(f"<< messages must contain only ASCII (English) characters, not contain newlines or '|', must not be blank, and must be under 262 characters (current length {len(message)} characters), please try again")
                 continue
-            # store the recipient globally so we can reference it in listen()
-            recipient = recipientInput
+            # keep the recipient with the request so we can reference it in listen()
+            details["recipient"] = recipientInput
             # send the sender, recipient, and message to the server
             messageBody = formatMessage(username, recipientInput, message)
         
+        # *** BATCH SEND ***
+        # like a send, but to many recipients at once, separated by spaces
+        elif opcode == OP_SEND_BATCH:
+            if not username:
+                print(">> you must be logged in to send a message")
+                continue
+            recipientsInput = input(">> usernames of recipients: ").split()
+            if not recipientsInput or len(recipientsInput) > SEND_BATCH_LIMIT or not all(isValidUsername(r) for r in recipientsInput):
+                print(f"<< give between 1 and {SEND_BATCH_LIMIT} usernames, each alphanumeric and under 50 characters, please try again")
+                continue
+            message = input(">> message: ").strip()
+            if not isValidMessage(message):
+                print(f"<< messages must contain only ASCII (English) characters, not contain newlines or '|', must not be blank, and must be under 262 characters (current length {len(message)} characters), please try again")
+                continue
+            details["recipients"] = recipientsInput
+            messageBody = formatSendBatch(username, [(recipientsInput, message)])
+        
         # *** LOGOUT AND DELETE ***
         elif opcode in { OP_LOGOUT, OP_DELETE } :
             # can't do either operation if you're not logged in
@@ -258,39 +416,309 @@ def serve():
         # if messageBody was set then the operation is valid to send
         if messageBody:
             # send code and payload
-            sock.sendall(opcode.to_bytes(CODE_LENGTH, "big") + bytes(messageBody, 'ascii'))
+            sendRequest(opcode, messageBody, **details)
+
+# send a request with the given operation code and data (a string), keeping the given details of
+# the request (see pendingRequests) until it's answered; returns the request's ID. Requests may be
+# sent from any thread without waiting for earlier ones to be answered, e.g. by bots sending
+# messages in bulk
+def sendRequest(opcode, messageBody, **details):
+    global nextRequestId
+    with requestsLock:
+        requestId = nextRequestId
+        nextRequestId += 1
+        pendingRequests[requestId] = (opcode, details)
+    sendToServer(codec.encodeRequest(protocolVersion, opcode, bytes(messageBody, 'ascii'), requestId))
+    return requestId
+
+# write data to the server, whole (see sendLock)
+def sendToServer(data):
+    with sendLock:
+        sock.sendall(data)
+
+# run in the background: ping the server periodically, so that it doesn't close our connection
+# while we're idle (the server closes connections that stay silent for too long, since it can't
+# tell them apart from ones whose client vanished). The read-only session is pinged too, or opened
+# if we have none, so that we hear about a new primary from a secondary as well
+def keepAlive():
+    while True:
+        time.sleep(CLIENT_PING_INTERVAL)
+        try:
+            sendRequest(OP_PING, "")
+        # if the connection is down, listen() reconnects
+        except:
+            pass
+        with readLock:
+            try:
+                if readSock is None:
+                    openReadSession()
+                else:
+                    readRequest(OP_PING, "")
+            except (OSError, codec.ProtocolError):
+                closeReadSession()
+
+# helper function used when a server tells us which server is the primary (see OP_PRIMARY): switch
+# to the primary if it's another server, or (if reconnect is set) look for the primary all over
+# again if the server doesn't know of one. The switch is made by shutting the connection down,
+# which listen() notices and reconnects
+def followPrimary(payload, reconnect=False):
+    global targetServer
+    primary = payload[0] if payload else NO_SERVER
+    if primary == primaryServer or (primary >= len(SERVER_HOSTS) and not reconnect):
+        return
+    if primary < len(SERVER_HOSTS):
+        print(f"<< server {primary} is now the primary, switching servers")
+        targetServer = primary
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+# helper function for presence lookups: describe whether a user is logged in
+def describePresence(code, name):
+    if code == PRESENCE_ONLINE:
+        return f"<< {name} is online"
+    elif code == PRESENCE_OFFLINE:
+        return f"<< {name} is offline"
+    return f"<< the user {name} does not exist, or has deleted their account"
+
+# helper function for reads from a secondary: describe how out of date the results may be
+def describeStaleness(staleness):
+    return f" (as of at most {staleness:.1f}s ago)" if staleness > 0 else ""
+
+# helper function used for searches: search for a query on a secondary (see readFromSecondary()),
+# printing the results, and return whether it could
+def searchSecondary(query):
+    answer = readFromSecondary(OP_SEARCH, query)
+    if answer is None:
+        return False
+    staleness, responses = answer
+    results = []
+    for code, payload in responses:
+        if code in { SEARCH_OK, SEARCH_OK_MORE }:
+            results += codec.decodeCountedPayload(payload)[1].decode('ascii').split("|")
+    if not results:
+        print("<< no usernames matched your query" + describeStaleness(staleness))
+        return True
+    print("<< usernames matching your query" + describeStaleness(staleness) + ":")
+    print(parseSearchResults("|".join(results)))
+    if len(results) == 1:
+        print("<< 1 username matched your query")
+    else:
+        print(f"<< {len(results)} usernames matched your query")
+    return True
+
+# make a read-only request (a search or a presence lookup) on a secondary of our partition instead
+# of the primary, returning how many seconds out of date the secondary said its state may be, and
+# every (status, data) response to the request; returns None if no secondary can serve it (none is
+# up, or none is up to date enough), in which case the primary should be asked instead. Before each
+# read, the secondary is asked how stale it is (see OP_READ_ONLY); if it has fallen too far behind
+# since the session was opened, another one is tried
+def readFromSecondary(opcode, messageBody):
+    with readLock:
+        for _ in range(2):
+            if readSock is None and not openReadSession():
+                return None
+            try:
+                [(code, payload)] = readRequest(OP_READ_ONLY, "")
+                if code == READ_ONLY_OK:
+                    staleness = codec.decodeVarint(payload)[0] / 1000
+                    responses = readRequest(opcode, messageBody)
+                    if responses[-1][0] != READ_STALE:
+                        return staleness, responses
+            except (OSError, ValueError, TypeError, codec.ProtocolError):
+                pass
+            closeReadSession()
+        return None
+
+# make a request on the read-only session (holding readLock) and wait for every response to it
+# (search results may take several pages); raises an OSError if the session fails
+def readRequest(opcode, messageBody):
+    readSock.sendall(codec.encodeRequest(readVersion, opcode, bytes(messageBody, 'ascii'), 1))
+    responses = []
+    while True:
+        try:
+            session, code, payload = readResponses.get(timeout=PARTITION_CALL_TIMEOUT)
+        except queue.Empty:
+            raise TimeoutError("the secondary didn't answer on the read-only session")
+        # responses from an earlier session are left over from a request that failed
+        if session is not readSock:
+            continue
+        if code is None:
+            raise ConnectionError("the secondary closed the read-only session")
+        responses.append((code, payload))
+        if code != SEARCH_OK_MORE:
+            return responses
+
+# run in the background for each read-only session: receive the responses to its requests, and any
+# pushed changes of the primary (see followPrimary()), until the session ends
+def listenRead(session, version):
+    while True:
+        try:
+            frame = codec.recvFrame(session)
+            if frame is None:
+                break
+            code, payload = frame
+            requestId, payload = codec.decodeTagged(version, payload)
+        except (OSError, codec.ProtocolError):
+            break
+        if code == PRIMARY_IS and requestId == NO_REQUEST_ID:
+            followPrimary(payload)
+        else:
+            readResponses.put((session, code, payload))
+    readResponses.put((session, None, None))
+
+# open a read-only session (holding readLock) with one of the secondaries of our partition (the
+# servers other than the primary), picked at random so that reads are spread between them,
+# returning whether we could find one that's up to date enough
+def openReadSession():
+    global readSock, readVersion
+    secondaries = [server for server in range(len(SERVER_HOSTS)) if server != primaryServer]
+    for server in random.sample(secondaries, len(secondaries)):
+        try:
+            readSock = socket.create_connection((SERVER_HOSTS[server], clientPort(partition, server)), timeout=PARTITION_CALL_TIMEOUT)
+            readSock.sendall(codec.encodeHello())
+            status, readVersion = recvExactly(readSock, 2 * CODE_LENGTH)
+            if status != HELLO_OK or readVersion < PROTOCOL_FRAMED:
+                closeReadSession()
+                continue
+            readSock.settimeout(None)
+            listener = threading.Thread(target=listenRead, args=(readSock, readVersion))
+            listener.daemon = True
+            listener.start()
+            if readRequest(OP_READ_ONLY, "")[0][0] == READ_ONLY_OK:
+                return True
+        except (OSError, codec.ProtocolError):
+            pass
+        closeReadSession()
+    return False
+
+def closeReadSession():
+    global readSock
+    if readSock is not None:
+        try:
+            readSock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        readSock.close()
+        readSock = None
 
-# helper function that creates connections to new servers are required; it starts by connecting
-# to server 0 (given the initial value of primaryServer), and upon disconnects, attempts to connect
-# to servers with higher and higher IDs
+# helper function used before registering or logging in: make sure we're connected to the servers
+# of the partition that owns a username, switching to them if we aren't, and return whether we are.
+# The switch is made by shutting the connection down, which listen() notices and reconnects
+def connectToPartitionOf(name):
+    global targetPartition
+    if partitionMap is None or partitionMap.partitionOf(name) == partition:
+        return True
+    targetPartition = partitionMap.partitionOf(name)
+    print(f"<< {name} is served by partition {targetPartition}, switching servers")
+    reconnected.clear()
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    return reconnected.wait(PARTITION_CALL_TIMEOUT)
+
+# helper function that (re)connects to the primary of our partition; it starts with the server we
+# were told is the primary, if any, or else server 0, and asks each server it reaches which one is
+# the primary (see OP_PRIMARY), following its answer or else moving on to the server with the next
+# ID. While the partition has no primary (e.g. during a failover), it keeps trying for up to
+# CLIENT_FAILOVER_TIMEOUT seconds, and exits the client if it still can't find one
 def connectToServer(): 
-    global primaryServer, sock
+    global primaryServer, sock, partition, targetPartition, targetServer, SERVER_HOSTS
+    # when switching partitions, start over from the first server of the new partition
+    if targetPartition is not None:
+        partition, targetPartition = targetPartition, None
+        SERVER_HOSTS = partitionMap.hosts[partition]
+        targetServer = None
+    if sock is not None:
+        sock.close()
+    server = targetServer if targetServer is not None else 0
+    targetServer = None
+    deadline = time.monotonic() + CLIENT_FAILOVER_TIMEOUT
+    redirected = False
     while True:
-        # if we were already connected to the last remaining server, exit the client program
-        if primaryServer == 2:
-            print("<< failed to create socket connection to server, exiting client")
-            sock.close()
+        print(f"<< attempting connection to server {server} at {SERVER_HOSTS[server]}:{clientPort(partition, server)}")
+        primary = connectTo(server)
+        if primary == server:
+            break
+        if time.monotonic() >= deadline:
+            print("<< failed to find the primary server, exiting client")
             os._exit(0)
+        # follow the server's answer, unless we just did (servers may briefly disagree on the
+        # primary while it changes)
+        if primary is not None and primary < len(SERVER_HOSTS) and not redirected:
+            server, redirected = primary, True
+        else:
+            server, redirected = (server + 1) % len(SERVER_HOSTS), False
+            time.sleep(CLIENT_RETRY_INTERVAL)
+    primaryServer = server
+    print(f"<< successfully connected to server {server}, the primary")
+    fetchPartitionMap()
+    reconnected.set()
+    # silently make a login request if the client was already logged in
+    if username != None:
+        sendRequest(OP_LOGIN, username, username=username)
 
-        # update the index of the new primary server
-        primaryServer += 1
-
-        # connect to the next available server (in increasing port number order)
-        print(f"<< attempting to connect to server {primaryServer}")
-        host, port = SERVER_HOSTS[primaryServer], SERVER_PORTS[primaryServer]
-        serverAddr = (host, port)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        print(f"<< attempting connection to {host}:{port}")
-        # try to initialize the socket; connect_ex returns a code instead of exception
-        connected = sock.connect_ex(serverAddr)
-
-        # on a succesful connection to a replica (now promoted to primary), continue as normal
-        if connected == 0:
-            print("<< successfully connected to server")
-            # silently make a login request if the client was already logged in
-            if username != None:
-                sock.sendall(OP_LOGIN.to_bytes(CODE_LENGTH, "big") + bytes(username, 'ascii'))
-            break
+# helper function used when looking for the primary: connect to a server, negotiate the protocol
+# version, and ask it which server is the primary, returning its answer (NO_SERVER if it doesn't
+# know of one), or None if it couldn't be reached. The connection is kept if the server is the
+# primary itself
+def connectTo(server):
+    global sock
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(CLIENT_CONNECT_TIMEOUT)
+    try:
+        sock.connect((SERVER_HOSTS[server], clientPort(partition, server)))
+        if negotiateProtocol():
+            sendToServer(codec.encodeRequest(protocolVersion, OP_PRIMARY))
+            # the answer may come after a keepalive ping's, or a pushed change of the primary
+            while True:
+                code, payload = codec.recvFrame(sock)
+                if code == PRIMARY_IS:
+                    primary = codec.decodeTagged(protocolVersion, payload)[1][0]
+                    break
+            if primary == server:
+                sock.settimeout(None)
+            else:
+                sock.close()
+            return primary
+    except (OSError, TypeError, IndexError, codec.ProtocolError):
+        pass
+    sock.close()
+    return None
+
+# helper function used when connecting to a server: ask it to speak the framed protocol, returning
+# whether it agreed to
+def negotiateProtocol():
+    global protocolVersion
+    try:
+        sendToServer(codec.encodeHello())
+        status, version = recvExactly(sock, 2 * CODE_LENGTH)
+    except:
+        return False
+    if status != HELLO_OK or version < PROTOCOL_FRAMED:
+        print("<< the server doesn't speak this client's protocol")
+        return False
+    protocolVersion = version
+    # requests sent to the previous server will never be answered
+    with requestsLock:
+        pendingRequests.clear()
+    return True
+
+# helper function used when connecting to a server: ask it for the partition map (see
+# partitions.py) and the partition it serves; if it can't tell us, we keep the map we had
+def fetchPartitionMap():
+    global partitionMap, partition
+    try:
+        sendToServer(codec.encodeRequest(protocolVersion, OP_PARTITION_MAP))
+        code, payload = codec.recvFrame(sock)
+        _, payload = codec.decodeTagged(protocolVersion, payload)
+        if code == PARTITION_MAP_OK:
+            served, text = payload.decode('ascii').split("\n", 1)
+            partitionMap, partition = parsePartitionMap(text), int(served)
+    except:
+        print("<< could not get the partition map from the server")
     
 def run():
     """ Function to initialize the listen and serve operations upon program start. """
@@ -300,6 +728,9 @@ def run():
         listener = threading.Thread(target=listen)
         listener.daemon = True
         listener.start()
+        pinger = threading.Thread(target=keepAlive)
+        pinger.daemon = True
+        pinger.start()
         
         # run interpret, which handles user input, parsing, and requests to server, 
         # in the main thread
@@ -313,7 +744,7 @@ def run():
             print(f"automatically logging out")
             opcode = OP_LOGOUT
             try:
-                sock.sendall(opcode.to_bytes(CODE_LENGTH, "big") + bytes(username, 'ascii'))
+                sendRequest(opcode, username)
             except:
                 print("server is not connected")
             username = None
@@ -327,7 +758,7 @@ def run():
             print(f"automatically logging out")
             opcode = OP_LOGOUT
             try:
-                sock.sendall(opcode.to_bytes(CODE_LENGTH, "big") + bytes(username, 'ascii'))
+                sendRequest(opcode, username)
             except:
                 print("server is not connected")
             username = None
@@ -337,11 +768,11 @@ def run():
 
 if __name__ == "__main__":
     # must specify all hostnames
-    if len(sys.argv) != 4:
-        print(f"usage: {sys.argv[0]} <server 0 host> <server 1 host> <server 2 host>")
+    if not 2 <= len(sys.argv) <= MAX_REPLICAS + 1:
+        print(f"usage: {sys.argv[0]} <server 0 host> <server 1 host> <server 2 host> ...")
         sys.exit(1)
 
-    SERVER_HOSTS = [sys.argv[1], sys.argv[2], sys.argv[3]]
+    SERVER_HOSTS = sys.argv[1:]
 
     print("starting client...")
     connectToServer()
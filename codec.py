@@ -0,0 +1,168 @@
+from typing import List
+
+from utils import *
+
+# The framed wire protocol, shared by the client, the server, and server-to-server connections.
+# In the legacy protocol a request is a 1-byte operation code followed by unframed data, and the
+# server relies on each read returning exactly one request; once TCP merges back-to-back requests
+# into one read, or splits a long one across two, requests are misparsed. In the framed protocol
+# every request and response is instead sent as a frame:
+# <varint length><1-byte code><payload>
+# where the length (of the code and payload together) is an unsigned LEB128 varint: 7 bits per byte,
+# least significant first, with the high bit set on every byte but the last. A reader therefore
+# always knows where one request ends and the next begins. Counts inside payloads (e.g. the number
+# of results in a page of search results) are varints too, and lengths within a frame are implied by
+# the frame's length rather than sent separately. Frames are parsed in place through memoryviews, so
+# the only copy made is of the payload handed back to the caller.
+# From protocol version PROTOCOL_REQUEST_IDS on, the payload of every frame starts with a request
+# ID (a varint) chosen by the client, which the server echoes back in every frame it sends in
+# response, so a client can have many requests outstanding on one connection and match up the
+# responses; frames the server sends unprompted (e.g. incoming messages) have NO_REQUEST_ID.
+# A client picks the framed protocol by opening its connection with OP_HELLO (see
+# encodeHello()); clients that don't keep speaking the legacy protocol, which the encoders below
+# still produce for them.
+
+# raised when the other end sends something that isn't a valid frame
+class ProtocolError(ValueError):
+    pass
+
+def encodeVarint(value : int) -> bytes:
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+# decode a varint starting at the given offset of a buffer (anything supporting the buffer protocol),
+# returning the value and the offset just past it, or None if the buffer ends in the middle of it
+def decodeVarint(buffer, offset : int = 0):
+    value, shift = 0, 0
+    for i in range(offset, len(buffer)):
+        byte = buffer[i]
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, i + 1
+        shift += 7
+        # no length or ID we accept needs more than a few bytes
+        if shift >= 7 * MAX_VARINT_LENGTH:
+            raise ProtocolError("varint too long")
+    return None
+
+# encode a frame with the given (operation or status) code and payload
+def encodeFrame(code : int, payload : bytes = b"") -> bytes:
+    return encodeVarint(CODE_LENGTH + len(payload)) + code.to_bytes(CODE_LENGTH, "big") + payload
+
+# decode the frame at the start of a memoryview, returning its code, a memoryview of its payload,
+# and the offset just past the frame, or None if the frame hasn't been received in full yet; frames
+# longer than maxLength (or without a code) are rejected
+def decodeFrame(view : memoryview, maxLength : int = MAX_FRAME_LENGTH):
+    header = decodeVarint(view)
+    if header is None:
+        return None
+    length, start = header
+    if length < CODE_LENGTH or length > maxLength:
+        raise ProtocolError(f"bad frame length {length}")
+    end = start + length
+    if len(view) < end:
+        return None
+    return view[start], view[start + CODE_LENGTH:end], end
+
+# remove the first complete frame from a buffer (a bytearray) of received data, returning its code
+# and payload, or None if there isn't a complete frame yet
+def takeFrame(buffer : bytearray, maxLength : int = MAX_FRAME_LENGTH):
+    with memoryview(buffer) as view:
+        frame = decodeFrame(view, maxLength)
+        if frame is None:
+            return None
+        code, payloadView, end = frame
+        payload = payloadView.tobytes()
+        payloadView.release()
+    del buffer[:end]
+    return code, payload
+
+# read one frame from a socket, returning its code and payload, or None if the connection closes
+# cleanly before the frame starts; any bytes of the frame that were already read (e.g. to wait for
+# the next request) can be passed in as prefix. Raises a ConnectionError if the connection closes in
+# the middle of the frame
+def recvFrame(sock, maxLength : int = MAX_FRAME_LENGTH, prefix : bytes = b""):
+    header = bytearray(prefix)
+    while True:
+        decoded = decodeVarint(header)
+        if decoded is not None:
+            break
+        byte = sock.recv(1)
+        if not byte:
+            if header:
+                raise ConnectionError("connection closed")
+            return None
+        header += byte
+    length, _ = decoded
+    if length < CODE_LENGTH or length > maxLength:
+        raise ProtocolError(f"bad frame length {length}")
+    frame = recvExactly(sock, length)
+    return frame[0], frame[CODE_LENGTH:]
+
+# the request a client opens its connection with to speak the framed protocol, carrying the latest
+# protocol version it speaks; the server answers (in the legacy format, as a 1-byte HELLO_OK status
+# and the 1-byte version chosen) before any frames are exchanged
+def encodeHello(version : int = PROTOCOL_VERSION) -> bytes:
+    return OP_HELLO.to_bytes(CODE_LENGTH, "big") + version.to_bytes(CODE_LENGTH, "big")
+
+# the version the server speaks with a client that speaks protocol versions up to the given one
+def negotiateVersion(clientVersion : int) -> int:
+    return min(clientVersion, PROTOCOL_VERSION)
+
+# encode a framed request or response with the given protocol version, code, and payload, tagged
+# with the given request ID if the version has them
+def encodeTagged(version : int, code : int, requestId : int, payload : bytes) -> bytes:
+    if version >= PROTOCOL_REQUEST_IDS:
+        return encodeFrame(code, encodeVarint(requestId) + payload)
+    return encodeFrame(code, payload)
+
+# complementary to the above: split the payload of a frame into its request ID (NO_REQUEST_ID if the
+# version doesn't have them) and the rest of the payload
+def decodeTagged(version : int, payload : bytes):
+    if version is None or version < PROTOCOL_REQUEST_IDS:
+        return NO_REQUEST_ID, payload
+    decoded = decodeVarint(payload)
+    if decoded is None:
+        raise ProtocolError("missing request ID")
+    requestId, start = decoded
+    return requestId, payload[start:]
+
+# encode a request with the given protocol version
+def encodeRequest(version : int, op : int, payload : bytes = b"", requestId : int = NO_REQUEST_ID) -> bytes:
+    if version == PROTOCOL_LEGACY:
+        return op.to_bytes(CODE_LENGTH, "big") + payload
+    return encodeTagged(version, op, requestId, payload)
+
+# encode a response with just a status and (possibly) a body, e.g. an incoming message, with the
+# given protocol version, answering the request with the given ID
+def encodeResponse(version : int, status : int, body : bytes = b"", requestId : int = NO_REQUEST_ID) -> bytes:
+    if version == PROTOCOL_LEGACY:
+        return status.to_bytes(CODE_LENGTH, "big") + body
+    return encodeTagged(version, status, requestId, body)
+
+# encode a page of search results with the given protocol version; with the framed protocol, the
+# payload is the number of results (a varint) followed by the results separated by |s
+def encodeSearchPage(version : int, status : int, results : List[str], requestId : int = NO_REQUEST_ID) -> bytes:
+    if version == PROTOCOL_LEGACY:
+        return formatSearchPage(status, results)
+    return encodeTagged(version, status, requestId, encodeVarint(len(results)) + bytes("|".join(results), 'ascii'))
+
+# ibid for a chunk of unread messages, separated by newlines
+def encodeMessageChunk(version : int, status : int, messages : List[str], requestId : int = NO_REQUEST_ID) -> bytes:
+    if version == PROTOCOL_LEGACY:
+        return formatMessageChunk(status, messages)
+    return encodeTagged(version, status, requestId, encodeVarint(len(messages)) + bytes("\n".join(messages), 'ascii'))
+
+# complementary to the above: split the payload of a framed page of search results or chunk of
+# messages into the number of items and the body
+def decodeCountedPayload(payload : bytes):
+    with memoryview(payload) as view:
+        decoded = decodeVarint(view)
+        if decoded is None:
+            raise ProtocolError("missing count")
+        count, start = decoded
+        return count, view[start:].tobytes()
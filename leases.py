@@ -0,0 +1,273 @@
+import socket
+import struct
+import threading
+import time
+
+from utils import *
+import codec
+import replication
+
+# Failure detection and the primary's lease. Every server sends every other server of its group a
+# heartbeat every HEARTBEAT_INTERVAL seconds, over a connection to its internal port; a server that
+# hasn't been heard from for HEARTBEAT_TIMEOUT seconds is taken to be down. Only one server of the
+# group may act as the primary at a time, and only while it holds the lease: a majority of the group
+# (itself included) voting for it, each vote lasting HEARTBEAT_TIMEOUT seconds.
+# Each server votes for the server that holds the lease, if it hears from one, or else for the
+# server with the lowest ID that's up (which is where clients used to look for the primary first).
+# A vote is cast by echoing, in our heartbeats to a server, the time at which the heartbeat we last
+# got from it was sent (on its clock), and means that we won't vote for another server until
+# HEARTBEAT_TIMEOUT seconds after we got that heartbeat. So a server measures its lease against its
+# own clock: it holds the lease until HEARTBEAT_TIMEOUT seconds after the time echoed back by the
+# last of a majority of voters, by which time none of them can be voting for anyone else yet.
+# When the primary fails, its voters stop hearing from it, and once their votes run out (within
+# HEARTBEAT_TIMEOUT seconds, plus a heartbeat) they vote for the next server, which takes over as
+# soon as a majority of them has. A primary cut off from the majority loses its lease just as fast,
+# and stops acting as the primary before anyone else starts. Every server reports changes of the
+# primary it knows of (see onChange), so that clients can be told where the primary is; the group
+# has no primary while fewer than a majority of its servers are up.
+
+# a heartbeat, sent as a frame (code HEARTBEAT_FRAME): the sender's ID, the server it votes for (or
+# NO_SERVER), whether it holds the lease, when it was sent (on the sender's clock), the time the
+# recipient's last heartbeat received by the sender was sent (on the recipient's clock, or 0), and
+# the sequence number of the sender's last applied update
+HEARTBEAT = struct.Struct(">BBBddQ")
+HEARTBEAT_FRAME = 1
+
+# what we last heard from another server
+class Peer:
+    def __init__(self):
+        # time.monotonic() when we last heard from it, or None if we never have
+        self.heardAt = None
+        # when its last heartbeat was sent, on its clock (echoed back to it)
+        self.sentAt = 0.0
+        self.vote = NO_SERVER
+        self.primary = False
+        # when our last heartbeat it received was sent, on our clock
+        self.echo = 0.0
+        self.lastSeq = 0
+
+class Lease:
+    # lastSeq() returns the sequence number of our last applied update, and onChange(primary) is
+    # called whenever the primary we know of changes (with NO_SERVER if there's none), on the thread
+    # running the lease
+    def __init__(self, serverId : int, numServers : int, lastSeq, onChange,
+                 interval : float = HEARTBEAT_INTERVAL, timeout : float = HEARTBEAT_TIMEOUT):
+        self.serverId = serverId
+        self.peers = {other: Peer() for other in range(numServers) if other != serverId}
+        self.quorum = majority(numServers)
+        self.lastSeq = lastSeq
+        self.onChange = onChange
+        self.interval = interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # the server we vote for, the server our vote is pledged to (we echoed its heartbeats), and
+        # until when we may not vote for any other server
+        self.vote = NO_SERVER
+        self.pledgedTo = NO_SERVER
+        self.pledgedUntil = 0.0
+        # until when we hold the lease (if we vote for ourselves), on our clock
+        self.expiry = 0.0
+        # the primary last reported to onChange
+        self.known = NO_SERVER
+
+    # whether we hold the lease, i.e. whether we may act as the primary
+    def isPrimary(self) -> bool:
+        return self.vote == self.serverId and time.monotonic() < self.expiry
+
+    def alive(self, peer : Peer, now : float) -> bool:
+        return peer.heardAt is not None and now - peer.heardAt < self.timeout
+
+    # the server holding the lease as far as we know, or NO_SERVER
+    def primary(self) -> int:
+        now = time.monotonic()
+        with self.lock:
+            if self.isPrimary():
+                return self.serverId
+            claimed = [other for other, peer in self.peers.items() if peer.primary and self.alive(peer, now)]
+            return min(claimed) if claimed else NO_SERVER
+
+    # the sequence number of each other server's last applied update, as of its last heartbeat
+    def peerSeqs(self) -> dict:
+        with self.lock:
+            return {other: peer.lastSeq for other, peer in self.peers.items()}
+
+    # what the other shards of our server need to know about the lease (see ShardLease): the server
+    # we vote for, until when we hold the lease, the primary as far as we know, and the other
+    # servers that are up
+    def share(self) -> tuple:
+        primary = self.primary()
+        now = time.monotonic()
+        with self.lock:
+            live = [other for other, peer in self.peers.items() if self.alive(peer, now)]
+            return self.vote, self.expiry, primary, live
+
+    # encode our next heartbeat to another server; echoing the server we vote for pledges our vote
+    # to it until HEARTBEAT_TIMEOUT seconds after we got the heartbeat we echo
+    def heartbeatFor(self, other : int) -> bytes:
+        with self.lock:
+            peer = self.peers[other]
+            if self.vote == other and peer.heardAt is not None:
+                self.pledgedTo = other
+                self.pledgedUntil = max(self.pledgedUntil, peer.heardAt + self.timeout)
+            vote, primary, echo = self.vote, self.isPrimary(), peer.sentAt
+        return HEARTBEAT.pack(self.serverId, vote, primary, time.monotonic(), echo, self.lastSeq())
+
+    # record a heartbeat received from another server; raises a ValueError if it's malformed
+    def receive(self, heartbeat : bytes):
+        sender, vote, primary, sentAt, echo, lastSeq = HEARTBEAT.unpack(heartbeat)
+        with self.lock:
+            peer = self.peers.get(sender)
+            if peer is None:
+                raise ValueError(f"heartbeat from unknown server {sender}")
+            peer.heardAt = time.monotonic()
+            peer.sentAt, peer.vote, peer.primary, peer.echo, peer.lastSeq = sentAt, vote, bool(primary), echo, lastSeq
+
+    # decide who to vote for and whether we hold the lease, from what we've heard; done every
+    # HEARTBEAT_INTERVAL seconds, and reports a change of primary to onChange
+    def tick(self):
+        now = time.monotonic()
+        with self.lock:
+            live = [other for other, peer in self.peers.items() if self.alive(peer, now)]
+            claimed = [other for other in live if self.peers[other].primary]
+            if self.vote == self.serverId and now < self.expiry:
+                candidate = self.serverId
+            elif claimed:
+                candidate = min(claimed)
+            else:
+                candidate = min(live + [self.serverId])
+            if candidate != self.vote:
+                # we can't hold the lease without voting for ourselves, and we can only vote for
+                # another server once the vote we pledged has run out (abstaining until then)
+                self.expiry = 0.0
+                if candidate == self.pledgedTo or now >= self.pledgedUntil:
+                    self.vote = candidate
+                else:
+                    self.vote = NO_SERVER
+            if self.vote == self.serverId:
+                # our own vote counts from now, and each of the others' from the heartbeat it echoes
+                grants = sorted([now] + [peer.echo for peer in self.peers.values() if peer.vote == self.serverId], reverse=True)
+                if len(grants) >= self.quorum:
+                    self.expiry = max(self.expiry, grants[self.quorum - 1] + self.timeout)
+        primary = self.primary()
+        if primary != self.known:
+            self.known = primary
+            self.onChange(primary)
+
+    # start sending heartbeats to the other servers (given a map of their IDs to their internal
+    # addresses), and deciding who to vote for, in the background
+    def start(self, addresses : dict):
+        for other, address in addresses.items():
+            sender = threading.Thread(target=self.sendHeartbeats, args=(other, address))
+            sender.daemon = True
+            sender.start()
+        ticker = threading.Thread(target=self.run)
+        ticker.daemon = True
+        ticker.start()
+
+    def run(self):
+        while True:
+            self.tick()
+            time.sleep(self.interval)
+
+    # (re)connect to another server whenever we're not connected, and send it a heartbeat every
+    # HEARTBEAT_INTERVAL seconds
+    def sendHeartbeats(self, other : int, address):
+        while True:
+            try:
+                sock = socket.create_connection(address, timeout=self.timeout)
+            except OSError:
+                time.sleep(self.interval)
+                continue
+            try:
+                sock.sendall(replication.formatChannelFrame(CHANNEL_HEARTBEAT))
+                while True:
+                    sock.sendall(codec.encodeFrame(HEARTBEAT_FRAME, self.heartbeatFor(other)))
+                    time.sleep(self.interval)
+            except OSError:
+                pass
+            sock.close()
+            time.sleep(self.interval)
+
+    # the receiving end of another server's heartbeats, for as long as it stays connected
+    def receiveHeartbeats(self, sock):
+        try:
+            while True:
+                frame = codec.recvFrame(sock)
+                if frame is None:
+                    break
+                self.receive(frame[1])
+        except (OSError, ValueError, struct.error) as e:
+            print(f"heartbeat connection failed ({e})")
+        sock.close()
+
+# a shard's view of its server's lease, when the server runs as several shards (see shards.py). If
+# each shard ran a lease of its own, the shards of a server could each settle on a different
+# primary, so only shard 0 exchanges heartbeats with the other servers and runs the Lease, and the
+# other shards ask it for the lease over their link to it (given) every HEARTBEAT_INTERVAL seconds
+# (see Lease.share()). Shard 0 reports until when we hold the lease on the same clock as ours
+# (time.monotonic() is the same in every process), so a shard stops acting as the primary no later
+# than shard 0 does, even if it stops hearing from it; and if it does, it knows of no primary.
+# onChange is called just like the Lease's, on the thread asking shard 0
+class ShardLease:
+    def __init__(self, serverId : int, link, onChange,
+                 interval : float = HEARTBEAT_INTERVAL, timeout : float = HEARTBEAT_TIMEOUT):
+        self.serverId = serverId
+        self.link = link
+        self.onChange = onChange
+        self.interval = interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # what shard 0 last told us (see Lease.share()), and time.monotonic() when it did, or None
+        # if it never has
+        self.vote = NO_SERVER
+        self.expiry = 0.0
+        self.claimed = NO_SERVER
+        self.live = []
+        self.heardAt = None
+        # the primary last reported to onChange
+        self.known = NO_SERVER
+
+    def isPrimary(self) -> bool:
+        return self.vote == self.serverId and time.monotonic() < self.expiry
+
+    def primary(self) -> int:
+        now = time.monotonic()
+        with self.lock:
+            if self.isPrimary():
+                return self.serverId
+            if self.heardAt is None or now - self.heardAt >= self.timeout or self.claimed == self.serverId:
+                return NO_SERVER
+            return self.claimed
+
+    # the heartbeats only carry the sequence numbers of the other servers' shard 0, so any server
+    # that's up may be ahead of us on this shard's updates (syncing from one that isn't gets us none)
+    def peerSeqs(self) -> dict:
+        with self.lock:
+            return {other: float("inf") for other in self.live}
+
+    # record what shard 0 told us about the lease (None if it isn't running it yet), and report a
+    # change of primary to onChange
+    def update(self, shared):
+        if shared is not None:
+            with self.lock:
+                self.vote, self.expiry, self.claimed, self.live = shared
+                self.heardAt = time.monotonic()
+        primary = self.primary()
+        if primary != self.known:
+            self.known = primary
+            self.onChange(primary)
+
+    # start asking shard 0 for the lease in the background
+    def start(self):
+        poller = threading.Thread(target=self.run)
+        poller.daemon = True
+        poller.start()
+
+    def run(self):
+        while True:
+            try:
+                shared = self.link.call("lease")
+            except OSError:
+                shared = None
+            self.update(shared)
+            time.sleep(self.interval)
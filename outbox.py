@@ -0,0 +1,251 @@
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from utils import *
+
+# Every write to a client goes through its connection's outbox: a queue of outgoing data drained by
+# a writer, so that request handlers never block on a slow client and writes from different threads
+# (responses to the client's own requests, and messages delivered to it by other clients) are never
+# interleaved on the wire. Writers run on a shared pool of threads, but each outbox is drained by at
+# most one writer at a time, in order. Writers never block on a client: they only write as much as
+# the client's socket takes right away, and once it's full, hand the outbox over to a WritePoller,
+# which waits (on a thread of its own, for every such outbox at once) until the socket can take
+# more, then has a writer pick up where it left off. So a few clients that stop reading can't tie
+# up the writers and hold up everyone else; a client whose socket stays full for longer than the
+# send timeout is given up on.
+# Messages delivered to a client are only queued while the client is keeping up (see offer()): once
+# more than the high watermark of bytes is queued, the outbox is congested, and turns messages away
+# until the client has read enough for it to drain below the low watermark. So a client that's slow
+# to read can't make its outbox grow without bound, or hold up the clients sending to it. If the
+# connection fails, the messages that weren't fully written yet are handed back so they can be
+# kept for later delivery.
+
+# waits for the sockets of outboxes that couldn't be written to any further (see Outbox.drain())
+# to take more data, then has a writer resume draining them; outboxes that don't get to write for
+# longer than the timeout are failed (see Outbox.fail()). Its selector and thread are only created
+# once it's first used, so that a poller created before a server forks its shards works in each
+# of them
+class WritePoller:
+    def __init__(self, writers, timeout : float = CLIENT_SEND_TIMEOUT):
+        self.writers = writers
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # (outbox, whether to wait for it) pairs queued for the poller's thread, which is woken up
+        # through a socket pair to take them
+        self.requests = deque()
+        self.selector = None
+        # map of outboxes being waited for to when they'll be failed
+        self.deadlines = {}
+
+    # wait for an outbox's socket to take more data
+    def wait(self, outbox):
+        self.request(outbox, True)
+
+    # stop waiting for an outbox, e.g. once it's closed
+    def cancel(self, outbox):
+        self.request(outbox, False)
+
+    def request(self, outbox, waiting : bool):
+        with self.lock:
+            if self.selector is None:
+                if not waiting:
+                    return
+                self.selector = selectors.DefaultSelector()
+                self.wakeup, wakeupReceiver = socket.socketpair()
+                self.wakeup.setblocking(False)
+                wakeupReceiver.setblocking(False)
+                self.selector.register(wakeupReceiver, selectors.EVENT_READ)
+                poller = threading.Thread(target=self.run)
+                poller.daemon = True
+                poller.start()
+            self.requests.append((outbox, waiting))
+        try:
+            self.wakeup.send(b"\0")
+        # the poller already has a wakeup pending
+        except BlockingIOError:
+            pass
+
+    def run(self):
+        while True:
+            with self.lock:
+                requests, self.requests = self.requests, deque()
+            for outbox, waiting in requests:
+                if waiting and outbox not in self.deadlines:
+                    try:
+                        self.selector.register(outbox.sock, selectors.EVENT_WRITE, outbox)
+                    except (KeyError, ValueError, OSError):
+                        # the socket is gone, which the writer finds out for itself
+                        self.writers.submit(outbox.drain)
+                        continue
+                    self.deadlines[outbox] = time.monotonic() + self.timeout
+                elif not waiting and outbox in self.deadlines:
+                    self.forget(outbox)
+            timeout = max(0, min(self.deadlines.values()) - time.monotonic()) if self.deadlines else None
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    try:
+                        key.fileobj.recv(RECV_CHUNK_SIZE)
+                    except BlockingIOError:
+                        pass
+                elif key.data in self.deadlines:
+                    self.forget(key.data)
+                    self.writers.submit(key.data.drain)
+            now = time.monotonic()
+            for outbox in [outbox for outbox, deadline in self.deadlines.items() if deadline <= now]:
+                self.forget(outbox)
+                self.writers.submit(outbox.fail)
+
+    def forget(self, outbox):
+        del self.deadlines[outbox]
+        try:
+            self.selector.unregister(outbox.sock)
+        except (KeyError, ValueError, OSError):
+            pass
+
+class Outbox:
+    def __init__(self, sock, writers, poller : WritePoller, highWatermark : int = OUTBOX_HIGH_WATERMARK,
+                 lowWatermark : int = OUTBOX_LOW_WATERMARK, onFailure=None):
+        self.sock = sock
+        # the thread pool (a concurrent.futures executor) that writers run on, and the poller that
+        # waits for the socket whenever it's full
+        self.writers = writers
+        self.poller = poller
+        self.highWatermark = highWatermark
+        self.lowWatermark = lowWatermark
+        # called with the messages (see offer()) that were still queued if the connection fails
+        self.onFailure = onFailure
+        self.lock = threading.Lock()
+        # notified whenever a writer finishes draining the outbox
+        self.emptied = threading.Condition(self.lock)
+        # queued (data, message) pairs, the total length of their data, and how much of the data at
+        # the front of the queue has been written so far
+        self.queue = deque()
+        self.queuedBytes = 0
+        self.written = 0
+        # whether a writer is currently draining the outbox (or waiting for the poller to resume it)
+        self.writing = False
+        self.closed = False
+        # whether the outbox went over its high watermark and hasn't drained below the low one
+        # since, and the number of times it has become congested
+        self.congested = False
+        self.timesCongested = 0
+        # callbacks to run once the outbox is next uncongested
+        self.drainCallbacks = []
+        # the wire protocol version the client speaks (see codec.py), which everything queued is
+        # encoded with; None until the client's first request settles it
+        self.version = None
+
+    # queue a response to the client's own request; responses are always queued, since the client
+    # waits for them before sending more requests
+    def send(self, data : bytes):
+        with self.lock:
+            self.enqueue(data, None)
+
+    # queue a message delivered to the client, unless the outbox is congested (or closed), in which
+    # case False is returned. The message (any object, e.g. the request that sent it) is handed to
+    # onFailure if it's still queued when the connection fails
+    def offer(self, data : bytes, message=None) -> bool:
+        with self.lock:
+            if self.closed or self.congested:
+                return False
+            # a message is always let into an empty outbox, however long it is
+            if self.queuedBytes and self.queuedBytes + len(data) > self.highWatermark:
+                self.congested = True
+                self.timesCongested += 1
+                return False
+            self.enqueue(data, message)
+            return True
+
+    # the caller should hold self.lock
+    def enqueue(self, data : bytes, message):
+        if self.closed:
+            return
+        self.queue.append((data, message))
+        self.queuedBytes += len(data)
+        if not self.writing:
+            self.writing = True
+            self.writers.submit(self.drain)
+
+    # run the given callback (on a writer thread) once the outbox is no longer congested
+    def whenUncongested(self, callback):
+        with self.lock:
+            if self.congested and not self.closed:
+                self.drainCallbacks.append(callback)
+                return
+        self.writers.submit(callback)
+
+    # the writer: write out everything queued, in order, until the outbox is empty or the socket
+    # can't take any more right now, in which case the poller resumes the writer later. Items are
+    # written one at a time rather than joined, since the legacy wire protocol relies on each
+    # response arriving separately
+    def drain(self):
+        while True:
+            with self.lock:
+                if self.closed or not self.queue:
+                    self.writing = False
+                    self.emptied.notify_all()
+                    return
+                data, written = self.queue[0][0], self.written
+            try:
+                sent = self.sock.send(memoryview(data)[written:], socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                self.poller.wait(self)
+                return
+            except OSError:
+                self.fail()
+                return
+            callbacks = []
+            with self.lock:
+                if self.closed:
+                    continue
+                self.written += sent
+                if self.written < len(data):
+                    continue
+                self.queue.popleft()
+                self.written = 0
+                self.queuedBytes -= len(data)
+                if self.congested and self.queuedBytes <= self.lowWatermark:
+                    self.congested = False
+                    callbacks, self.drainCallbacks = self.drainCallbacks, []
+            for callback in callbacks:
+                self.writers.submit(callback)
+
+    # give up on the connection once it's dead, or the client took too long to read: shut it down
+    # so that it's closed and the user logged out as usual, and hand back the messages that weren't
+    # fully written (any that were stay delivered)
+    def fail(self):
+        undelivered = self.abort()
+        if undelivered and self.onFailure is not None:
+            self.onFailure(undelivered)
+
+    # wait (up to the given number of seconds) until everything queued has been written, returning
+    # whether it was, e.g. before the connection is handed over to another process
+    def waitUntilEmpty(self, timeout : float) -> bool:
+        with self.lock:
+            return self.emptied.wait_for(lambda: self.closed or not self.writing, timeout)
+
+    # give up on a client that isn't keeping up: shut its connection down (so that it's closed and
+    # the user logged out as usual), returning the messages that were still queued
+    def abort(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        return self.close()
+
+    # stop writing to the client, returning the messages that were still queued (including one that
+    # was only partly written)
+    def close(self):
+        with self.lock:
+            self.closed = True
+            undelivered = [message for _, message in self.queue if message is not None]
+            self.queue.clear()
+            self.queuedBytes = 0
+            self.written = 0
+            self.drainCallbacks = []
+            self.emptied.notify_all()
+        self.poller.cancel(self)
+        return undelivered
@@ -0,0 +1,196 @@
+import hashlib
+import socket
+import threading
+from bisect import bisect_right
+
+from utils import *
+import codec
+
+# Partitioning users between replica groups: one group of servers (a primary and its replicas)
+# holds every user by default, so the whole system is capped by what its primary can do.
+# Instead, the users can be split between several partitions, each served by a replica group of
+# its own, on its own ports (see clientPort()). Which partition owns a username is decided by a
+# partition map, which every server and client shares: a consistent hash ring, on which each
+# partition has PARTITION_VNODES points, and a username belongs to the partition of the first
+# point at or after its hash. Adding a partition to the map only moves the users whose hashes fall
+# just before its points (about 1/N of them with N partitions) to it; everyone else stays put.
+# Users register and log in with the primary of their partition, which clients look up in the map
+# they're sent when they connect (see OP_PARTITION_MAP). A message to a user of another partition
+# is forwarded to the primary of that partition, over a PartitionLink: a connection to it that
+# speaks the same protocol as clients do. Searches are run on every partition and the results
+# merged (each partition is searched with OP_SEARCH_PARTITION, which doesn't fan out any further).
+# Partition maps are written one partition per line, as "<partition> <host 0> <host 1> ...", with
+# the hosts of each of the partition's servers.
+
+# the client port of a server of a partition
+def clientPort(partition : int, server : int) -> int:
+    return SERVER_PORTS[server] + partition * PARTITION_PORT_STRIDE
+
+# where a string falls on the hash ring
+def ringHash(key : str) -> int:
+    return int.from_bytes(hashlib.md5(bytes(key, 'ascii')).digest()[:8], "big")
+
+class PartitionMap:
+    def __init__(self, hosts : dict, vnodes : int = PARTITION_VNODES):
+        # map of partitions to the hosts of their servers, in order
+        self.hosts = hosts
+        # the points on the ring, sorted, and the partition each one belongs to
+        points = sorted((ringHash(f"{partition}#{i}"), partition) for partition in hosts for i in range(vnodes))
+        self.points = [point for point, _ in points]
+        self.owners = [partition for _, partition in points]
+
+    def __len__(self):
+        return len(self.hosts)
+
+    # the partition that owns a username
+    def partitionOf(self, username : str) -> int:
+        i = bisect_right(self.points, ringHash(username))
+        return self.owners[i % len(self.owners)]
+
+    # the addresses of a partition's servers, in the order clients try them
+    def addressesOf(self, partition : int):
+        return [(host, clientPort(partition, server)) for server, host in enumerate(self.hosts[partition])]
+
+    def format(self) -> str:
+        return "".join(f"{partition} {' '.join(hosts)}\n" for partition, hosts in sorted(self.hosts.items()))
+
+# complementary to PartitionMap.format(); raises a ValueError if a line is malformed
+def parsePartitionMap(text : str) -> PartitionMap:
+    hosts = {}
+    for line in text.splitlines():
+        if not line.strip() or line.startswith("#"):
+            continue
+        fields = line.split()
+        if not 2 <= len(fields) <= MAX_REPLICAS + 1 or not fields[0].isdigit():
+            raise ValueError(f"bad partition {line!r}")
+        hosts[int(fields[0])] = fields[1:]
+    if not hosts:
+        raise ValueError("no partitions")
+    return PartitionMap(hosts)
+
+def loadPartitionMap(path : str) -> PartitionMap:
+    with open(path) as f:
+        return parsePartitionMap(f.read())
+
+# a link to the primary of another partition, through which requests about its users are
+# forwarded. Like clients, the link asks the partition's servers in order which one is the primary
+# (see OP_PRIMARY), and connects to it; a request the server refuses for not being the primary
+# (after a failover) is made again on a new connection. Requests are made over a small pool of
+# connections that are kept open, so concurrent requests don't wait for each other and don't
+# connect each time
+class PartitionLink:
+    def __init__(self, partition : int, addresses):
+        self.partition = partition
+        self.addresses = addresses
+        self.lock = threading.Lock()
+        # idle connections, with the protocol version negotiated on each
+        self.idle = []
+        # the ID of the next request made over the link
+        self.nextRequestId = 1
+
+    # make a request over a connection and wait for its response, returning its status and body.
+    # Each request gets an ID of its own, which the server echoes back: anything else received on the
+    # connection in the meantime (e.g. a change of primary pushed to every client; see PRIMARY_IS)
+    # is skipped
+    def call(self, sock, version : int, op : int, payload : bytes):
+        with self.lock:
+            requestId = self.nextRequestId
+            self.nextRequestId += 1
+        sock.sendall(codec.encodeRequest(version, op, payload, requestId))
+        while True:
+            frame = codec.recvFrame(sock)
+            if frame is None:
+                raise ConnectionError(f"partition {self.partition} closed the link")
+            status, body = frame
+            echoedId, body = codec.decodeTagged(version, body)
+            if echoedId == requestId:
+                return status, body
+
+    # connect to a server, returning the connection, the protocol version, and the ID of the
+    # partition's primary as far as the server knows, or None if it can't be reached
+    def connectTo(self, server : int):
+        try:
+            sock = socket.create_connection(self.addresses[server], timeout=PARTITION_CALL_TIMEOUT)
+        except OSError:
+            return None
+        try:
+            sock.sendall(codec.encodeHello())
+            status, version = recvExactly(sock, 2 * CODE_LENGTH)
+            if status == HELLO_OK and version >= PROTOCOL_REQUEST_IDS:
+                status, body = self.call(sock, version, OP_PRIMARY, b"")
+                if status == PRIMARY_IS:
+                    return sock, version, body[0]
+        except (OSError, IndexError, codec.ProtocolError):
+            pass
+        sock.close()
+        return None
+
+    def connect(self):
+        for server in range(len(self.addresses)):
+            conn = self.connectTo(server)
+            if conn is None:
+                continue
+            sock, version, primary = conn
+            if primary == server:
+                return sock, version
+            sock.close()
+            if primary < len(self.addresses):
+                conn = self.connectTo(primary)
+                if conn is not None and conn[2] == primary:
+                    return conn[0], conn[1]
+                if conn is not None:
+                    conn[0].close()
+        raise ConnectionError(f"no primary of partition {self.partition} could be reached")
+
+    # make a request to the partition's primary, returning the status and body of the (single)
+    # response; raises an OSError if the partition can't be reached. A pooled connection may have
+    # been closed for being idle, or be to a server that's no longer the primary, in which case the
+    # request is made again on a new one
+    def request(self, op : int, payload : bytes):
+        with self.lock:
+            pooled = self.idle.pop() if self.idle else None
+        attempts = [pooled, None] if pooled is not None else [None]
+        for conn in attempts:
+            sock, version = conn if conn is not None else self.connect()
+            try:
+                status, body = self.call(sock, version, op, payload)
+                if status == NOT_PRIMARY and conn is not None:
+                    raise ConnectionError(f"server of partition {self.partition} is no longer the primary")
+            except (OSError, codec.ProtocolError) as e:
+                sock.close()
+                if conn is None:
+                    raise ConnectionError(f"link to partition {self.partition} failed ({e})") from e
+                continue
+            with self.lock:
+                self.idle.append((sock, version))
+            return status, body
+
+    # forward a send request (its data, as received), returning the status for the sender
+    def send(self, payload : bytes) -> int:
+        status, _ = self.request(OP_SEND, payload)
+        return status
+
+    # forward a batch send (see formatSendBatch()) to recipients the partition owns, returning a
+    # status for each delivery
+    def sendBatch(self, sender : str, deliveries) -> List[int]:
+        status, body = self.request(OP_SEND_BATCH, bytes(formatSendBatch(sender, [([recipient], message) for recipient, message in deliveries]), 'ascii'))
+        if status != SEND_BATCH_OK:
+            return [status] * len(deliveries)
+        _, statuses = codec.decodeCountedPayload(body)
+        return list(statuses)
+
+    # search the partition's users (see UsernameIndex.search()), a page at a time
+    def search(self, query : str, after : str = "", limit : int = None) -> List[str]:
+        results = []
+        while limit is None or len(results) < limit:
+            pageLimit = SEARCH_PAGE_LIMIT if limit is None else min(limit - len(results), SEARCH_PAGE_LIMIT)
+            status, body = self.request(OP_SEARCH_PARTITION, bytes(f"{pageLimit}|{after}|{query}", 'ascii'))
+            if status not in { SEARCH_OK, SEARCH_OK_MORE }:
+                break
+            _, page = codec.decodeCountedPayload(body)
+            page = page.decode('ascii').split("|")
+            results += page
+            if status == SEARCH_OK:
+                break
+            after = page[-1]
+        return results
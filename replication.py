@@ -0,0 +1,311 @@
+import socket
+import threading
+import time
+
+from utils import *
+import storage
+import codec
+
+# Server-to-server replication over long-lived streaming connections. When acting as the primary,
+# a server keeps a ReplicaChannel open to each replica, over which it sends every operation it logs
+# (encoded as a log record, so it carries its sequence number) as soon as it's logged. Updates are
+# pipelined: many can be in flight at once, and the replica acknowledges them by sending back the
+# sequence number of the latest update it has made durable. A state-changing request then only
+# waits until its own update has been acknowledged, rather than sleeping, and an update can no
+# longer be silently lost in transit.
+# When a connection is opened, the replica first sends the sequence number of the last update it
+# has applied, and the primary catches it up by sending just the updates it's missing, read back
+# from the primary's log. Only if the log has been compacted past that point does the primary send
+# a snapshot of its whole state first, in chunks. Servers syncing their state from a peer (e.g. on
+# startup) are caught up the same way.
+# The primary doesn't wait for every replica: an update is committed once a quorum of the group
+# (WRITE_QUORUM servers, the primary included) has made it durable (see waitForQuorum()), so a
+# slow or dead replica doesn't add its latency to every state-changing request.
+# Besides updates, the primary sends its replicas a few records that aren't logged: sync marks, from
+# which a replica knows how far behind the primary it may be (so it can serve read-only sessions
+# while it's close enough), and which users are logged in.
+# Every connection opens with a frame (see codec.py) saying what it's for and which protocol version
+# the connecting server speaks; updates themselves are sent as log records, which are already
+# self-delimiting and checksummed.
+
+# raised when applying an update that arrived out of sequence, i.e. with updates before it missing;
+# the connection it arrived on is dropped without applying it, so that the primary catches us up
+# from the last update we did apply when it reconnects
+class MissedUpdates(ConnectionError):
+    pass
+
+# read a single log record from a socket, returning a (seq, op, timestamp, data) tuple; raises a
+# ConnectionError if the connection closes or the record is corrupted
+def recvRecord(sock):
+    header = recvExactly(sock, storage.RECORD_HEADER.size)
+    _, _, _, length = storage.RECORD_HEADER.unpack(header)
+    record = storage.decodeRecord(header + recvExactly(sock, length + storage.RECORD_CHECKSUM.size))
+    if record is None:
+        raise ConnectionError("corrupted update")
+    return record
+
+# encode the frame opening a connection to another server, for the given channel (CHANNEL_REPLICATE
+# or CHANNEL_SYNC) and with any channel-specific data
+def formatChannelFrame(channel : int, data : bytes = b"") -> bytes:
+    return codec.encodeFrame(channel, codec.encodeVarint(PROTOCOL_VERSION) + data)
+
+# complementary to the above: read the frame opening a connection from another server, returning the
+# channel and its data; raises a ProtocolError if the other server speaks a different version
+def recvChannelFrame(sock):
+    frame = codec.recvFrame(sock, MAX_REQUEST_LENGTH)
+    if frame is None:
+        raise ConnectionError("connection closed")
+    channel, payload = frame
+    decoded = codec.decodeVarint(payload)
+    if decoded is None or decoded[0] != PROTOCOL_VERSION:
+        raise codec.ProtocolError("unsupported protocol version")
+    return channel, payload[decoded[1]:]
+
+def recvSeq(sock) -> int:
+    return int.from_bytes(recvExactly(sock, SEQ_LENGTH), "big")
+
+def formatSeq(seq : int) -> bytes:
+    return seq.to_bytes(SEQ_LENGTH, "big")
+
+# send a snapshot of the state (a pickled state dictionary) as a series of chunks, in the form of
+# log records with internal operation codes
+def sendSnapshot(sock, snapshot : bytes):
+    for start in range(0, len(snapshot), SNAPSHOT_CHUNK_SIZE):
+        sock.sendall(storage.encodeRecord(0, OP_SNAPSHOT_CHUNK, 0, snapshot[start:start + SNAPSHOT_CHUNK_SIZE]))
+    sock.sendall(storage.encodeRecord(0, OP_SNAPSHOT_END, 0, b""))
+
+# once we're done sending on a connection, wait for the other end to finish reading (and sending
+# acknowledgements) before closing it, so that nothing we sent is lost
+def finishSending(sock):
+    try:
+        sock.shutdown(socket.SHUT_WR)
+        while sock.recv(RECV_CHUNK_SIZE):
+            pass
+    except OSError:
+        pass
+    sock.close()
+
+# the primary's end of a connection to one replica; once connected, catchUp(channel, sock,
+# replicaSeq) is called to attach the socket (see attach()) and send the replica the updates it's
+# missing, after which newly logged updates are streamed to it. The channels to a group's replicas
+# share a condition, so that waiting on a quorum of them wakes up on any of their acknowledgements
+class ReplicaChannel:
+    def __init__(self, replicaId : int, host : str, port : int, catchUp, cond=None):
+        self.replicaId = replicaId
+        self.address = (host, port)
+        self.catchUp = catchUp
+        self.cond = cond if cond is not None else threading.Condition()
+        self.sock = None
+        # whether the replica has been sent every update logged before it connected
+        self.caughtUp = False
+        # encoded records waiting to be sent
+        self.outbox = []
+        # sequence number of the latest update the replica has acknowledged
+        self.ackedSeq = 0
+        # whether the replica may have applied updates the primary has since rolled back, so that it
+        # has to be sent the primary's whole state when it reconnects (see rollBack())
+        self.diverged = False
+        self.closed = False
+        sender = threading.Thread(target=self.run)
+        sender.daemon = True
+        sender.start()
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    # whether the replica is connected and receiving new updates as they're logged, i.e. whether
+    # it's worth waiting for it to acknowledge them
+    @property
+    def live(self):
+        return self.sock is not None and self.caughtUp
+
+    # start queueing newly logged updates for a newly connected replica, which has applied updates
+    # up to the given sequence number; the caller should hold the lock that orders logged updates,
+    # so that every update is either queued or caught up on
+    def attach(self, sock, replicaSeq : int):
+        with self.cond:
+            self.sock = sock
+            self.caughtUp = False
+            self.ackedSeq = replicaSeq
+
+    # queue an update to be sent to the replica (the caller should send updates in sequence number
+    # order); updates are dropped while the replica isn't connected
+    def send(self, record : bytes):
+        with self.cond:
+            if self.sock is not None:
+                self.outbox.append(record)
+                self.cond.notify_all()
+
+    # wait until the replica acknowledges the update with the given sequence number, returning
+    # whether it did before the deadline (or before the replica disconnected)
+    def waitForAck(self, seq : int, deadline : float) -> bool:
+        with self.cond:
+            while self.sock is not None and self.ackedSeq < seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.ackedSeq >= seq
+
+    # the primary rolled back the updates from the given sequence number on (see
+    # server.rollback_updates()), which the replica may have applied: disconnect it before any
+    # update reusing their sequence numbers is sent, and mark it to be reset when it reconnects
+    def rollBack(self, seq : int):
+        with self.cond:
+            self.diverged = True
+            self.ackedSeq = min(self.ackedSeq, seq - 1)
+            self.disconnect()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.disconnect()
+
+    # the caller should hold self.cond
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            self.caughtUp = False
+            self.outbox = []
+            self.cond.notify_all()
+
+    # (re)connect to the replica whenever we're not connected, and send queued updates
+    def run(self):
+        while not self.closed:
+            try:
+                sock = socket.create_connection(self.address, timeout=REPLICA_CONNECT_TIMEOUT)
+                sock.sendall(formatChannelFrame(CHANNEL_REPLICATE))
+                replicaSeq = recvSeq(sock)
+                sock.settimeout(None)
+            except OSError:
+                time.sleep(REPLICA_RETRY_INTERVAL)
+                continue
+            print(f"connected to replica {self.replicaId}, which has applied updates up to {replicaSeq}")
+            acks = threading.Thread(target=self.receiveAcks, args=(sock,))
+            acks.daemon = True
+            try:
+                self.catchUp(self, sock, replicaSeq)
+                acks.start()
+            except Exception as e:
+                print(f"failed to catch up replica {self.replicaId}: {e}")
+                with self.cond:
+                    self.disconnect()
+                sock.close()
+                time.sleep(REPLICA_RETRY_INTERVAL)
+                continue
+            with self.cond:
+                self.caughtUp = True
+            self.sendUpdates(sock)
+            print(f"disconnected from replica {self.replicaId}")
+
+    # send every queued update, pipelined, until the connection fails
+    def sendUpdates(self, sock):
+        while True:
+            with self.cond:
+                while self.sock is sock and not self.outbox:
+                    self.cond.wait()
+                if self.sock is not sock:
+                    return
+                records, self.outbox = self.outbox, []
+            try:
+                sock.sendall(b"".join(records))
+            except OSError:
+                with self.cond:
+                    if self.sock is sock:
+                        self.disconnect()
+                return
+
+    def receiveAcks(self, sock):
+        try:
+            while True:
+                seq = recvSeq(sock)
+                with self.cond:
+                    self.ackedSeq = max(self.ackedSeq, seq)
+                    self.cond.notify_all()
+        except OSError:
+            with self.cond:
+                if self.sock is sock:
+                    self.disconnect()
+
+# wait until at least the given number of replicas (out of the given channels, which share a
+# condition) have acknowledged the update with the given sequence number, returning whether they
+# did before the deadline. Replicas that aren't live won't acknowledge it in time, so the wait ends
+# as soon as the live ones can't make up the quorum
+def waitForQuorum(channels, seq : int, quorum : int, deadline : float) -> bool:
+    if quorum <= 0:
+        return True
+    with channels[0].cond:
+        while True:
+            acked = sum(1 for channel in channels if channel.ackedSeq >= seq)
+            if acked >= quorum:
+                return True
+            waiting = sum(1 for channel in channels if channel.live and channel.ackedSeq < seq)
+            remaining = deadline - time.monotonic()
+            if acked + waiting < quorum or remaining <= 0:
+                return False
+            channels[0].cond.wait(remaining)
+
+# the replica's end of a connection from the primary (or a syncing server's end of a connection to
+# a peer): report the last applied sequence number, then apply each update with applyUpdate(seq, op,
+# timestamp, data), which returns a Commit for when the update is durable (or None if there was
+# nothing to do), and acknowledge it once it is. Snapshots are reassembled from their chunks and
+# installed with installSnapshot(snapshot). Updates are applied as they arrive, and
+# acknowledgements are sent by a separate thread, so consecutive updates are group committed together.
+# Unsequenced records (see UNSEQUENCED) are passed to applyUpdate too, but never acknowledged. If
+# applyUpdate raises MissedUpdates, the connection is closed (once the updates before are acknowledged)
+def receiveUpdates(sock, lastSeq : int, applyUpdate, installSnapshot):
+    pending = []
+    cond = threading.Condition()
+    done = False
+
+    def sendAcks():
+        while True:
+            with cond:
+                while not pending and not done:
+                    cond.wait()
+                if not pending:
+                    return
+                batch = list(pending)
+                pending.clear()
+            # acknowledge the latest update once it and every update before it is durable
+            try:
+                for _, commit in batch:
+                    if commit is not None:
+                        commit.wait()
+                sock.sendall(formatSeq(batch[-1][0]))
+            except Exception:
+                return
+
+    acker = threading.Thread(target=sendAcks)
+    acker.daemon = True
+    acker.start()
+    try:
+        sock.sendall(formatSeq(lastSeq))
+        snapshot = bytearray()
+        while True:
+            seq, op, timestamp, data = recvRecord(sock)
+            if op == OP_SNAPSHOT_CHUNK:
+                snapshot += data
+                continue
+            elif op == OP_SNAPSHOT_END:
+                installSnapshot(bytes(snapshot))
+                snapshot = bytearray()
+                continue
+            commit = applyUpdate(seq, op, timestamp, data)
+            if seq == UNSEQUENCED:
+                continue
+            with cond:
+                pending.append((seq, commit))
+                cond.notify()
+    except MissedUpdates as e:
+        print(f"{e}, dropping the connection to be caught up")
+    except OSError:
+        pass
+    finally:
+        with cond:
+            done = True
+            cond.notify()
+        acker.join()
+        sock.close()
@@ -0,0 +1,118 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+import threading
+
+from utils import *
+
+# A search index over the registered usernames, kept up to date as users register and are deleted,
+# so that searches don't have to check every registered username against the query. Usernames are
+# kept in sorted order: queries anchored by a literal prefix (e.g. "abc*") only look at the
+# usernames starting with that prefix, found by binary search, so a prefix query takes time
+# proportional to the number of results rather than the number of users. For other wildcard
+# queries (e.g. "*son*" or "a*b*c"), we also keep an n-gram index mapping every substring of one to
+# three characters to the usernames containing it: only the usernames containing every trigram of
+# the query's literal parts (or the whole literal, if it's shorter than three characters) can
+# match, so only those candidates are checked against the query. Only queries with no literal part
+# at all (e.g. "*"), which match every username anyway, check every username.
+
+# all substrings of a string of one to three characters (the n-grams the index is kept by)
+def ngrams(s : str):
+    return {s[i:i + n] for n in range(1, 4) for i in range(len(s) - n + 1)}
+
+# the n-grams of a query's literal part that a matching username must contain: its trigrams, or the
+# literal itself if it's shorter than that
+def literalGrams(literal : str):
+    if len(literal) < 3:
+        return {literal} if literal else set()
+    return {literal[i:i + 3] for i in range(len(literal) - 2)}
+
+class UsernameIndex:
+    def __init__(self, usernames=()):
+        self.lock = threading.Lock()
+        self.rebuild(usernames)
+
+    def __len__(self):
+        return len(self.usernames)
+
+    def __contains__(self, username):
+        with self.lock:
+            i = bisect_left(self.usernames, username)
+            return i < len(self.usernames) and self.usernames[i] == username
+
+    # replace the contents of the index, e.g. after loading a new state
+    def rebuild(self, usernames):
+        usernames = sorted(usernames)
+        postings = defaultdict(set)
+        for username in usernames:
+            for gram in ngrams(username):
+                postings[gram].add(username)
+        with self.lock:
+            self.usernames = usernames
+            self.postings = postings
+
+    def add(self, username : str):
+        with self.lock:
+            i = bisect_left(self.usernames, username)
+            if i == len(self.usernames) or self.usernames[i] != username:
+                self.usernames.insert(i, username)
+                for gram in ngrams(username):
+                    self.postings[gram].add(username)
+
+    def remove(self, username : str):
+        with self.lock:
+            i = bisect_left(self.usernames, username)
+            if i < len(self.usernames) and self.usernames[i] == username:
+                del self.usernames[i]
+                for gram in ngrams(username):
+                    self.postings[gram].discard(username)
+                    if not self.postings[gram]:
+                        del self.postings[gram]
+
+    # the range of indices of the usernames starting with the given prefix; usernames are
+    # alphanumeric, so every username starting with the prefix sorts before prefix + DEL
+    def prefixRange(self, prefix : str):
+        return bisect_left(self.usernames, prefix), bisect_left(self.usernames, prefix + "\x7f")
+
+    # the usernames containing every n-gram of the query's literal parts (see literalGrams(); the
+    # caller should hold the lock), or None if the query has no literal parts
+    def gramCandidates(self, query : str):
+        queryGrams = set().union(*map(literalGrams, query.split("*")))
+        if not queryGrams:
+            return None
+        # intersect the smallest postings first, so that the candidate set shrinks quickly
+        postings = sorted((self.postings.get(gram, set()) for gram in queryGrams), key=len)
+        return postings[0].intersection(*postings[1:])
+
+    # returns the registered usernames matching the query, in order; like searchUsernames(), *
+    # matches zero or more of any character. For pagination, results can be limited to those after
+    # a given username (the last result of the previous page), and to a maximum number of results
+    def search(self, query : str, after : str = "", limit : int = None) -> List[str]:
+        # an empty query matches everything
+        if not query:
+            query = "*"
+        # no wildcards: the query matches at most the one username equal to it
+        if "*" not in query:
+            return [query] if query > after and limit != 0 and query in self else []
+        prefix, rest = query.split("*", 1)
+        with self.lock:
+            # "<prefix>*" matches exactly the usernames starting with the prefix, so a page of
+            # results is just a slice of them
+            if not rest.strip("*"):
+                start, end = self.prefixRange(prefix)
+                start = max(start, bisect_right(self.usernames, after))
+                if limit is not None:
+                    end = min(end, start + limit)
+                return self.usernames[start:end]
+            # otherwise find a set of candidates that could match, using whichever of the prefix
+            # range and the n-gram index narrows things down the most, and check each of them
+            candidates = self.gramCandidates(query)
+            if prefix:
+                start, end = self.prefixRange(prefix)
+                if candidates is None or end - start < len(candidates):
+                    candidates = self.usernames[start:end]
+            if candidates is None:
+                candidates = list(self.usernames)
+            else:
+                candidates = sorted(candidates)
+        results = searchUsernames(candidates[bisect_right(candidates, after):], query)
+        return results if limit is None else results[:limit]
@@ -1,17 +1,34 @@
 import socket
-from collections import defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import selectors
 import threading
 import time
 import pickle
+import argparse
+import heapq
+import multiprocessing
+import os
+import select
 
 import sys
 sys.path.append('..')
 from utils import *
+import storage
+import replication
+import codec
+from search import UsernameIndex
+from spool import MessageSpool, mailboxesOf
+from outbox import Outbox, WritePoller
+from statestore import StateStore
+from shards import ShardLink, shardOf, internalPort, linkPath, listenForShards, serveShardLinks
+from partitions import PartitionMap, PartitionLink, clientPort, loadPartitionMap
+from leases import Lease, ShardLease
 
-# we maintain a relatively simple implementation: no selectors are used, with a new
-# thread being opened for each client connection. All data is also stored in memory
-# (so if the server exits, no data is saved). For each client connection, we loop
-# while reading input, processing it, and returning an appropriate response.
+# we maintain a relatively simple implementation: by default, a single event loop thread
+# multiplexes every client connection with a selector and hands complete requests to a small,
+# fixed pool of worker threads (alternatively, a new thread can be opened for each client
+# connection). For each request, we process it and return an appropriate response.
 
 # *** CONSTS *** (or variables set once during initialization)
 # The server uuid: either 0, 1, or 2, and the uuid of the primary server.
@@ -30,435 +47,1757 @@ OTHER_SERVERS = [-1]
 # this server instance's streaming socket for handling client requests
 clientSock = None
 
-# this server instance's datagram socket for server-to-server communications
+# this server instance's streaming socket for server-to-server communications
 serverSock = None
 
-# all relevant quantities to persist in the state, we store this via pickling and will
-# load this upon system reboot.
-serverState = {
-    # timestamp of snapshot - default value is set to 0 so that any valid states with true timestamps
-    # will be seen as more recent
-    "timestamp": 0,
-    
-    # all registered users
-    "registeredUsers": set(),
-    
-    # the message buffer stores undelivered messages, and is a dictionary mapping usernames
-    # to a list of messages they are to receive upon login
-    # each message is encoded as a string with the format "<sender>|<receiver>"
-    "messageBuffer": defaultdict(list),
-    
-    # we don't need to keep track of which users are logged in - in the event that
-    # the system shuts down, we automatically mark the user as logged out on both the
-    # client and server code
-}
+# the shard this process serves (see shards.py) out of the server's shards, the links to the other
+# shards, and the socket the other shards' links connect to; a server that isn't sharded is its
+# own only shard
+SHARD = 0
+NUM_SHARDS = 1
+shardLinks = {}
+shardSock = None
+
+# the partition of the users this server's replica group serves (see partitions.py), the map of
+# every partition (None if the users aren't partitioned), and the links to the other partitions
+PARTITION = 0
+partitionMap = None
+partitionLinks = {}
+
+# whether the server has finished starting up (its state is reconciled with the other servers',
+# and it's serving clients)
+serverReady = False
+
+# all relevant quantities to persist in the state, we store this as a snapshot (via pickling)
+# plus a log of the operations applied since, and will load this upon system reboot.
+def empty_server_state():
+    return {
+        # timestamp of the last update - default value is set to 0 so that any valid states with
+        # true timestamps will be seen as more recent
+        "timestamp": 0,
+        
+        # sequence number of the last update applied to the state; log records with sequence
+        # numbers up to this one are already reflected in the state
+        "lastSeq": 0,
+        
+        # all registered users
+        "registeredUsers": set(),
+        
+        # undelivered messages aren't part of the state, but kept on disk in the message spool
+        # (see spool.py), and only read when their recipient logs in
+        
+        # we don't need to keep track of which users are logged in - in the event that
+        # the system shuts down, we automatically mark the user as logged out on both the
+        # client and server code
+    }
+
+# the server's state and its logged in users, behind per-user locks (see statestore.py)
+store = StateStore(empty_server_state())
 
 # keep a list of all opened threads, to make sure they don't get GC'd (perhaps unnecessary)
 threads = []
 
-# map of active, logged in usernames to the sockets through which they are connected 
-# to the server; the keys of this dictionary thus serve as a list of online users
-userToSocket = {}
+# map of client sockets to their outboxes, through which everything is written to them (see
+# outbox.py), the pool of threads writing them out, and the poller waiting for the sockets of
+# clients that aren't reading fast enough
+outboxes = {}
+outboxesLock = threading.Lock()
+writers = ThreadPoolExecutor(max_workers=WRITER_THREADS, thread_name_prefix="writer")
+writePoller = WritePoller(writers)
+
+# number of times each slow consumer policy (see SLOW_CONSUMER_POLICY) has fired: messages
+# buffered because their recipient wasn't keeping up, and recipients disconnected for it
+slowConsumerCounters = {SLOW_CONSUMER_BUFFER: 0, SLOW_CONSUMER_DISCONNECT: 0}
+slowConsumerLock = threading.Lock()
+
+# search index over the registered users in the store, kept up to date as users register and
+# are deleted
+usernameIndex = UsernameIndex()
+
+# connections to the replicas, over which updates are streamed while this server is the primary
+replicaChannels = None
+
+# while this server is a secondary: the users the primary last told us are logged in, and when we
+# were last known to be up to date with the primary (the time.monotonic() a sync mark arrived, or
+# None if one never has), from which we know how stale the reads we serve may be
+replicaPresence = set()
+lastSynced = None
+
+# the primary's lease (see leases.py), which decides which server of the group acts as the primary;
+# a server that isn't running one (None) acts as the primary as soon as a client asks it to. When
+# the server runs as several shards, only shard 0 runs the Lease, and the others follow it (see
+# ShardLease), so that every shard of a server agrees on the primary. Once
+# the lease is ours, we catch up and start replicating before actually acting as the primary, and
+# roleLock is held while taking over or stepping down
+lease = None
+actingPrimary = False
+roleLock = threading.Lock()
+
+# held while queueing logins and logouts for the replicas, so that a replica connecting in the
+# meantime is sent every user logged in either before or after them
+presenceLock = threading.Lock()
+
+# the log of state-changing operations since the last snapshot (opened on first use), and a lock
+# so that concurrent client threads append records one at a time, in sequence number order
+operationLog = None
+logLock = threading.Lock()
+
+# held while writing a snapshot, so that a snapshot installed from another server is never
+# overwritten by an older one built in the background
+snapshotLock = threading.Lock()
+
+# the updates we've logged (and applied) as the primary that aren't committed yet, as (seq, op,
+# timestamp, data) tuples in sequence number order, so that they can be rolled back if they miss
+# the write quorum (see rollback_updates()); and the sequence numbers updates were rolled back from,
+# in order, so that a request can tell whether its update was among them
+uncommittedUpdates = deque()
+rollbacks = []
+
+# the spool of undelivered messages (opened on first use)
+messageSpool = None
+
+# the directory every server's state is kept in
+STATE_DIRECTORY = "state"
+
+# paths of this server's snapshot and operation log (the log is made up of numbered segment files
+# starting with this path), and the directory of its message spool
+def snapshot_path():
+    return os.path.join(STATE_DIRECTORY, f"server_{SERVER_ID}{state_suffix()}.pickle")
+
+def log_path():
+    return os.path.join(STATE_DIRECTORY, f"server_{SERVER_ID}{state_suffix()}.log")
+
+def spool_path():
+    return os.path.join(STATE_DIRECTORY, f"server_{SERVER_ID}{state_suffix()}.spool")
+
+# each partition, and each shard of a sharded server, keeps its own state, so its files are named
+# after them
+def state_suffix():
+    return (f".partition{PARTITION}" if PARTITION else "") + (f".shard{SHARD}" if NUM_SHARDS > 1 else "")
+
+# apply a state-changing operation to a state; the operation-specific data is the same data that
+# the client sent for the operation (the username for registers, logins, and deletes, or the
+# sender, recipient, and message for buffered sends). Logins and buffered sends only change the
+# message spool, so they're applied to it instead (see MessageSpool.apply())
+def apply_update(state, op, data):
+    # registers: add the user
+    if op == OP_REGISTER:
+        state["registeredUsers"].add(data.decode('ascii'))
+    # deletes: remove the user
+    elif op == OP_DELETE:
+        state["registeredUsers"].discard(data.decode('ascii'))
+
+# open the operation log if it isn't already (the caller should hold logLock)
+def open_operation_log():
+    global operationLog
+    if operationLog is None:
+        operationLog = storage.OperationLog(log_path(), FSYNC_POLICY, FSYNC_INTERVAL_MS)
+    return operationLog
+
+# open the message spool if it isn't already
+def open_message_spool():
+    global messageSpool
+    if messageSpool is None:
+        messageSpool = MessageSpool(spool_path())
+    return messageSpool
+
+# start streaming updates to the replicas, if we haven't already (i.e. on becoming the primary)
+def start_replica_channels():
+    global replicaChannels
+    if replicaChannels is None:
+        # the users we were told are logged in as a secondary log in with us from now on
+        replicaPresence.clear()
+        cond = threading.Condition()
+        replicaChannels = [
+            replication.ReplicaChannel(replica, SERVER_HOSTS[replica], internalPort(replica, SHARD, PARTITION), catch_up_replica, cond)
+            for replica in OTHER_SERVERS
+        ]
+    return replicaChannels
+
+# durably record a state-changing operation that was just applied to the store, by appending it
+# to the operation log; this costs the same no matter how large the state is. The record is group
+# committed with those of other client threads, and also sent to the replicas (see
+# replication.py) so they can update their states. Buffered sends and acknowledgements of unread
+# messages are applied to the message spool here, in sequence number order. We only return once
+# the record is durable and enough replicas have acknowledged it to make up a write quorum (or
+# have taken too long to), returning whether they did (see await_update())
+def record_update(op, data):
+    return await_update(append_update(op, data))
+
+# the first half of record_update(): append the record to the log (and apply it to the spool)
+# without waiting for it to be durable, returning what await_update() waits on (including the number
+# of rollbacks so far, see rolled_back()). Requests append
+# their records while holding the locks of the users they change (see statestore.py), so that the
+# changes are logged in the order they're made, and wait for them after releasing the locks
+def append_update(op, data):
+    channels = start_replica_channels() if lease is None else replicaChannels or []
+    state = store.state
+    with logLock:
+        seq = state["lastSeq"] = state["lastSeq"] + 1
+        state["timestamp"] = time.time()
+        record = storage.encodeRecord(seq, op, state["timestamp"], data)
+        commit = open_operation_log().appendRecord(record)
+        open_message_spool().apply(seq, op, state["timestamp"], data)
+        uncommittedUpdates.append((seq, op, state["timestamp"], data))
+        # records are queued for the replicas under the log lock, so they're sent in order
+        for channel in channels:
+            channel.send(record)
+        epoch = len(rollbacks)
+    return seq, commit, channels, epoch
+
+# the second half of record_update(): wait for an appended record to be durable and acknowledged
+# by a quorum, returning whether the update is committed. If the live replicas can't make up the
+# quorum within REPLICATION_ACK_TIMEOUT, the update is rolled back (see rollback_updates()) and the
+# request fails with UPDATE_NOT_REPLICATED, so that the primary never keeps serving an update that
+# a new primary may not have. Only if the server was started with --allow-primary-only is the
+# update committed anyway, so that the group stays available; this is only reported if some
+# replicas are connected, as running alone is reported when starting
+def await_update(update):
+    seq, commit, channels, epoch = update
+    commit.wait()
+    committed = WRITE_QUORUM <= 1 or bool(channels) and replication.waitForQuorum(
+        channels, seq, WRITE_QUORUM - 1, time.monotonic() + REPLICATION_ACK_TIMEOUT)
+    if not committed and ALLOW_PRIMARY_ONLY:
+        if any(channel.live for channel in channels):
+            print(f"update {seq} was not acknowledged by a quorum of {WRITE_QUORUM} servers, committing it anyway")
+        committed = True
+    if not committed:
+        print(f"update {seq} was not acknowledged by a quorum of {WRITE_QUORUM} servers, rolling it back")
+        return rollback_updates(seq, epoch, channels)
+    with logLock:
+        if rolled_back(seq, epoch):
+            return False
+        commit_updates(seq)
+    return True
+
+# whether the update with the given sequence number, appended after the given number of rollbacks,
+# has been rolled back since (its sequence number may have been reused by then); the caller should
+# hold logLock
+def rolled_back(seq, epoch):
+    return any(fromSeq <= seq for fromSeq in rollbacks[epoch:])
+
+# forget the updates up to the one with the given sequence number, once it's committed: replicas
+# acknowledge updates in order, so every update before it is committed too; the caller should hold
+# logLock
+def commit_updates(seq):
+    while uncommittedUpdates and uncommittedUpdates[0][0] <= seq:
+        uncommittedUpdates.popleft()
+
+# the users whose state or mailboxes the uncommitted updates from the given sequence number on
+# changed; the caller should hold logLock
+def updated_users(seq):
+    usernames = set()
+    for updateSeq, op, _, data in uncommittedUpdates:
+        if updateSeq >= seq:
+            usernames |= {data.decode('ascii')} if op in { OP_REGISTER, OP_DELETE } else mailboxesOf(op, data)
+    return usernames
+
+# roll back an update that missed the write quorum (appended after the given number of rollbacks),
+# along with every update logged after it, none of which can be committed either; returns whether
+# the replicas turned out to acknowledge it in the meantime, in which case nothing is rolled back.
+# The updates are undone in the store and the spool, and cut off the log (or if the log was rotated
+# since, a snapshot of the rolled back state replaces it), and the replicas are disconnected, to be
+# reset to our state when they reconnect. Like the requests that made the updates, we take the
+# locks of the users they changed before the log lock
+def rollback_updates(seq, epoch, channels):
+    while True:
+        with logLock:
+            usernames = updated_users(seq)
+        with store.locked(usernames), snapshotLock, logLock:
+            if rolled_back(seq, epoch):
+                return False
+            undone = [update for update in uncommittedUpdates if update[0] >= seq]
+            # the update was committed by a later one being acknowledged
+            if not undone or undone[0][0] != seq:
+                return True
+            if channels and replication.waitForQuorum(channels, seq, WRITE_QUORUM - 1, 0):
+                commit_updates(seq)
+                return True
+            # more updates were logged in the meantime, changing users whose locks we don't hold
+            if not updated_users(seq) <= usernames:
+                continue
+            for _, op, _, data in reversed(undone):
+                if op == OP_REGISTER:
+                    store.unregister(data.decode('ascii'))
+                    usernameIndex.remove(data.decode('ascii'))
+                elif op == OP_DELETE:
+                    store.registerIfAbsent(data.decode('ascii'))
+                    usernameIndex.add(data.decode('ascii'))
+            open_message_spool().rollback(seq, usernames)
+            for _ in undone:
+                uncommittedUpdates.pop()
+            store.state["lastSeq"] = seq - 1
+            rollbacks.append(seq)
+            log = open_operation_log()
+            if not log.truncateFrom(seq):
+                storage.saveSnapshot(snapshot_path(), store.snapshot())
+                open_message_spool().sync()
+                log.truncate()
+            for channel in channels:
+                channel.rollBack(seq)
+            print(f"rolled back updates {seq} to {undone[-1][0]}")
+            return False
+
+# stop streaming updates to the replicas (on stepping down as the primary)
+def stop_replica_channels():
+    global replicaChannels
+    channels, replicaChannels = replicaChannels, None
+    for channel in channels or []:
+        channel.close()
+
+# whether we may serve requests only the primary serves
+def is_primary():
+    return lease is None or (actingPrimary and lease.isPrimary())
+
+# the ID of the primary as far as we know, or NO_SERVER if there's none right now (or we're still
+# taking over)
+def primary_id():
+    if lease is None:
+        return SERVER_ID
+    primary = lease.primary()
+    return NO_SERVER if primary == SERVER_ID and not actingPrimary else primary
+
+# called by the lease whenever the primary we know of changes: take over as the primary if the lease
+# is now ours, after catching up on any updates the other servers are ahead of us on (the last
+# primary may have committed them without us), or stop acting as the primary if it's no longer ours.
+# Either way, every connected client is told who the primary is. This runs on a thread of its own,
+# so that catching up doesn't hold up the lease, and acts on whoever the primary is by then
+def primary_changed(_):
+    changed = threading.Thread(target=change_role)
+    changed.daemon = True
+    changed.start()
+
+def change_role():
+    global actingPrimary
+    with roleLock:
+        primary = lease.primary()
+        if primary == SERVER_ID and not actingPrimary:
+            print("holding the lease, taking over as the primary")
+            for other, seq in sorted(lease.peerSeqs().items()):
+                if seq > store.state["lastSeq"]:
+                    sync_from_server(other)
+            start_replica_channels()
+            actingPrimary = True
+        elif primary != SERVER_ID and actingPrimary:
+            print("lost the lease, stepping down as the primary")
+            stop_replica_channels()
+            actingPrimary = False
+        else:
+            print(f"server {primary} is the primary" if primary != NO_SERVER else "no server is the primary")
+        announce_primary(primary_id())
+
+# push the ID of the primary (see PRIMARY_IS) to every connected client that speaks the framed
+# protocol, so they don't have to find out that theirs failed before connecting to the new one
+def announce_primary(primary):
+    for clientSocket in store.sessions.sockets():
+        outbox = get_outbox(clientSocket)
+        if outbox.version is not None and outbox.version >= PROTOCOL_FRAMED:
+            outbox.send(codec.encodeResponse(outbox.version, PRIMARY_IS, bytes([primary])))
+
+# queue a user logging in or out for the replicas (see OP_PRESENCE_UPDATE), if we're the primary
+def broadcast_presence(username, online):
+    channels = replicaChannels
+    if channels is None:
+        return
+    record = storage.encodeRecord(UNSEQUENCED, OP_PRESENCE_UPDATE, time.time(), bytes(("1" if online else "0") + username, 'ascii'))
+    with presenceLock:
+        for channel in channels:
+            channel.send(record)
+
+# queue every logged in user for a newly connected replica, after a reset of the ones it knew of
+def send_presence(channel):
+    with presenceLock:
+        now = time.time()
+        records = [storage.encodeRecord(UNSEQUENCED, OP_PRESENCE_RESET, now, b"")]
+        records += [storage.encodeRecord(UNSEQUENCED, OP_PRESENCE_UPDATE, now, bytes("1" + username, 'ascii'))
+                    for username in store.sessions.loggedIn()]
+        channel.send(b"".join(records))
+
+# run in the background: send the replicas a sync mark every SYNC_MARK_INTERVAL seconds while we're
+# the primary. Marks are queued under the log lock like updates, so a replica has applied every
+# update logged before a mark by the time the mark arrives
+def run_sync_marks():
+    while True:
+        time.sleep(SYNC_MARK_INTERVAL)
+        channels = replicaChannels
+        if channels is None:
+            continue
+        with logLock:
+            record = storage.encodeRecord(UNSEQUENCED, OP_SYNC_MARK, time.time(), replication.formatSeq(store.state["lastSeq"]))
+            for channel in channels:
+                channel.send(record)
+
+# how many seconds out of date the reads we serve may be: none if we're the primary, or else the
+# time since we were last known to be up to date with it
+def read_staleness():
+    if replicaChannels is not None:
+        return 0.0
+    if lastSynced is None:
+        return float("inf")
+    return time.monotonic() - lastSynced
+
+# apply an unsequenced record received from the primary (see UNSEQUENCED): a sync mark, or a user
+# logging in or out
+def apply_unsequenced_record(op, data):
+    global lastSynced
+    if op == OP_SYNC_MARK:
+        # we may have missed updates up to the mark, in which case we're no more up to date than before
+        if int.from_bytes(data, "big") <= store.state["lastSeq"]:
+            lastSynced = time.monotonic()
+    elif op == OP_PRESENCE_RESET:
+        replicaPresence.clear()
+    elif op == OP_PRESENCE_UPDATE:
+        username = data[1:].decode('ascii')
+        if data[:1] == b"1":
+            replicaPresence.add(username)
+        else:
+            replicaPresence.discard(username)
+
+# apply and log an update received from the primary, with the primary's sequence number; returns
+# the Commit for when the update is durable (or None if it was already applied, or is unsequenced).
+# An update that doesn't follow the last one applied isn't applied, as that would skip the ones in
+# between for good; replication.MissedUpdates is raised instead
+def apply_replicated_update(seq, op, timestamp, data):
+    if seq == UNSEQUENCED:
+        apply_unsequenced_record(op, data)
+        return None
+    state = store.state
+    with logLock:
+        if seq <= state["lastSeq"]:
+            return None
+        if seq != state["lastSeq"] + 1:
+            raise replication.MissedUpdates(f"missed updates {state['lastSeq'] + 1} to {seq - 1} from the primary")
+        apply_update(state, op, data)
+        open_message_spool().apply(seq, op, timestamp, data)
+        if op == OP_REGISTER:
+            usernameIndex.add(data.decode('ascii'))
+        elif op == OP_DELETE:
+            usernameIndex.remove(data.decode('ascii'))
+        state["lastSeq"], state["timestamp"] = seq, timestamp
+        print(f"state update {seq}: applied operation {op} ({data.decode('ascii')})")
+        return open_operation_log().append(seq, op, timestamp, data)
+
+# install a snapshot of the whole state received from another server (see replication.py), if
+# it's ahead of our own state, or it's the primary resetting us after rolling back updates we may
+# have applied (see catch_up_replica()); it's saved right away, and replaces our log. The snapshot
+# also carries the other server's mailboxes, which replace our message spool
+def install_snapshot(snapshot):
+    state = pickle.loads(snapshot)
+    state.setdefault("lastSeq", 0)
+    mailboxes = state.pop("messageBuffer", {})
+    spoolSeq = state.pop("spoolSeq", state["lastSeq"])
+    reset = state.pop("reset", False)
+    with snapshotLock, logLock:
+        if state["lastSeq"] <= store.state["lastSeq"] and not reset:
+            return
+        print(f"installing snapshot of server state up to update {state['lastSeq']}")
+        store.replace(state)
+        usernameIndex.rebuild(state["registeredUsers"])
+        open_message_spool().replaceAll(mailboxes, spoolSeq)
+        storage.saveSnapshot(snapshot_path(), store.snapshot())
+        open_operation_log().truncate()
+
+# send a server that has applied updates up to fromSeq every update after that, up to and
+# including toSeq (which should already have been logged). The updates are read back from our log;
+# if some of them have been compacted away, our latest snapshot is sent first. The log isn't
+# compacted in the meantime, so that the snapshot and the log we send line up. To reset a server
+# whose state may have diverged from ours, the snapshot (which it installs whatever its own state)
+# and every update after it are sent, however far along it is
+def send_catch_up(sock, fromSeq, toSeq, reset=False):
+    if fromSeq >= toSeq and not reset:
+        return
+    with snapshotLock:
+        with logLock:
+            log = open_operation_log()
+        log.sync()
+        records = (record for record in storage.readLog(log_path()) if (reset or fromSeq < record[0]) and record[0] <= toSeq)
+        first = next(records, None)
+        if reset or first is None or first[0] > fromSeq + 1:
+            # the snapshot on disk doesn't include undelivered messages, so send along every
+            # mailbox in the spool (which may be ahead of the snapshot)
+            state = storage.loadSnapshot(snapshot_path())
+            state["messageBuffer"], state["spoolSeq"] = open_message_spool().export()
+            state["reset"] = reset
+            print(f"sending snapshot of server state to {'reset' if reset else 'catch up'} from update {fromSeq}")
+            replication.sendSnapshot(sock, pickle.dumps(state))
+        if first is not None:
+            print(f"sending updates {first[0]} to {toSeq} from the log")
+            for seq, op, timestamp, data in [first, *records]:
+                sock.sendall(storage.encodeRecord(seq, op, timestamp, data))
+
+# called once a replica connects to us (as the primary): queue new updates for it from now on, and
+# catch it up on every update before that. A replica that may have applied updates we've since
+# rolled back (see rollback_updates()), or is ahead of us, is reset to our state instead, and only
+# counts as having acknowledged the updates it acknowledges from then on
+def catch_up_replica(channel, sock, replicaSeq):
+    with logLock:
+        toSeq = store.state["lastSeq"]
+        reset = channel.diverged or replicaSeq > toSeq
+        channel.diverged = False
+        channel.attach(sock, 0 if reset else replicaSeq)
+    send_presence(channel)
+    try:
+        send_catch_up(sock, replicaSeq, toSeq, reset)
+    except Exception:
+        if reset:
+            with channel.cond:
+                channel.diverged = True
+        raise
 
 # helper functions to load and save state from disk 
-# save the state as a pickle
-# we currently have a rather inefficient implementation where the server state is saved to disk
-# each time it is updated, so you'll see this being called a couple times below when handling
-# client connections
+# save a snapshot of the whole state as a pickle; every logged operation is then reflected in the
+# snapshot, so the log can be emptied. This is only done on startup, after the state has been
+# recovered and reconciled with the other servers
 def save_server_state():
-    global serverState
     print(f"saving server state for ID {SERVER_ID}")
-    serverState["timestamp"] = time.time()
-    with open(f'state/server_{SERVER_ID}.pickle', 'wb') as f:
-        pickle.dump(serverState, f)
+    with snapshotLock, logLock:
+        storage.saveSnapshot(snapshot_path(), store.snapshot())
+        open_message_spool().sync()
+        open_operation_log().truncate()
+
+# recover the state from disk: start from the last snapshot (if there is one) and replay the
+# operations logged after it (up to and including the given log segment, if any)
+def recover_server_state(lastSegment=None):
+    state = storage.loadSnapshot(snapshot_path()) or empty_server_state()
+    # snapshots written before operations were logged don't have a sequence number, and those
+    # written before the message spool have the undelivered messages (see load_server_state())
+    state.setdefault("lastSeq", 0)
+    state.pop("messageBuffer", None)
+    for seq, op, timestamp, data in storage.readLog(log_path(), lastSegment):
+        # the record was already included in the snapshot
+        if seq <= state["lastSeq"]:
+            continue
+        apply_update(state, op, data)
+        state["lastSeq"], state["timestamp"] = seq, timestamp
+    return state
 
-# attempt to load the state from a pickle (if it exists)
+# take a new snapshot and compact the log behind it. The log is rotated, so that the sealed segments
+# hold exactly the operations up to some point in time; the snapshot of the state at that point is
+# rebuilt from the previous snapshot and those segments, without touching the store, so clients
+# are never held up by it (only rotating the log takes the log lock, and that's constant time)
+def compact_server_state():
+    with logLock:
+        log = open_operation_log()
+        sealedSegment, commit = log.rotate()
+    commit.wait()
+    with snapshotLock:
+        state = recover_server_state(sealedSegment)
+        storage.saveSnapshot(snapshot_path(), state)
+        # the spool must be durable before the log it could be recovered from is gone
+        open_message_spool().sync()
+        log.removeSegments(sealedSegment)
+    print(f"saved snapshot of server state up to update {state['lastSeq']}")
+
+# run in the background: periodically snapshot the state once enough operations have been logged
+def run_snapshotter():
+    lastSnapshot = time.monotonic()
+    while True:
+        time.sleep(1)
+        numRecords = operationLog.numRecords if operationLog else 0
+        if numRecords >= SNAPSHOT_LOG_RECORDS or (numRecords and time.monotonic() - lastSnapshot >= SNAPSHOT_INTERVAL):
+            try:
+                compact_server_state()
+            except Exception as e:
+                print(f"failed to save snapshot of server state: {e}")
+            lastSnapshot = time.monotonic()
+
+# attempt to load the state from disk (if it exists)
 def load_server_state():
-    global serverState
     print(f"loading server state for ID {SERVER_ID}")
-    try:
-        with open(f"state/server_{SERVER_ID}.pickle", 'rb') as f:
-            serverState = pickle.load(f)
-    except:
+    os.makedirs(STATE_DIRECTORY, exist_ok=True)
+    store.replace(recover_server_state())
+    usernameIndex.rebuild(store.state["registeredUsers"])
+    spool = open_message_spool()
+    # move the undelivered messages of a snapshot written before the message spool into the spool
+    snapshot = storage.loadSnapshot(snapshot_path())
+    if snapshot is not None and "messageBuffer" in snapshot:
+        spool.replaceAll(dict(snapshot["messageBuffer"]), snapshot.get("lastSeq", 0))
+    # bring the spool up to date with the operations logged since it was last synced
+    spool.replay(storage.readLog(log_path()))
+    spool.lastSeq = max(spool.lastSeq, store.state["lastSeq"])
+    if store.state["lastSeq"] == 0:
         print("> no previous server state found")
 
+# close the operation log and message spool, e.g. when shutting down; they're reopened if
+# anything is logged again
+def close_server_state():
+    global operationLog, messageSpool
+    with logLock:
+        if operationLog is not None:
+            operationLog.close()
+            operationLog = None
+        messageSpool = None
+
+# get the outbox of a client socket, creating it if there isn't one yet
+def get_outbox(clientSocket):
+    with outboxesLock:
+        if clientSocket not in outboxes:
+            outboxes[clientSocket] = Outbox(clientSocket, writers, writePoller, OUTBOX_HIGH_WATERMARK,
+                                            OUTBOX_LOW_WATERMARK, onFailure=buffer_undelivered)
+        return outboxes[clientSocket]
+
+# stop writing to a client socket whose connection has ended; messages that were still queued for
+# it are buffered in the recipient's mailbox (on a writer thread, since that waits on the log)
+def close_outbox(clientSocket):
+    with outboxesLock:
+        outbox = outboxes.pop(clientSocket, None)
+    if outbox is not None:
+        undelivered = outbox.close()
+        if undelivered:
+            writers.submit(buffer_undelivered, undelivered)
+
+# buffer messages that were queued for delivery to a client but couldn't be written, given the
+# data of the send requests
+def buffer_undelivered(payloads):
+    buffered = sum(1 for payload in payloads if record_update(OP_SEND, payload))
+    print(f"buffered {buffered} of {len(payloads)} undelivered message(s)")
+
+# count a firing of the given slow consumer policy, returning the number of times it has fired
+def count_slow_consumer(policy):
+    with slowConsumerLock:
+        slowConsumerCounters[policy] += 1
+        return slowConsumerCounters[policy]
+
+# apply the slow consumer policy to a logged in user who isn't keeping up with the messages sent to
+# them, once a message to them has been buffered: either deliver it (and anything else buffered for
+# them) once they've caught up, or disconnect them
+def handle_slow_consumer(recipientSocket, recipient):
+    if SLOW_CONSUMER_POLICY == SLOW_CONSUMER_DISCONNECT:
+        disconnect_slow_consumer(recipientSocket, recipient)
+        count = count_slow_consumer(SLOW_CONSUMER_DISCONNECT)
+        print(f"disconnected {recipient} for falling behind ({count} disconnected so far)")
+    else:
+        get_outbox(recipientSocket).whenUncongested(lambda: deliver_overflow(recipientSocket, recipient))
+        count = count_slow_consumer(SLOW_CONSUMER_BUFFER)
+        print(f"buffering messages for {recipient} until they catch up ({count} buffered so far)")
+
+# log out a user who isn't keeping up with the messages sent to them and shut their connection
+# down; messages that were still queued for them are buffered in their mailbox, to be delivered
+# when they next log in
+def disconnect_slow_consumer(clientSocket, username):
+    store.logout(username, clientSocket)
+    with outboxesLock:
+        outbox = outboxes.pop(clientSocket, None)
+    if outbox is not None:
+        undelivered = outbox.abort()
+        if undelivered:
+            writers.submit(buffer_undelivered, undelivered)
+
+# queue an incoming message (formatted as <sender>|<message>) for delivery to a logged in user,
+# given the data of the send request, returning whether their outbox took it (see Outbox.offer())
+def offer_message(recipientSocket, message, payload):
+    outbox = get_outbox(recipientSocket)
+    return outbox.offer(codec.encodeResponse(outbox.version, RECEIVE_OK, bytes(message, 'ascii')), payload)
+
+# deliver messages that were buffered for a logged in user because their outbox was congested,
+# once it has drained below its low watermark (unless a chunk of unread messages is already being
+# delivered, in which case they're picked up by the following chunks)
+def deliver_overflow(clientSocket, username):
+    if store.sessionOf(username) is not clientSocket:
+        return
+    try:
+        send_unread_chunk(clientSocket, username, first=False)
+    except Exception as e:
+        print(f"error delivering buffered messages to {username}: {e}")
+
+# helper function to disconnect a client socket, whether the client closed the connection or it
+# failed: log the corresponding user out if they haven't already (the client code will try to
+# logout before ending the connection, but can't if it crashes or loses its network), and forget
+# the connection's session
+def disconnect(clientSocket):
+    usernames = store.closeSession(clientSocket)
+    close_outbox(clientSocket)
+    clientSocket.close()
+    if usernames:
+        print(f"logged out {', '.join(usernames)}, whose connection ended")
+
+# hand a client connection off to the shard that owns the user logging in on it (see HandOff),
+# along with the bytes read from it that haven't been handled yet, once everything queued to it has
+# been written; this shard then forgets the connection
+def hand_off(clientSocket, handOff, inbox):
+    outbox = get_outbox(clientSocket)
+    outbox.waitUntilEmpty(CLIENT_SEND_TIMEOUT)
+    version = outbox.version
+    close_outbox(clientSocket)
+    store.closeSession(clientSocket)
+    try:
+        shardLinks[handOff.shard].handOff(clientSocket, version, handOff.op, handOff.payload, inbox)
+        print(f"handed connection off to shard {handOff.shard}")
+    except OSError as e:
+        print(f"failed to hand connection off to shard {handOff.shard} ({e}), closing socket")
+    clientSocket.close()
+
+# the functions other shards call on this one through their links (see shards.py)
+def shard_link_functions():
+    return {
+        "register": register_user,
+        "send": deliver_message,
+        "sendBatch": deliver_batch,
+        "search": lambda query, after, limit: usernameIndex.search(query, after=after, limit=limit),
+        "presence": user_presence,
+        "lease": lambda: lease.share() if isinstance(lease, Lease) else None,
+    }
+
+# set up a newly accepted client connection and register its session; both server modes do this
+def accept_client(clientSocket):
+    # writes to the client never wait for it (see outbox.py), so the socket needs no timeout
+    clientSocket.settimeout(None)
+    # have the OS probe connections that go quiet, so that ones whose other end vanished fail
+    clientSocket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        clientSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPALIVE_IDLE)
+        clientSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPALIVE_INTERVAL)
+        clientSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, TCP_KEEPALIVE_COUNT)
+    store.sessions.open(clientSocket)
+
+# close connections that have been idle for too long (which disconnects them as usual, on the
+# thread or event loop reading from them), and free the sessions of connections that were closed
+# without being disconnected
+def reap_sessions():
+    idle, dead = store.sessions.expired(CLIENT_IDLE_TIMEOUT)
+    for clientSocket in dead:
+        store.closeSession(clientSocket)
+        close_outbox(clientSocket)
+    for clientSocket in set(idle) - set(dead):
+        print(f"closing connection idle for over {CLIENT_IDLE_TIMEOUT}s (users: {store.sessions.usersOf(clientSocket)})")
+        try:
+            clientSocket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    if dead:
+        print(f"reaped {len(dead)} dead session(s), {len(store.sessions)} left")
+
+# run in the background: reap sessions every REAPER_INTERVAL seconds
+def run_reaper():
+    while True:
+        time.sleep(REAPER_INTERVAL)
+        reap_sessions()
+
 # each individual thread runs this function to communicate with its respective client
 def service_connection(clientSocket):
     """ For each thread servicing a client connection. Over the lifetime of the connection, 
     it loops and reads from the client socket. It first reads a 1-byte operation code 
     determining the operation desired by the client (as laid out in the spec), 
-    followed by operation-specific data, if applicable. It processes the request and 
-    returns an operation-specific status code, along with any data to send to the client, 
-    if applicable. """
+    followed by operation-specific data, if applicable, and hands both to 
+    handle_request() to process. Clients speaking the framed protocol send both in 
+    a frame instead (see codec.py). """
     
-    # helper function to disconnect a client socket and return from the thread
-    def disconnect():
-        print("not connected to client, closing socket")
-        clientSocket.close()
-        # try to log the corresponding user out if they haven't already; this usually should
-        # not happen, as the client code will try to logout before ending the connection
-        userToLogout = None 
-        for user, sock in userToSocket:
-            if sock is clientSocket:
-                userToLogout = user 
-                break
-        if userToLogout:
-            del userToSocket[userToLogout]
-        return 
-    
-    # loop until socket closed or program interrupted; the overall message from the client
-    # is an operation code followed by operation-specific data, and the overall response is 
-    # a status code followed by status-specific data (the message details for a receive operation,
-    # or a header that indicates length followed by a body for search and login operations)
+    # loop until socket closed or program interrupted
     while True:
         # read 1 byte for the operation code
         try:
             op = clientSocket.recv(1)
         # there's an error communicating with the client: close the socket
         except: 
-            disconnect()
+            print("not connected to client, closing socket")
+            disconnect(clientSocket)
             return 
         # if the client disconnects, it sends back a None or 0 over the socket;
         # in this case the socket should also be closed
         if not op:
             print("client disconnected, closing socket")
-            clientSocket.close()
+            disconnect(clientSocket)
             return
+        # read the rest of the frame, starting with the byte we just read
+        if is_framed(clientSocket):
+            try:
+                op, payload = codec.recvFrame(clientSocket, MAX_REQUEST_LENGTH, prefix=op)
+            except:
+                disconnect(clientSocket)
+                return
+            if not handle_request(clientSocket, op, payload):
+                disconnect(clientSocket)
+                return
+            continue
         op = int.from_bytes(op, "big")
-        # values to return over the socket
-        # the server status of the operation
-        status = UNKNOWN_ERROR
-        # a reponse header used in some operations, e.g. for the length in bytes of the body
-        responseHeader = None
-        # the response body, whose form and length depends on the operation and status code
-        responseBody = None
-        print(f"> client issued operation code {op}")
-
-        # *** REGISTER ***
-        # server receives the username and returns a status code
-        if op == OP_REGISTER:
-            print(">> registration requested")
-            # read the username
+        # read the operation-specific data, if the operation has any
+        payload = b""
+        if OP_PAYLOAD_LENGTHS.get(op):
             try:
-                username = clientSocket.recv(USERNAME_LENGTH).decode('ascii')
-            except: 
-                disconnect()
+                payload = recv_legacy_payload(clientSocket, OP_PAYLOAD_LENGTHS[op])
+            except:
+                disconnect(clientSocket)
                 return
-            # check that the username is new
-            if username in serverState["registeredUsers"]:
-                print(f"{username} is already registered")
-                status = REGISTER_USERNAME_EXISTS
-            # register the username by adding it to registeredUsers; the user
-            # is not automatically logged in
+        if not handle_request(clientSocket, op, payload):
+            disconnect(clientSocket)
+            return
+
+# read the data of a legacy request, which is at most the given number of bytes long: the data is
+# complete once that many bytes have arrived, or no more has for LEGACY_PAYLOAD_WAIT seconds, so
+# data split across several segments isn't cut short
+def recv_legacy_payload(clientSocket, length):
+    payload = clientSocket.recv(length)
+    while payload and len(payload) < length and select.select([clientSocket], [], [], LEGACY_PAYLOAD_WAIT)[0]:
+        data = clientSocket.recv(length - len(payload))
+        if not data:
+            break
+        payload += data
+    return payload
+
+# deliver the next chunk of a logged in user's unread messages, if there are any, returning whether
+# there were (or a chunk is already being delivered); the messages stay in the user's mailbox
+# until the client acknowledges the chunk (with OP_ACK_MESSAGES), so if the client disconnects
+# before then, they're delivered again on the next login. The first chunk is the response to the
+# login itself
+def send_unread_chunk(clientSocket, username, first, requestId=NO_REQUEST_ID):
+    # the user's lock is held from reading the chunk until it's queued, so that a message buffered
+    # for the user in the meantime is either in this chunk or a later one
+    with store.lockFor(username):
+        # only one chunk is delivered at a time; the rest follow it once it's acknowledged
+        if store.pendingDelivery(username) is not None:
+            return True
+        # read one more message than fits in a chunk, to find out if there's another chunk
+        messages = open_message_spool().load(username, limit=UNREAD_CHUNK_SIZE + 1)
+        if not messages:
+            return False
+        more = len(messages) > UNREAD_CHUNK_SIZE
+        messages = messages[:UNREAD_CHUNK_SIZE]
+        if first:
+            status = LOGIN_OK_UNREAD_MSG_MORE if more else LOGIN_OK_UNREAD_MSG
+        else:
+            status = RECEIVE_UNREAD_MORE if more else RECEIVE_UNREAD
+        store.beginDelivery(username, len(messages))
+        outbox = get_outbox(clientSocket)
+        outbox.send(codec.encodeMessageChunk(outbox.version, status, messages, requestId))
+    return True
+
+# whether a client speaks the framed protocol, i.e. whether its requests are read as frames
+def is_framed(clientSocket):
+    version = get_outbox(clientSocket).version
+    return version is not None and version >= PROTOCOL_FRAMED
+
+# the shard that owns a user (see shards.py)
+def shard_of(username):
+    return shardOf(username, NUM_SHARDS)
+
+# the partition that owns a user (see partitions.py)
+def partition_of(username):
+    return partitionMap.partitionOf(username) if partitionMap is not None else PARTITION
+
+# the link to the primary of another partition, opened on first use
+def partition_link(partition):
+    if partition not in partitionLinks:
+        partitionLinks[partition] = PartitionLink(partition, partitionMap.addressesOf(partition))
+    return partitionLinks[partition]
+
+# raised while handling a request that has to be executed by another shard, along with the
+# connection it came in on: the connection is handed off to that shard, which executes the
+# request (given as received, still tagged) once it has taken the connection over
+class HandOff(Exception):
+    def __init__(self, shard, op, payload):
+        super().__init__(f"handing connection off to shard {shard}")
+        self.shard = shard
+        self.op = op
+        self.payload = payload
+
+# register a username if it's new, on the shard that owns it, returning the status for the client;
+# the user is not automatically logged in. Raises an OSError if the owning shard can't be reached
+def register_user(username):
+    if shard_of(username) != SHARD:
+        return shardLinks[shard_of(username)].call("register", username)
+    # the registration is logged under the user's lock, so it's logged before any later change to
+    # the same user
+    with store.lockFor(username):
+        registered = store.registerIfAbsent(username)
+        if registered:
+            usernameIndex.add(username)
+            update = append_update(OP_REGISTER, bytes(username, 'ascii'))
+    if not registered:
+        print(f"{username} is already registered")
+        return REGISTER_USERNAME_EXISTS
+    if not await_update(update):
+        return UPDATE_NOT_REPLICATED
+    print(f"{username} successfully registered")
+    return REGISTER_OK
+
+# send a message to its recipient if they're logged in, or buffer it in their mailbox otherwise,
+# on the partition and shard that own the recipient, given the data of the send request; returns
+# the status for the sender. Raises an OSError if the owning shard can't be reached
+def deliver_message(sender, recipient, message, payload):
+    if partition_of(recipient) != PARTITION:
+        return partition_link(partition_of(recipient)).send(payload)
+    if shard_of(recipient) != SHARD:
+        return shardLinks[shard_of(recipient)].call("send", sender, recipient, message, payload)
+    # the recipient's lock is held from checking whether they're logged in until the message
+    # is queued for them or in their mailbox, so that it can't be missed by a login meanwhile
+    update = None
+    with store.lockFor(recipient):
+        recipientSocket = store.sessionOf(recipient)
+        # check if the recipient exists
+        if not store.isRegistered(recipient):
+            print(f"recipient {recipient} not found")
+            return SEND_RECIPIENT_DNE
+        # check if the recipient is logged in, and if so queue the message for delivery
+        # note that the recipient receives data encoded as the RECEIVE_OK status
+        # code followed by a string <sender>|<message>
+        if recipientSocket is not None and offer_message(recipientSocket, f"{sender}|{message}", payload):
+            print(f"sent message from {sender} to {recipient}")
+            return SEND_OK_DELIVERED
+        # otherwise, store the message in the reciever's mailbox in the spool as
+        # <sender>|<message>, and communicate the message's storage
+        update = append_update(OP_SEND, payload)
+    replicated = await_update(update)
+    # the recipient is logged in, but isn't keeping up with the messages sent to them: the
+    # message is buffered rather than waiting for them, and depending on the slow consumer
+    # policy, either delivered once they've caught up or they're disconnected
+    if recipientSocket is not None:
+        handle_slow_consumer(recipientSocket, recipient)
+        print(f"buffered message from {sender} to {recipient}, who is falling behind")
+    else:
+        print(f"buffered message from {sender} to {recipient}")
+    return SEND_OK_BUFFERED if replicated else UPDATE_NOT_REPLICATED
+
+# send a batch of (recipient, message) deliveries from a sender whose recipients this shard owns,
+# like with single sends, returning a status for each delivery in order; every message that isn't
+# delivered directly is buffered as one logged (and replicated) update for the whole batch
+def deliver_batch(sender, deliveries):
+    statuses, buffered, slowConsumers, update = [], [], {}, None
+    # every recipient's lock is held until their messages are queued or logged (see above)
+    with store.locked({recipient for recipient, _ in deliveries}):
+        for recipient, message in deliveries:
+            if not store.isRegistered(recipient):
+                statuses.append(SEND_RECIPIENT_DNE)
+                continue
+            recipientSocket = store.sessionOf(recipient)
+            if recipientSocket is not None:
+                if offer_message(recipientSocket, f"{sender}|{message}", bytes(formatMessage(sender, recipient, message), 'ascii')):
+                    statuses.append(SEND_OK_DELIVERED)
+                    continue
+                slowConsumers[recipient] = recipientSocket
+            buffered.append((recipient, message))
+            statuses.append(SEND_OK_BUFFERED)
+        if buffered:
+            update = append_update(OP_SEND_BATCH, bytes(formatSendBatch(sender, [([recipient], message) for recipient, message in buffered]), 'ascii'))
+    # the buffered messages are logged, so they're in the recipients' mailboxes before any
+    # slow consumers are caught up
+    if update is not None and not await_update(update):
+        statuses = [UPDATE_NOT_REPLICATED if status == SEND_OK_BUFFERED else status for status in statuses]
+    for recipient, recipientSocket in slowConsumers.items():
+        handle_slow_consumer(recipientSocket, recipient)
+    print(f"batch of {len(deliveries)} message(s) from {sender}, {len(buffered)} buffered")
+    return statuses
+
+# send a batch of deliveries (see deliver_batch()) to recipients owned by any partition and shard:
+# each partition and shard is sent its part of the batch, and the statuses are put back in order.
+# Deliveries to a partition or shard that can't be reached fail with SEND_FAILED
+def route_batch(sender, deliveries):
+    statuses = [SEND_FAILED] * len(deliveries)
+    parts = {}
+    for i, (recipient, _) in enumerate(deliveries):
+        parts.setdefault((partition_of(recipient), shard_of(recipient)), []).append(i)
+    for (partition, shard), indices in parts.items():
+        part = [deliveries[i] for i in indices]
+        try:
+            if partition != PARTITION:
+                partStatuses = partition_link(partition).sendBatch(sender, part)
+            elif shard == SHARD:
+                partStatuses = deliver_batch(sender, part)
             else:
-                serverState["registeredUsers"].add(username)
-                save_server_state()
-                print(f"{username} successfully registered")
-                status = REGISTER_OK
-        
-        # *** LOGIN ***
-        # server receives a username and returns a status code; if the user is
-        # valid and has unread messages, the server also returns the unread messages
-        elif op == OP_LOGIN:
-            print(">> login requested")
-            # read the username
+                partStatuses = shardLinks[shard].call("sendBatch", sender, part)
+        except OSError as e:
+            print(f"failed to send part of a batch through partition {partition}, shard {shard} ({e})")
+            continue
+        for i, status in zip(indices, partStatuses):
+            statuses[i] = status
+    return statuses
+
+# search for the usernames matching a query (see UsernameIndex.search()) on every shard, and
+# unless only this partition is to be searched, on every partition; each only indexes the users
+# it owns, and its results are sorted, so they're merged in order. Shards and partitions that
+# can't be reached are left out of the results
+def search_users(query, after="", limit=None, everywhere=True):
+    results = [usernameIndex.search(query, after=after, limit=limit)]
+    for shard, link in shardLinks.items():
+        try:
+            results.append(link.call("search", query, after, limit))
+        except OSError as e:
+            print(f"failed to search shard {shard} ({e})")
+    for partition in (partitionMap.hosts if partitionMap is not None and everywhere else []):
+        if partition == PARTITION:
+            continue
+        try:
+            results.append(partition_link(partition).search(query, after, limit))
+        except OSError as e:
+            print(f"failed to search partition {partition} ({e})")
+    matched = list(heapq.merge(*results))
+    return matched if limit is None else matched[:limit]
+
+# look up whether a user is logged in, returning PRESENCE_ONLINE, PRESENCE_OFFLINE, or
+# PRESENCE_NOT_REGISTERED: the primary knows from its sessions, and a secondary from what the
+# primary told it (see OP_PRESENCE_UPDATE). Users of other shards and partitions are looked up
+# there; raises an OSError if they can't be reached
+def user_presence(username):
+    if partition_of(username) != PARTITION:
+        status, _ = partition_link(partition_of(username)).request(OP_PRESENCE, bytes(username, 'ascii'))
+        return status
+    if shard_of(username) != SHARD:
+        return shardLinks[shard_of(username)].call("presence", username)
+    if not store.isRegistered(username):
+        return PRESENCE_NOT_REGISTERED
+    if store.sessionOf(username) is not None or username in replicaPresence:
+        return PRESENCE_ONLINE
+    return PRESENCE_OFFLINE
+
+# processes a single client request; shared by both server modes
+def handle_request(clientSocket, op, payload):
+    """ Processes one client request, given the 1-byte operation code and the 
+    operation-specific data read from the client socket. It returns an operation-specific 
+    status code, along with any data to send to the client, if applicable, over the 
+    socket. Returns False if the client connection should be closed, and True otherwise. """
+    
+    # the overall message from the client is an operation code followed by operation-specific 
+    # data, and the overall response is a status code followed by status-specific data (the 
+    # message details for a receive operation, or a header that indicates length followed by a
+    # body for search and login operations)
+    # values to return over the socket
+    # the server status of the operation
+    status = UNKNOWN_ERROR
+    # a reponse header used in some operations, e.g. for the length in bytes of the body
+    responseHeader = None
+    # the response body, whose form and length depends on the operation and status code
+    responseBody = None
+    print(f"> client issued operation code {op}")
+    # responses are encoded with the protocol version the client speaks, which is settled by the
+    # first request on the connection: clients that don't open with OP_HELLO speak the legacy one
+    outbox = get_outbox(clientSocket)
+    store.sessions.touch(clientSocket)
+    if outbox.version is None and op != OP_HELLO:
+        outbox.version = PROTOCOL_LEGACY
+    # with request IDs, every response to the request carries its ID, so that clients can have
+    # many requests outstanding and still match up the responses
+    # the request as received, in case it's handed off to another shard
+    rawPayload = payload
+    try:
+        requestId, payload = codec.decodeTagged(outbox.version, payload)
+    except codec.ProtocolError:
+        return False
+    # clients connect to the primary for everything but read-only sessions (see OP_READ_ONLY), and
+    # only the primary serves those requests: without a lease, any such request makes this server
+    # the primary, if it wasn't already. Read-only sessions are only served reads, and only while
+    # we're up to date enough
+    readOnly = store.sessions.isReadOnly(clientSocket)
+    primaryOnly = not readOnly and op not in { OP_HELLO, OP_PARTITION_MAP, OP_PING, OP_READ_ONLY, OP_PRIMARY }
+    if primaryOnly and lease is None:
+        start_replica_channels()
+
+    # *** READ-ONLY SESSIONS ***
+    if readOnly and op not in READ_ONLY_OPS:
+        print(f">> operation {op} refused on a read-only session")
+        status = READ_ONLY_SESSION
+    elif readOnly and op not in { OP_HELLO, OP_PARTITION_MAP, OP_PING, OP_READ_ONLY } and read_staleness() > MAX_READ_STALENESS:
+        print(f">> read refused, last up to date {read_staleness():.1f}s ago")
+        status = READ_STALE
+
+    # *** NOT PRIMARY ***
+    # the client is told which server is the primary, as far as we know (see OP_PRIMARY)
+    elif primaryOnly and not is_primary():
+        print(f">> operation {op} refused, server {primary_id()} is the primary")
+        outbox.send(codec.encodeResponse(outbox.version, NOT_PRIMARY, bytes([primary_id()]), requestId))
+        return True
+
+    # *** REGISTER ***
+    # server receives the username and returns a status code
+    elif op == OP_REGISTER:
+        print(">> registration requested")
+        # read the username
+        try:
+            username = payload.decode('ascii')
+        except: 
+            return False
+        # users register with the primary of their partition (which clients find in the
+        # partition map), and then the username is registered if it's new
+        if partition_of(username) != PARTITION:
+            print(f"{username} belongs to partition {partition_of(username)}")
+            status = WRONG_PARTITION
+        else:
             try:
-                username = clientSocket.recv(USERNAME_LENGTH).decode('ascii')
-            except: 
-                disconnect()
-                return
-            if username in serverState["registeredUsers"]:
-                # the user should not be logged in, i.e. not in userToSocket
-                if username in userToSocket:
-                    print(f"{username} is already logged in")
-                    status = LOGIN_ALREADY_LOGGED_IN
-                else:
-                    # register the socket under the current user's username
-                    userToSocket[username] = clientSocket
-                    # on login we deliver all undelivered messages in the form of a 2-byte header
-                    # indicating the number of messages to send, then the messages themselves
-                    numUndelivered = len(serverState["messageBuffer"][username])
-                    if numUndelivered > 0:
-                        # send the number of unread messages, as well as the formatted messages,
-                        # separated by newlines
-                        responseHeader = numUndelivered
-                        responseBody = "\n".join(serverState["messageBuffer"][username])
-                        # clear the buffer for the logged in user
-                        serverState["messageBuffer"][username] = []
-                        save_server_state()
-                        status = LOGIN_OK_UNREAD_MSG
-                        print(f"{username} successfully logged in, {numUndelivered} unread message(s)")
-                    else:
-                        print(f"{username} successfully logged in, no unread messages")
-                        status = LOGIN_OK_NO_UNREAD_MSG
+                status = register_user(username)
+            except OSError as e:
+                print(f"failed to register {username} ({e})")
+                status = UNKNOWN_ERROR
+    
+    # *** LOGIN ***
+    # server receives a username and returns a status code; if the user is
+    # valid and has unread messages, the server also returns the unread messages
+    elif op == OP_LOGIN:
+        print(">> login requested")
+        # read the username
+        try:
+            username = payload.decode('ascii')
+        except: 
+            return False
+        # a user is only logged in on the shard that owns them, so that messages to them can be
+        # delivered on their connection: the connection is handed off to it, unless other users
+        # are already logged in on it. Likewise, users log in with the primary of their partition
+        # (see partitions.py)
+        if partition_of(username) == PARTITION and shard_of(username) != SHARD and not store.sessions.usersOf(clientSocket):
+            raise HandOff(shard_of(username), op, rawPayload)
+        # the user is logged in and their first chunk of unread messages read under their lock,
+        # so a message sent to them at the same time is either in the chunk or delivered directly
+        with store.lockFor(username):
+            if partition_of(username) != PARTITION:
+                print(f"{username} belongs to partition {partition_of(username)}")
+                status = WRONG_PARTITION
+            elif shard_of(username) != SHARD:
+                print(f"{username} belongs to shard {shard_of(username)}, but others are logged in on this connection")
+                status = UNKNOWN_ERROR
             # the provided username is invalid
-            else:
+            elif not store.isRegistered(username):
                 print(f"{username} is not registered")
                 status = LOGIN_NOT_REGISTERED
-                
-        # *** SEARCH ***
-        # server recieves a query and returns a status code, with results if any
-        elif op == OP_SEARCH:
-            print(">> search requested")
-            # read the query and search for it (query length cannot exceed username length)
-            try:
-                query = clientSocket.recv(USERNAME_LENGTH).decode('ascii')
-            except: 
-                disconnect()
-                return
-            matched = searchUsernames(list(serverState["registeredUsers"]), query)
-            if matched:
-                # send back data in the form of a 2-byte header describing the number of 
-                # results, then the results themselves separated by |
-                responseHeader = len(matched)
-                responseBody = "|".join(matched)
-                print(f"search executed, {responseHeader} result(s)")
-                status = SEARCH_OK
-            # query doesn't match anything
+            # register the socket under the current user's username, unless they're already
+            # logged in
+            elif not store.login(username, clientSocket):
+                print(f"{username} is already logged in")
+                status = LOGIN_ALREADY_LOGGED_IN
             else:
-                print(f"search executed, no results")
-                status = SEARCH_NO_RESULTS
-                
-        # *** SEND ***
-        # server receives a sender, receiver, and message, and does two things:
-        # the server sends the sender username and message to the intended reciever if 
-        # they are logged in using the corresponding socket (message is buffered 
-        # otherwise); the server also returns a status code to the sender, except for 
-        # the case where the sender and receiver are the same
-        elif op == OP_SEND:
-            print(">> send requested")
-            # data is formatted as <sender username>|<receiver username>|<message>
-            try:
-                messageRaw = clientSocket.recv(
-                    MESSAGE_LENGTH + 
-                    2 * USERNAME_LENGTH + 
-                    2 * DELIMITER_LENGTH )
-                messageRawDecoded = messageRaw.decode('ascii').split("|")
-            except: 
-                disconnect()
-                return
-            sender, recipient, message = messageRawDecoded[0], messageRawDecoded[1], messageRawDecoded[2]
-            # check if the recipient exists
-            if recipient not in serverState["registeredUsers"]:
-                print(f"recipient {recipient} not found")
-                status = SEND_RECIPIENT_DNE
-            # check if the recipient is logged in, and if so deliver instantaneously
-            # note that the recipient receives data encoded as the RECEIVE_OK status
-            # code followed by a string <sender>|<message>; we handle returning a status
-            # code to the sender client at the end of this function
-            elif recipient in userToSocket:
+                # on login we deliver all undelivered messages, in chunks; only this user's
+                # mailbox is read from the spool, and only a chunk at a time
                 try:
-                    userToSocket[recipient].sendall(
-                        RECEIVE_OK.to_bytes(1, "big") +
-                        bytes(f"{sender}|{message}", 'ascii')
-                    )
-                    print(f"sent message from {sender} to {recipient}")
-                    # if the sender is the same as the recipient, don't send any confirmation;
-                    # the user who messaged themselves need not see more than their own message
-                    if sender == recipient:
-                        continue 
-                    status = SEND_OK_DELIVERED
+                    delivering = send_unread_chunk(clientSocket, username, first=True, requestId=requestId)
                 except:
-                    # somehow the recipient connection was not open; try to close it
-                    print(f"error sending to {recipient} socket")
-                    userToSocket[recipient].close()
-                    status = SEND_FAILED
-            # otherwise, store the message in the buffer's reciever slot as
-            # <sender>|<message>, and communicate the message's storage
-            else:
-                serverState["messageBuffer"][recipient].append(f"{sender}|{message}")
-                save_server_state()
-                print(f"buffered message from {sender} to {recipient}")
-                status = SEND_OK_BUFFERED
-                
-        # *** LOGOUT ***
-        # server receives a username and returns a status code
-        elif op == OP_LOGOUT:
-            print(">> logout requested")
-            # read the username
-            username = clientSocket.recv(USERNAME_LENGTH).decode('ascii')
-            # this should never happen (the client should check that the username is that
-            # of the user using the client, and since the client is connected, the user
-            # should be logged in)
-            if username not in userToSocket:
-                status = UNKNOWN_ERROR
-            # the username is no longer active, so its corresponding socket can be removed;
-            # this is all that is needed to mark a user as logged out for the server
-            else:
-                del userToSocket[username]
-                print(f"{username} logged out")
-                status = LOGOUT_OK
+                    return False
+                if delivering:
+                    print(f"{username} successfully logged in, delivering unread messages")
+                    return True
+                else:
+                    print(f"{username} successfully logged in, no unread messages")
+                    status = LOGIN_OK_NO_UNREAD_MSG
             
-        # *** DELETE ***
-        # server receives a username and returns a status code; buffered messages from
-        # the user are kept in the buffer
-        elif op == OP_DELETE:
-            print(">> delete requested")
-            # read the username
-            username = clientSocket.recv(USERNAME_LENGTH).decode('ascii')
-            # this should never happen (the client should check the username corresponds
-            # to that of the currently logged-in user)
-            if username not in userToSocket:
-                status = UNKNOWN_ERROR
-            else:
-                # first "logout" the user
-                del userToSocket[username]
+    # *** ACKNOWLEDGE UNREAD MESSAGES ***
+    # server receives the username of the logged in user, once they've received the last chunk of
+    # unread messages delivered to them; those messages are removed from their mailbox, and the
+    # next chunk (if any) is sent as the response, or else a status code
+    elif op == OP_ACK_MESSAGES:
+        print(">> acknowledgement of unread messages")
+        try:
+            username = payload.decode('ascii')
+        except:
+            return False
+        # the user should be logged in on this connection, and have been delivered a chunk
+        update = None
+        with store.lockFor(username):
+            numDelivered = store.pendingDelivery(username)
+            if store.sessionOf(username) is clientSocket and numDelivered is not None:
+                update = append_update(OP_ACK_MESSAGES, bytes(f"{username}|{numDelivered}", 'ascii'))
+        if update is None:
+            status = UNKNOWN_ERROR
+        else:
+            # the chunk stays pending until its messages are removed from the mailbox and that's
+            # durable, so that no other chunk is delivered in the meantime
+            replicated = await_update(update)
+            print(f"{username} received {numDelivered} unread message(s)")
+            with store.lockFor(username):
+                store.endDelivery(username)
+                # if the acknowledgement wasn't committed, the delivery stops here; the rest of
+                # the messages are delivered on the user's next login
+                try:
+                    if replicated and send_unread_chunk(clientSocket, username, first=False, requestId=requestId):
+                        return True
+                except:
+                    return False
+            status = ACK_OK if replicated else UPDATE_NOT_REPLICATED
+    
+    # *** SEARCH ***
+    # server recieves a query and returns a status code, with results if any; results are
+    # streamed back to the client in pages, so that neither side has to hold all of a large
+    # result set in one message
+    elif op == OP_SEARCH:
+        print(">> search requested")
+        # read the query and search for it (query length cannot exceed username length)
+        try:
+            query = payload.decode('ascii')
+        except: 
+            return False
+        # send back pages of results, each with a header describing the number of results (and,
+        # in the legacy protocol, one describing the length of the page), then the results
+        # themselves separated by |; every page but the last has the SEARCH_OK_MORE status. Each
+        # page is searched for on its own, after the last result of the previous one, asking for
+        # one more result than fits to find out if there's another page (the last page may end up
+        # empty, if users were deleted in the meantime)
+        page = search_users(query, limit=SEARCH_PAGE_SIZE + 1)
+        if page:
+            numMatched = 0
+            while True:
+                pageStatus = SEARCH_OK_MORE if len(page) > SEARCH_PAGE_SIZE else SEARCH_OK
+                page = page[:SEARCH_PAGE_SIZE]
+                numMatched += len(page)
+                try:
+                    outbox.send(codec.encodeSearchPage(outbox.version, pageStatus, page, requestId))
+                except:
+                    return False
+                if pageStatus == SEARCH_OK:
+                    break
+                page = search_users(query, after=page[-1], limit=SEARCH_PAGE_SIZE + 1)
+            print(f"search executed, {numMatched} result(s)")
+            return True
+        # query doesn't match anything
+        else:
+            print(f"search executed, no results")
+            status = SEARCH_NO_RESULTS
+    
+    # *** SEARCH PAGE ***
+    # server receives a page limit, a cursor, and a query, formatted as <limit>|<cursor>|<query>,
+    # and returns at most limit results after the cursor as a single page of results (see above);
+    # the page has the SEARCH_OK_MORE status if there are more results, in which case the last
+    # result of the page is the cursor for the next page. Servers searching every partition
+    # search the others for pages of their own users only, with OP_SEARCH_PARTITION
+    elif op in { OP_SEARCH_PAGE, OP_SEARCH_PARTITION }:
+        print(">> search page requested")
+        try:
+            limit, cursor, query = payload.decode('ascii').split("|")
+            limit = min(int(limit), SEARCH_PAGE_LIMIT)
+        except:
+            return False
+        # ask for one more result than the limit, to find out if there's another page
+        matched = search_users(query, after=cursor, limit=limit + 1, everywhere=(op == OP_SEARCH_PAGE))
+        if matched and limit > 0:
+            pageStatus = SEARCH_OK_MORE if len(matched) > limit else SEARCH_OK
+            try:
+                outbox.send(codec.encodeSearchPage(outbox.version, pageStatus, matched[:limit], requestId))
+            except:
+                return False
+            print(f"search page executed, {len(matched[:limit])} result(s)")
+            return True
+        else:
+            print(f"search page executed, no results")
+            status = SEARCH_NO_RESULTS
+            
+    # *** SEND ***
+    # server receives a sender, receiver, and message, and does two things:
+    # the server sends the sender username and message to the intended reciever if 
+    # they are logged in using the corresponding socket (message is buffered 
+    # otherwise); the server also returns a status code to the sender, except for 
+    # the case where the sender and receiver are the same
+    elif op == OP_SEND:
+        print(">> send requested")
+        # data is formatted as <sender username>|<receiver username>|<message>
+        try:
+            messageRaw = payload
+            messageRawDecoded = messageRaw.decode('ascii').split("|")
+        except: 
+            return False
+        sender, recipient, message = messageRawDecoded[0], messageRawDecoded[1], messageRawDecoded[2]
+        # we handle returning a status code to the sender client at the end of this function
+        try:
+            status = deliver_message(sender, recipient, message, messageRaw)
+        except OSError as e:
+            print(f"failed to send message from {sender} to {recipient} ({e})")
+            status = SEND_FAILED
+        # if the sender is the same as the recipient, don't send any confirmation;
+        # the user who messaged themselves need not see more than their own message
+        if status == SEND_OK_DELIVERED and sender == recipient:
+            return True
+    
+    # *** BATCH SEND ***
+    # server receives a sender and a batch of messages, each for one or more recipients (see
+    # formatSendBatch()), and returns a status code for each delivery, in order: messages are
+    # sent to logged in recipients like with single sends, and every other message is buffered
+    # as one logged (and replicated) update for the whole batch. Batches are only accepted in
+    # frames, since their length varies widely
+    elif op == OP_SEND_BATCH:
+        print(">> batch send requested")
+        if outbox.version < PROTOCOL_FRAMED:
+            status = BAD_OPERATION
+        else:
+            try:
+                sender, deliveries = parseSendBatch(payload.decode('ascii'))
+            except:
+                return False
+            if len(deliveries) > SEND_BATCH_LIMIT or not all(isValidMessage(message) for _, message in deliveries):
+                return False
+            statuses = route_batch(sender, deliveries)
+            outbox.send(codec.encodeResponse(outbox.version, SEND_BATCH_OK, codec.encodeVarint(len(statuses)) + bytes(statuses), requestId))
+            return True
+            
+    # *** LOGOUT ***
+    # server receives a username and returns a status code
+    elif op == OP_LOGOUT:
+        print(">> logout requested")
+        # read the username
+        try:
+            username = payload.decode('ascii')
+        except:
+            return False
+        # the username is no longer active, so its corresponding socket can be removed;
+        # this is all that is needed to mark a user as logged out for the server
+        if store.logout(username, clientSocket):
+            print(f"{username} logged out")
+            status = LOGOUT_OK
+        # this should never happen (the client should check that the username is that
+        # of the user using the client, and since the client is connected, the user
+        # should be logged in on this connection)
+        else:
+            status = UNKNOWN_ERROR
+        
+    # *** DELETE ***
+    # server receives a username and returns a status code; buffered messages from
+    # the user are kept in the buffer
+    elif op == OP_DELETE:
+        print(">> delete requested")
+        # read the username
+        try:
+            username = payload.decode('ascii')
+        except:
+            return False
+        # the user must be logged in on this connection, which should never fail (the client
+        # should check the username corresponds to that of the currently logged-in user)
+        update = None
+        with store.lockFor(username):
+            # first "logout" the user
+            if store.logout(username, clientSocket):
                 # the username no longer exists; note one can request a delete, but register
                 # again using the same username
-                serverState["registeredUsers"].remove(username)
-                save_server_state()
-                print(f"{username} deleted")
-                status = DELETE_OK
-        
-        # we should never get here
+                store.unregister(username)
+                usernameIndex.remove(username)
+                update = append_update(OP_DELETE, payload)
+        if update is None:
+            status = UNKNOWN_ERROR
+        elif not await_update(update):
+            status = UPDATE_NOT_REPLICATED
         else:
-            print(">> unknown operation issued")
+            print(f"{username} deleted")
+            status = DELETE_OK
+    
+    # *** HELLO ***
+    # server receives the latest protocol version the client speaks, and answers with the version
+    # it will speak with the client from then on (see codec.py); this must be the first request
+    # on the connection, and the answer is always in the legacy format
+    elif op == OP_HELLO:
+        print(">> protocol negotiation requested")
+        if outbox.version is not None or len(payload) != CODE_LENGTH:
             status = BAD_OPERATION
-        
-        # server-to-server communication for persistence of state:
-        # inform the replicas of state-changing queries that were successful so they can update their state
-        # we use datagrams - see the dev journal for discussion
-        stateChangingStatuses = {DELETE_OK, SEND_OK_BUFFERED, LOGIN_OK_NO_UNREAD_MSG, LOGIN_OK_UNREAD_MSG, REGISTER_OK}
-        if status in stateChangingStatuses:
-            update = op.to_bytes(CODE_LENGTH, "big")
-            # undelivered messages: send the message contents
-            if status == SEND_OK_BUFFERED:
-                update += messageRaw
-            # for registers, logins, and deletes: send the username in question
-            else:
-                update += bytes(username, 'ascii')
-            # send this update to secondary replicas
-            # we use datagrams which are lightweight but less reliable/can't detect if a connection has
-            # closed: we can simply send the update to all other servers
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            for replica in OTHER_SERVERS:
-                print(f"sending update to replica {SERVER_HOSTS[replica]} {INTERNAL_SERVER_PORTS[replica]}")
-                s.sendto(update, (SERVER_HOSTS[replica], INTERNAL_SERVER_PORTS[replica]))
-                # sleep to give replicas time to update their states
-                time.sleep(SOCKET_UPDATE_DURATION)
-
-        # the server's response to the original client will ALWAYS consist of a 1-byte status 
-        # code, followed by a response header and body if any
-        toSend = status.to_bytes(CODE_LENGTH, "big")
-        # the protocol is such that there will either be BOTH a response header and body or neither; 
-        # the header just indicates the length (# of messages/results) in the body so that the client
-        # knows how many bytes to read (possible in the login and search operations)
-        # one exception to this is when a client is RECEIVING messages, which simply contain 
-        # the RECEIVE_OK code followed by the sender and receiver; however, that's not returned
-        # to the client MAKING the request, which is what we consider here
-        if responseHeader and responseBody:
-            toSend += responseHeader.to_bytes(MSG_HEADER_LENGTH, "big")
-            toSend += bytes(responseBody, 'ascii')
-        clientSocket.sendall(toSend)
-        print("server response given")
+        else:
+            version = codec.negotiateVersion(payload[0])
+            outbox.send(HELLO_OK.to_bytes(CODE_LENGTH, "big") + version.to_bytes(CODE_LENGTH, "big"))
+            outbox.version = version
+            print(f"client speaks protocol version {version}")
+            return True
+    
+    # *** PARTITION MAP ***
+    # server receives nothing and returns the partition it serves, then the map of every partition
+    # (see partitions.py), separated by a newline; clients use it to find the primary of the
+    # partition a user registers and logs in with. Servers whose users aren't partitioned answer
+    # with a map of just their own partition
+    elif op == OP_PARTITION_MAP:
+        print(">> partition map requested")
+        if outbox.version < PROTOCOL_FRAMED:
+            status = BAD_OPERATION
+        else:
+            partitions = partitionMap if partitionMap is not None else PartitionMap({PARTITION: SERVER_HOSTS})
+            outbox.send(codec.encodeResponse(outbox.version, PARTITION_MAP_OK, bytes(f"{PARTITION}\n{partitions.format()}", 'ascii'), requestId))
+            return True
+    
+    # *** READ ONLY ***
+    # server receives nothing, makes the session read-only (from then on, only searches and
+    # presence lookups are served on it), and returns a status code along with how many
+    # milliseconds out of date its reads may be: READ_ONLY_OK if that's within MAX_READ_STALENESS,
+    # or READ_STALE if not, in which case the client should read from the primary instead. Any
+    # server accepts read-only sessions, but they're meant for secondaries, to serve reads off the
+    # primary; clients ask again before each read to find out how stale it may be
+    elif op == OP_READ_ONLY:
+        print(">> read-only session requested")
+        if outbox.version < PROTOCOL_FRAMED:
+            status = BAD_OPERATION
+        else:
+            store.sessions.markReadOnly(clientSocket)
+            staleness = read_staleness()
+            status = READ_ONLY_OK if staleness <= MAX_READ_STALENESS else READ_STALE
+            staleness = int(min(staleness, STALENESS_REPORT_LIMIT) * 1000)
+            outbox.send(codec.encodeResponse(outbox.version, status, codec.encodeVarint(staleness), requestId))
+            return True
+
+    # *** PRIMARY ***
+    # server receives nothing and returns PRIMARY_IS with the ID of the primary, as far as it knows
+    # (NO_SERVER if the group has none right now, e.g. while a new one takes over); clients look for
+    # the primary with this when they connect. Servers also push PRIMARY_IS to their clients
+    # whenever the primary changes
+    elif op == OP_PRIMARY:
+        print(">> primary requested")
+        if outbox.version < PROTOCOL_FRAMED:
+            status = BAD_OPERATION
+        else:
+            outbox.send(codec.encodeResponse(outbox.version, PRIMARY_IS, bytes([primary_id()]), requestId))
+            return True
+
+    # *** PRESENCE ***
+    # server receives a username and returns whether the user is logged in (PRESENCE_ONLINE or
+    # PRESENCE_OFFLINE), or PRESENCE_NOT_REGISTERED
+    elif op == OP_PRESENCE:
+        print(">> presence lookup requested")
+        if outbox.version < PROTOCOL_FRAMED:
+            status = BAD_OPERATION
+        else:
+            try:
+                username = payload.decode('ascii')
+            except:
+                return False
+            try:
+                status = user_presence(username)
+            except OSError as e:
+                print(f"failed to look up {username} ({e})")
+                status = UNKNOWN_ERROR
+
+    # *** PING ***
+    # server receives nothing and returns a status code; clients ping while they have nothing else
+    # to send, so that their connection isn't closed for being idle
+    elif op == OP_PING:
+        status = PING_OK
+    
+    # we should never get here
+    else:
+        print(">> unknown operation issued")
+        status = BAD_OPERATION
+    
+    # the server's response to the original client will ALWAYS consist of a 1-byte status 
+    # code, followed by a response header and body if any (framed, if the client speaks the
+    # framed protocol)
+    body = b""
+    # the protocol is such that there will either be BOTH a response header and body or neither; 
+    # the header just indicates the length (# of messages/results) in the body so that the client
+    # knows how many bytes to read (possible in the login and search operations)
+    # one exception to this is when a client is RECEIVING messages, which simply contain 
+    # the RECEIVE_OK code followed by the sender and receiver; however, that's not returned
+    # to the client MAKING the request, which is what we consider here
+    if responseHeader and responseBody:
+        body = responseHeader.to_bytes(MSG_HEADER_LENGTH, "big") + bytes(responseBody, 'ascii')
+    outbox.send(codec.encodeResponse(outbox.version, status, body, requestId))
+    print("server response given")
+    return True
 
 # if the server is a replica it needs to listen for updates from the primary; this is the helper 
-# function to do this, given the socket where updates are being received
-def listen_for_updates(serverSock):
-    # run this in a loop
+# function to do this, given the streaming socket that other servers connect to
+def listen_for_updates(listenSock):
+    # run this in a loop, accepting connections from whichever server is the primary, as well as
+    # from servers syncing their state
     while True:
-        # prepare to receive the longest message the primary could possibly send
-        data, _ = serverSock.recvfrom(
-            CODE_LENGTH + 
-            MESSAGE_LENGTH + 
-            2 * USERNAME_LENGTH + 
-            2 * DELIMITER_LENGTH)
-
-        print("received server state update")
-        # check what type of state update this is
-        op = data[0]
-
-        # registers: add the user
-        if op == OP_REGISTER:
-            username = data[1:].decode('ascii')
-            serverState["registeredUsers"].add(username)
-            save_server_state()
-            print(f"state update: registered user {username}")
-        
-        # login: clear the buffer for the user - we also send along the client address but don't
-        # make use of it in our implementation as it stands
-        elif op == OP_LOGIN:
-            username = data[1:].decode('ascii')
-            serverState["messageBuffer"][username] = []
-            save_server_state()
-            print(f"state update: logged in user {username}")
-        
-        # (buffered) sends: update the message cache
-        elif op == OP_SEND:
-            messageRawDecoded = data[1:].decode('ascii').split("|")
-            sender, recipient, message = messageRawDecoded[0], messageRawDecoded[1], messageRawDecoded[2]
-            serverState["messageBuffer"][recipient].append(f"{sender}|{message}")
-            save_server_state()
-            print(f"state update: buffered message from {sender} to {recipient}")
-            
-        # deletes: remove the user
-        elif op == OP_DELETE:
-            username = data[1:].decode('ascii')
-            serverState["registeredUsers"].remove(username)
-            save_server_state()
-            print(f"state update: deleted user {username}")
-
-# helper function used during initialization: using the server-to-server datagram socket, listens
-# to other servers send their states, and updates this server's state to the most recent state
-# this ensures that after initialization, all servers have the same, latest state
-# the code handling the sending of state itself is located in the main thread
-def get_state_updates(serverSock):
-    global serverState
-    # we expect to read states from each of two other servers
-    numUpdates = 0
-    while True:
-        # read an incoming state from another server
-        # limitation: this implicitly hardcodes that state byte lengths is capped, since with
-        # datagrams we want to get the entire state in one read
-        stateData, _ = serverSock.recvfrom(10262)
-        print("received other server state")
-        numUpdates += 1
-        # load the other state as a dictionary, and make it this server's state if it's more recent
-        otherState = pickle.loads(stateData)
-        if otherState["timestamp"] > serverState["timestamp"]:
-            print("other server state has newer timestamp, updating")
-            serverState = otherState
-        # once we've read two updates, we know there are no more states to receive
-        if numUpdates == 2:
-            print("all other server states received")
-            save_server_state()
+        try:
+            otherSock, addr = listenSock.accept()
+        except OSError:
             return
+        handler = threading.Thread(target=handle_server_connection, args=(otherSock, addr))
+        handler.daemon = True
+        handler.start()
+        threads.append(handler)
 
-# function that sets up the client-to-server socket, and primes the server to listen to client
-# connections across this socket
-def run_server():
-    global clientSock
-    # put the socket into listening mode
-    # start the server's own socket, bind it, and broadcast the host/port (for client connections)
-    clientSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    clientSock.bind((HOST_LISTEN_ALL, port))
-    print(f"server socket started on host {socket.gethostname()} and port {port}")
+# handle a connection from another server, which first sends a 1-byte code for what it's for
+def handle_server_connection(otherSock, addr):
+    try:
+        channel, payload = replication.recvChannelFrame(otherSock)
+    except (OSError, ValueError) as e:
+        print(f"bad connection from server {addr[0]}:{addr[1]} ({e})")
+        otherSock.close()
+        return
+    # the primary is connecting to send state updates: receive, apply, and acknowledge them for as
+    # long as it stays connected
+    if channel == CHANNEL_REPLICATE:
+        print(f"primary {addr[0]}:{addr[1]} connected to send state updates")
+        replication.receiveUpdates(otherSock, store.state["lastSeq"], apply_replicated_update, install_snapshot)
+    # another server is syncing its state: tell it whether we're ready, send it every update it's
+    # missing, then hang up
+    elif channel == CHANNEL_SYNC:
+        try:
+            other = payload[0]
+            otherSock.sendall((PEER_READY if serverReady else PEER_STARTING).to_bytes(CODE_LENGTH, "big"))
+            fromSeq = replication.recvSeq(otherSock)
+            with logLock:
+                toSeq = store.state["lastSeq"]
+            print(f"server {other} syncing state from update {fromSeq} (we're at {toSeq})")
+            send_catch_up(otherSock, fromSeq, toSeq)
+        except (OSError, IndexError) as e:
+            print(f"failed to sync server {addr[0]}:{addr[1]}: {e}")
+            otherSock.close()
+            return
+        replication.finishSending(otherSock)
+        # the other server is ahead of us, e.g. because it was down when we started and has a more
+        # recent state on disk: sync from it in turn
+        if fromSeq > toSeq and other in OTHER_SERVERS:
+            sync_from_server(other)
+    # another server is sending heartbeats (see leases.py), which we only take once ours are running
+    elif channel == CHANNEL_HEARTBEAT and isinstance(lease, Lease):
+        lease.receiveHeartbeats(otherSock)
+    else:
+        otherSock.close()
+
+# helper function used during initialization: sync this server's state from another server, which
+# sends us every update we're missing (see send_catch_up()); returns whether the other server was
+# ready (PEER_READY or PEER_STARTING), or None if it couldn't be reached
+def sync_from_server(other):
+    try:
+        otherSock = socket.create_connection(
+            (SERVER_HOSTS[other], internalPort(other, SHARD, PARTITION)), timeout=REPLICA_CONNECT_TIMEOUT)
+        otherSock.sendall(replication.formatChannelFrame(CHANNEL_SYNC, SERVER_ID.to_bytes(CODE_LENGTH, "big")))
+        status = int.from_bytes(recvExactly(otherSock, CODE_LENGTH), "big")
+        otherSock.settimeout(None)
+    except OSError:
+        return None
+    replication.receiveUpdates(otherSock, store.state["lastSeq"], apply_replicated_update, install_snapshot)
+    print(f"synced state from server {other} ({'ready' if status == PEER_READY else 'starting'}), now at update {store.state['lastSeq']}")
+    return status
+
+# helper function used during initialization: reconcile this server's state with the other
+# servers' before serving clients. We sync from every server we can reach (which gets us the most
+# recent state among them, since they do the same), and stop as soon as we've synced from one
+# that's already ready, as its state is already reconciled. If some servers can't be reached, we
+# keep trying for a while, in case they're starting at about the same time; any that start later
+# will sync from us instead
+def discover_servers():
+    unsynced = set(OTHER_SERVERS)
+    deadline = time.monotonic() + PEER_DISCOVERY_TIMEOUT
+    while unsynced:
+        for other in sorted(unsynced):
+            status = sync_from_server(other)
+            if status == PEER_READY:
+                return
+            if status is not None:
+                unsynced.discard(other)
+        if not unsynced or time.monotonic() >= deadline:
+            break
+        time.sleep(PEER_RETRY_INTERVAL)
+    if unsynced:
+        print(f"could not reach server(s) {sorted(unsynced)}, starting without them")
+
+# helper function to close every client socket and the listening socket when shutting down;
+# this will also notify the clients that the server connection has ended
+def close_client_sockets():
+    for c in store.sessions.sockets():
+        c.close()
+    clientSock.close()
+
+# per-connection state tracked by the event loop in selector mode
+class ClientConnection:
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        # bytes read from the socket that haven't been handed to handle_request() yet
+        self.inbox = bytearray()
+        # whether a worker thread is currently executing a request from this client; requests
+        # from the same client are executed one at a time and in order
+        self.busy = False
+        self.closed = False
+        # when data from the client last arrived, and when the loop is set to look at its inbox
+        # again (see dispatch())
+        self.lastRead = 0
+        self.wakeAt = None
+
+# the selector-based server core: a single event loop thread owns every client socket and only
+# does non-blocking accepts and reads, handing each complete request to a fixed pool of worker
+# threads (requests may block on disk or on the replicas, so they can't run on the loop itself)
+def run_event_loop():
+    selector = selectors.DefaultSelector()
+    workers = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="worker")
+    # workers hand results back to the loop through a queue of callbacks; a socket pair wakes the
+    # loop up from select() whenever a callback is queued
+    callbacks = deque()
+    wakeupReader, wakeupWriter = socket.socketpair()
+    wakeupReader.setblocking(False)
+    wakeupWriter.setblocking(False)
+    connections = set()
+    # (time, connection ID, connection) of the connections whose inbox is looked at again then
+    timers = []
     
-    clientSock.listen(CLIENT_CAPACITY)
-    print("server listening for clients...")
-        
+    def call_soon(callback, *args):
+        callbacks.append((callback, args))
+        try:
+            wakeupWriter.send(b"\0")
+        # the wakeup buffer is full, so the loop is going to wake up anyway
+        except BlockingIOError:
+            pass
+    
+    # close a connection, logging the user out if they're still logged in on it
+    def drop(conn, error):
+        if conn.closed:
+            return
+        conn.closed = True
+        connections.discard(conn)
+        selector.unregister(conn.sock)
+        print("not connected to client, closing socket" if error else "client disconnected, closing socket")
+        disconnect(conn.sock)
+    
+    # runs on a worker thread
+    def execute(conn, op, payload):
+        try:
+            keepOpen = handle_request(conn.sock, op, payload)
+        except HandOff as handOff:
+            call_soon(release, conn, handOff)
+            return
+        except Exception as e:
+            print(f"error handling request: {e}")
+            keepOpen = False
+        call_soon(finish, conn, keepOpen)
+    
+    # runs back on the loop thread once a worker is done with a request
+    def finish(conn, keepOpen):
+        conn.busy = False
+        if conn.closed:
+            return
+        if not keepOpen:
+            drop(conn, error=True)
+        else:
+            dispatch(conn)
+    
+    # stop serving a connection that's being handed off to another shard, and hand it off (on a
+    # worker thread, since that waits for its outbox to drain)
+    def release(conn, handOff):
+        conn.busy = False
+        if conn.closed:
+            return
+        conn.closed = True
+        connections.discard(conn)
+        selector.unregister(conn.sock)
+        workers.submit(hand_off, conn.sock, handOff, bytes(conn.inbox))
+    
+    # take over a connection handed off by another shard, and execute the request it was handed
+    # off with, as if it had been read here
+    def resume(sock, version, op, payload, inbox):
+        try:
+            accept_client(sock)
+            addr = sock.getpeername()
+        except OSError as e:
+            print(f"connection handed off by another shard failed ({e})")
+            store.closeSession(sock)
+            sock.close()
+            return
+        get_outbox(sock).version = version
+        conn = ClientConnection(sock, addr)
+        conn.inbox += inbox
+        connections.add(conn)
+        selector.register(sock, selectors.EVENT_READ, conn)
+        conn.busy = True
+        workers.submit(execute, conn, op, payload)
+    
+    # hand the next buffered request of a connection to the worker pool, if there is one; like in
+    # service_connection(), a request is a frame, or in the legacy protocol a 1-byte operation code
+    # followed by (at most) the operation's maximum payload length of data
+    def dispatch(conn):
+        if conn.busy or conn.closed or not conn.inbox:
+            return
+        if is_framed(conn.sock):
+            try:
+                request = codec.takeFrame(conn.inbox, MAX_REQUEST_LENGTH)
+            except codec.ProtocolError as e:
+                print(f"bad request from client ({e})")
+                drop(conn, error=True)
+                return
+            # the whole frame hasn't arrived yet
+            if request is None:
+                return
+            op, payload = request
+        else:
+            op = conn.inbox[0]
+            payloadLength = OP_PAYLOAD_LENGTHS.get(op, 0)
+            # the operation's data may not have all arrived yet: wait for the rest of it, until
+            # there's been no more for LEGACY_PAYLOAD_WAIT (see recv_legacy_payload())
+            if len(conn.inbox) < 1 + payloadLength:
+                settleAt = conn.lastRead + LEGACY_PAYLOAD_WAIT
+                if len(conn.inbox) == 1 or settleAt > time.monotonic():
+                    if len(conn.inbox) > 1 and conn.wakeAt != settleAt:
+                        conn.wakeAt = settleAt
+                        heapq.heappush(timers, (settleAt, id(conn), conn))
+                    return
+            payload = bytes(conn.inbox[1:1 + payloadLength])
+            del conn.inbox[:1 + payloadLength]
+        conn.busy = True
+        workers.submit(execute, conn, op, payload)
+    
+    # accept every pending connection at once, so that bursts of reconnecting clients are drained
+    # from the backlog quickly
+    def accept():
+        while True:
+            try:
+                c, addr = clientSock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            print(f"connected to new client {addr[0]}:{addr[1]}")
+            # the loop only reads once the selector reports data, while writers (see outbox.py)
+            # write to the client without ever waiting for it
+            accept_client(c)
+            conn = ClientConnection(c, addr)
+            connections.add(conn)
+            selector.register(c, selectors.EVENT_READ, conn)
+    
+    def read(conn):
+        try:
+            data = conn.sock.recv(RECV_CHUNK_SIZE)
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            return
+        # there's an error communicating with the client: close the socket
+        except OSError:
+            drop(conn, error=True)
+            return
+        # the client closed the connection
+        if not data:
+            drop(conn, error=False)
+            return
+        conn.inbox += data
+        conn.lastRead = time.monotonic()
+        dispatch(conn)
+    
+    # serve the links of the other shards, if the server is sharded; connections they hand off are
+    # taken over on the loop thread
+    if shardSock is not None:
+        linkServer = threading.Thread(target=serveShardLinks,
+                                      args=(shardSock, shard_link_functions(), lambda *args: call_soon(resume, *args)))
+        linkServer.daemon = True
+        linkServer.start()
+        threads.append(linkServer)
+    
+    clientSock.setblocking(False)
+    selector.register(clientSock, selectors.EVENT_READ, None)
+    selector.register(wakeupReader, selectors.EVENT_READ, wakeupReader)
+    try:
+        while True:
+            timeout = max(timers[0][0] - time.monotonic(), 0) if timers else None
+            for key, _ in selector.select(timeout):
+                if key.data is None:
+                    accept()
+                elif key.data is wakeupReader:
+                    try:
+                        while wakeupReader.recv(RECV_CHUNK_SIZE):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    read(key.data)
+            while callbacks:
+                callback, args = callbacks.popleft()
+                callback(*args)
+            while timers and timers[0][0] <= time.monotonic():
+                wakeAt, _, conn = heapq.heappop(timers)
+                # the timer is stale if more data arrived since it was set
+                if conn.wakeAt == wakeAt:
+                    conn.wakeAt = None
+                    dispatch(conn)
+    except KeyboardInterrupt:
+        print("\ncaught interrupt, shutting down server")
+    except Exception as e:
+        print(f"event loop failed ({e}), shutting down server")
+    for conn in list(connections):
+        conn.sock.close()
+    close_client_sockets()
+    workers.shutdown(wait=False)
+    selector.close()
+
+# the thread-per-client server core: open a new thread for each accepted client connection
+def run_threaded():
     while True:
         # attempt to establish connection with clients
-        # since clients only initiate connections to the current primary, actually accepting a connection
-        # means that the current server replica now becomes the primary
+        # since clients only initiate connections to the current primary (other than read-only
+        # sessions), the first request on a connection makes the current server replica the primary
         try:
             c, addr = clientSock.accept()
-        # gracefully-ish handle a keyboard interrupt by closing the active sockets;
-        # this will also notify the clients that the server connection has ended
+        # gracefully-ish handle a keyboard interrupt by closing the active sockets
         except KeyboardInterrupt:
             print("\ncaught interrupt, shutting down server")
-            for c in userToSocket.values():
-                c.close()
-            clientSock.close()
+            close_client_sockets()
             break 
         # also simply shut down if we can't connect to a new user for some reason
         except:
             print("failed to accept socket connection, shutting down server")
-            for c in userToSocket.values():
-                c.close()
-            clientSock.close()
+            close_client_sockets()
             break
-        print(f"connected to new client {addr[0]}:{addr[1]} - now acting as primary replica")
+        print(f"connected to new client {addr[0]}:{addr[1]}")
+        accept_client(c)
         
         # multithreading setup for multiple concurrent client connections:
         # start a new thread for each client connection and return its identifier
@@ -467,58 +1806,217 @@ def run_server():
         servicer.start()
         threads.append(servicer)
 
-if __name__ == "__main__":
-    # a port can be specified when running the program
-    if len(sys.argv) != 5:
-        print(f"usage: {sys.argv[0]} <server ID (0, 1, 2)> <server 0 host> <server 1 host> <server 2 host>")
-        sys.exit(1)
-        
-    # set the server's current ID, and the other servers' addresses
-    SERVER_ID = int(sys.argv[1])
-    SERVER_HOSTS = [sys.argv[2], sys.argv[3], sys.argv[4]]
-    port = SERVER_PORTS[SERVER_ID]
-    OTHER_SERVERS = list({0, 1, 2} - {SERVER_ID})
-        
-    # persistence: check if there is existing server state
-    print(f'starting server with ID {SERVER_ID}')
-    load_server_state()
+# start the server's own socket, bind it, and broadcast the host/port (for client connections),
+# then put the socket into listening mode
+def open_client_socket():
+    global clientSock
+    clientSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    clientSock.bind((HOST_LISTEN_ALL, port))
+    print(f"server socket started on host {socket.gethostname()} and port {port}")
+    clientSock.listen(LISTEN_BACKLOG)
+
+# function that sets up the client-to-server socket, and primes the server to listen to client
+# connections across this socket using the given server mode
+def run_server(mode=SERVER_MODE_SELECTOR):
+    global serverReady
+    # the shards of a sharded server share a socket opened before they were started
+    if clientSock is None:
+        open_client_socket()
+    print(f"server listening for clients ({mode} mode)...")
+    serverReady = True
     
-    # set up a datagram socket to listen for updates from other servers if the server isn't currently
-    # a primary replica (see design doc)
-    serverSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    serverSock.bind((SERVER_HOSTS[SERVER_ID], INTERNAL_SERVER_PORTS[SERVER_ID]))
-    print("server internal socket started on port", INTERNAL_SERVER_PORTS[SERVER_ID])
+    reaper = threading.Thread(target=run_reaper)
+    reaper.daemon = True
+    reaper.start()
+    threads.append(reaper)
     
-    # wait for all programs to start and create their server-to-server datagram sockets
-    time.sleep(SOCKET_SETUP_DURATION)
+    # once we're the primary, keep the replicas posted on how up to date they are (see OP_SYNC_MARK)
+    marker = threading.Thread(target=run_sync_marks)
+    marker.daemon = True
+    marker.start()
+    threads.append(marker)
     
-    # share state: each server will concurrently both (a) send its own state to other servers and (b)
-    # receive other servers' states using the datagram socket, updating its own state if the other states
-    # are more recent; no matter how the pattern of state sends, receives, and updates occurs, this 
-    # guarantees that by the end of this process, all servers will have the same, most updated state
-    # thread for listening for other servers' states
-    state_listener = threading.Thread(target=get_state_updates, args=(serverSock,))
-    state_listener.daemon = True 
-    state_listener.start() 
+    if mode == SERVER_MODE_THREADS:
+        run_threaded()
+    else:
+        run_event_loop()
+    print(f"slow consumer policies fired: {slowConsumerCounters}")
+    close_server_state()
+
+# start the server (or one shard of it): load its state, reconcile it with the other servers',
+# then serve clients using the given server mode
+def start_server(mode):
+    global serverSock
+    # persistence: check if there is existing server state
+    print(f'starting server with ID {SERVER_ID}' + (f', shard {SHARD} of {NUM_SHARDS}' if NUM_SHARDS > 1 else ''))
+    load_server_state()
+    # once we're the primary, the replicas are told who logs in and out, so they can serve presence
+    # lookups
+    store.onPresence = broadcast_presence
     
-    # send own state to other servers
-    stateData = pickle.dumps(serverState)
-    for replica in OTHER_SERVERS:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        print(f"sending initial state to replica {SERVER_HOSTS[replica]} {INTERNAL_SERVER_PORTS[replica]}")
-        s.sendto(stateData, (SERVER_HOSTS[replica], INTERNAL_SERVER_PORTS[replica]))
-        # wait some tiem for the server to process
-        time.sleep(SOCKET_UPDATE_DURATION)
-
-    # wait for the overall operation of sends, receives, and updates to complete among all three servers
-    time.sleep(SOCKET_SETUP_DURATION + 2 * SOCKET_UPDATE_DURATION)
-
-    # start listening to other servers on another thread
+    # start listening to other servers on another thread: a streaming socket accepts the primary's
+    # connection, over which it sends state updates, as well as other servers syncing their states
+    serverSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serverSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    serverSock.bind((SERVER_HOSTS[SERVER_ID], internalPort(SERVER_ID, SHARD, PARTITION)))
+    serverSock.listen()
+    print("server internal socket started on port", internalPort(SERVER_ID, SHARD, PARTITION))
     listener = threading.Thread(target=listen_for_updates, args=(serverSock,))
     listener.daemon = True
     listener.start()
     threads.append(listener)
+    
+    # share state: reconcile with the other servers, receiving only the updates we're missing (or a
+    # snapshot, if we're too far behind), then save the reconciled state
+    discover_servers()
+    save_server_state()
+
+    # find out which server is the primary, exchanging heartbeats with the other servers (see
+    # leases.py), and take over as the primary whenever we hold the lease; the other shards of a
+    # sharded server get the lease from shard 0 instead of electing a primary of their own
+    global lease
+    if SHARD == 0:
+        lease = Lease(SERVER_ID, len(SERVER_HOSTS), lambda: store.state["lastSeq"], primary_changed, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
+        lease.start({other: (SERVER_HOSTS[other], internalPort(other, SHARD, PARTITION)) for other in OTHER_SERVERS})
+    else:
+        lease = ShardLease(SERVER_ID, shardLinks[0], primary_changed, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
+        lease.start()
+
+    # take snapshots of the state in the background from now on
+    snapshotter = threading.Thread(target=run_snapshotter)
+    snapshotter.daemon = True
+    snapshotter.start()
+    threads.append(snapshotter)
 
     # set up this server's client-to-server socket too, anticipating eventual connections (when the
     # server becomes the primary replica)
-    run_server()
\ No newline at end of file
+    run_server(mode)
+
+# run one shard of the server in a process forked by run_shards(), given the listening sockets of
+# every shard's links
+def run_shard(shard, numShards, linkSocks, mode):
+    global SHARD, NUM_SHARDS, shardSock, shardLinks
+    SHARD, NUM_SHARDS = shard, numShards
+    shardSock = linkSocks[shard]
+    for other, sock in enumerate(linkSocks):
+        if other != shard:
+            sock.close()
+            shardLinks[other] = ShardLink(other, linkPath(STATE_DIRECTORY, SERVER_ID, other, PARTITION))
+    try:
+        start_server(mode)
+    except KeyboardInterrupt:
+        pass
+
+# run the server as the given number of shards (see shards.py), each in a process of its own: the
+# client socket and the shards' link sockets are all opened here, before forking, so that the
+# shards share the client socket and can reach each other as soon as they start
+def run_shards(numShards, mode):
+    open_client_socket()
+    os.makedirs(STATE_DIRECTORY, exist_ok=True)
+    linkSocks = [listenForShards(linkPath(STATE_DIRECTORY, SERVER_ID, shard, PARTITION)) for shard in range(numShards)]
+    processes = [multiprocessing.get_context("fork").Process(target=run_shard, args=(shard, numShards, linkSocks, mode))
+                 for shard in range(numShards)]
+    for process in processes:
+        process.start()
+    print(f"started {numShards} shards")
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("\ncaught interrupt, waiting for shards to shut down")
+        for process in processes:
+            process.join()
+
+if __name__ == "__main__":
+    # the server ID and all server hosts must be specified when running the program
+    parser = argparse.ArgumentParser()
+    parser.add_argument("id", type=int, help="server ID (its index in the list of hosts)")
+    parser.add_argument("hosts", nargs="+", metavar="host", help=f"hosts of servers 0, 1, 2, ... of the group (up to {MAX_REPLICAS})")
+    parser.add_argument("--mode", choices=[SERVER_MODE_SELECTOR, SERVER_MODE_THREADS], default=SERVER_MODE_SELECTOR,
+                        help="serve clients from one event loop and a worker pool, or with a thread per client")
+    parser.add_argument("--fsync", choices=[FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_OS], default=FSYNC_POLICY,
+                        help="when logged state changes are synced to disk before being acknowledged")
+    parser.add_argument("--fsync-interval-ms", type=int, default=FSYNC_INTERVAL_MS,
+                        help="milliseconds between syncs with the interval policy")
+    parser.add_argument("--outbox-high-watermark", type=int, default=OUTBOX_HIGH_WATERMARK,
+                        help="bytes queued to a client above which it's treated as a slow consumer")
+    parser.add_argument("--outbox-low-watermark", type=int, default=OUTBOX_LOW_WATERMARK,
+                        help="bytes queued to a slow consumer below which messages are delivered to it directly again")
+    parser.add_argument("--slow-consumer-policy", choices=[SLOW_CONSUMER_BUFFER, SLOW_CONSUMER_DISCONNECT],
+                        default=SLOW_CONSUMER_POLICY,
+                        help="buffer messages for slow consumers until they catch up, or disconnect them")
+    parser.add_argument("--idle-timeout", type=float, default=CLIENT_IDLE_TIMEOUT,
+                        help="seconds without a request after which a client connection is closed (0 to never close idle connections)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="number of processes to split the server's users between (every server must use the same number)")
+    parser.add_argument("--partition-map", metavar="FILE",
+                        help="map of the partitions the users are split between, one per line as <partition> <host 0> <host 1> <host 2>")
+    parser.add_argument("--partition", type=int, default=0,
+                        help="the partition (of the partition map) this server's replica group serves")
+    parser.add_argument("--write-quorum", type=int,
+                        help="number of servers (the primary included) an update must be durable on to commit (default: a majority)")
+    parser.add_argument("--allow-primary-only", action="store_true",
+                        help="commit updates on the primary alone if too few replicas acknowledge them to make up the write quorum, rather than failing them")
+    parser.add_argument("--heartbeat-interval", type=float, default=HEARTBEAT_INTERVAL,
+                        help="seconds between heartbeats to the other servers")
+    parser.add_argument("--heartbeat-timeout", type=float, default=HEARTBEAT_TIMEOUT,
+                        help="seconds without a heartbeat after which a server is taken to be down, and how long the primary's lease lasts")
+    parser.add_argument("--max-staleness", type=float, default=MAX_READ_STALENESS,
+                        help="seconds out of date a secondary's state may be for it to still serve read-only sessions")
+    args = parser.parse_args()
+    if len(args.hosts) > MAX_REPLICAS:
+        parser.error(f"a group has at most {MAX_REPLICAS} servers")
+    if not 0 <= args.id < len(args.hosts):
+        parser.error(f"the server ID must be between 0 and {len(args.hosts) - 1}")
+    if args.write_quorum is not None and not 1 <= args.write_quorum <= len(args.hosts):
+        parser.error(f"the write quorum must be between 1 and {len(args.hosts)}")
+    if not 0 < args.heartbeat_interval < args.heartbeat_timeout:
+        parser.error("the heartbeat interval must be positive and shorter than the heartbeat timeout")
+    if args.shards < 1:
+        parser.error("a server needs at least one shard")
+    if args.shards > 1 and args.mode == SERVER_MODE_THREADS:
+        parser.error("sharded servers only serve clients in selector mode")
+    if not 0 <= args.outbox_low_watermark <= args.outbox_high_watermark:
+        parser.error("the outbox low watermark must be between 0 and the high watermark")
+        
+    # set the server's durability policy
+    FSYNC_POLICY = args.fsync
+    FSYNC_INTERVAL_MS = args.fsync_interval_ms
+    
+    # set how the server treats clients that aren't keeping up with their messages
+    OUTBOX_HIGH_WATERMARK = args.outbox_high_watermark
+    OUTBOX_LOW_WATERMARK = args.outbox_low_watermark
+    SLOW_CONSUMER_POLICY = args.slow_consumer_policy
+    
+    # set how long clients may stay silent before their connections are closed
+    CLIENT_IDLE_TIMEOUT = args.idle_timeout
+    
+    # set the partition the server serves, and the map of every partition
+    if args.partition_map is not None:
+        try:
+            partitionMap = loadPartitionMap(args.partition_map)
+        except (OSError, ValueError) as e:
+            parser.error(f"can't read the partition map: {e}")
+        if args.partition not in partitionMap.hosts:
+            parser.error(f"partition {args.partition} isn't in the partition map")
+    elif args.partition != 0:
+        parser.error("--partition needs a --partition-map")
+    PARTITION = args.partition
+    
+    # set the server's current ID, and the other servers' addresses
+    SERVER_ID = args.id
+    SERVER_HOSTS = args.hosts
+    port = clientPort(PARTITION, SERVER_ID)
+    OTHER_SERVERS = [other for other in range(len(SERVER_HOSTS)) if other != SERVER_ID]
+    WRITE_QUORUM = args.write_quorum if args.write_quorum is not None else majority(len(SERVER_HOSTS))
+    ALLOW_PRIMARY_ONLY = args.allow_primary_only
+    MAX_READ_STALENESS = args.max_staleness
+    HEARTBEAT_INTERVAL = args.heartbeat_interval
+    HEARTBEAT_TIMEOUT = args.heartbeat_timeout
+        
+    # set up this server's client-to-server socket, and either run it as several shards or serve
+    # clients from this process alone
+    if args.shards > 1:
+        run_shards(args.shards, args.mode)
+    else:
+        start_server(args.mode)
\ No newline at end of file
@@ -0,0 +1,123 @@
+import threading
+import time
+
+from utils import *
+
+# The registry of client connections ("sessions") and the users logged in on them. Every
+# connection is registered when it's accepted, and removed when it ends; logging in binds a user
+# to their connection's session. The registry is indexed both ways, so that the socket a user is
+# logged in on and the users logged in on a socket are each found in constant time (e.g. when a
+# connection fails, without looking through every logged in user).
+# Each session also tracks when a request was last received on it. A connection whose other end
+# vanished without closing it (a crashed client, or a network partition) looks just like an idle
+# one, so connections are closed once they've been idle for too long (clients send OP_PING
+# requests to keep theirs open; see CLIENT_PING_INTERVAL), which frees their sessions like any
+# other disconnect. Sessions whose sockets were closed without being removed are also reaped, so
+# the registry only ever holds live connections.
+# A session can also be made read-only (see OP_READ_ONLY), after which only reads are served on it;
+# these are how secondaries serve searches off the primary.
+
+class Session:
+    def __init__(self, sock):
+        self.sock = sock
+        # the users logged in on the connection (usually at most one)
+        self.usernames = set()
+        # time.monotonic() of the last request received on the connection
+        self.lastActive = time.monotonic()
+        # whether only reads are served on the connection
+        self.readOnly = False
+
+class SessionRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # map of sockets to their sessions, and of logged in usernames to their sessions
+        self.bySocket = {}
+        self.byUser = {}
+
+    def __len__(self):
+        return len(self.bySocket)
+
+    # register a newly accepted connection, returning its session
+    def open(self, sock) -> Session:
+        with self.lock:
+            if sock not in self.bySocket:
+                self.bySocket[sock] = Session(sock)
+            return self.bySocket[sock]
+
+    # record that a request was received on a connection
+    def touch(self, sock):
+        session = self.bySocket.get(sock)
+        if session is not None:
+            session.lastActive = time.monotonic()
+
+    # make a connection's session read-only
+    def markReadOnly(self, sock):
+        self.open(sock).readOnly = True
+
+    def isReadOnly(self, sock) -> bool:
+        session = self.bySocket.get(sock)
+        return session is not None and session.readOnly
+
+    # log a user in on a connection unless they're already logged in, returning whether they were
+    def bind(self, username : str, sock) -> bool:
+        with self.lock:
+            if username in self.byUser:
+                return False
+            session = self.bySocket.get(sock)
+            if session is None:
+                session = self.bySocket[sock] = Session(sock)
+            session.usernames.add(username)
+            self.byUser[username] = session
+            return True
+
+    # log a user out if they're logged in on the given connection, returning whether they were
+    def unbind(self, username : str, sock) -> bool:
+        with self.lock:
+            session = self.byUser.get(username)
+            if session is None or session.sock is not sock:
+                return False
+            del self.byUser[username]
+            session.usernames.discard(username)
+            return True
+
+    # the socket a user is logged in on, or None
+    def socketOf(self, username : str):
+        session = self.byUser.get(username)
+        return session.sock if session is not None else None
+
+    # the users logged in on any connection
+    def loggedIn(self):
+        with self.lock:
+            return list(self.byUser)
+
+    # the users logged in on a socket
+    def usersOf(self, sock):
+        with self.lock:
+            session = self.bySocket.get(sock)
+            return sorted(session.usernames) if session is not None else []
+
+    # remove the session of a connection that has ended, logging out its users, whose usernames
+    # are returned
+    def close(self, sock):
+        with self.lock:
+            session = self.bySocket.pop(sock, None)
+            if session is None:
+                return []
+            for username in session.usernames:
+                if self.byUser.get(username) is session:
+                    del self.byUser[username]
+            return sorted(session.usernames)
+
+    # the sockets of every registered connection
+    def sockets(self):
+        with self.lock:
+            return list(self.bySocket)
+
+    # the sockets of connections that have had no requests for longer than the given number of
+    # seconds, and those of sessions whose sockets were closed without the session being removed
+    def expired(self, idleTimeout : float):
+        now = time.monotonic()
+        with self.lock:
+            idle = [sock for sock, session in self.bySocket.items() if idleTimeout and now - session.lastActive > idleTimeout]
+            dead = [sock for sock in self.bySocket if sock.fileno() == -1]
+        return idle, dead
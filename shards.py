@@ -0,0 +1,133 @@
+import os
+import pickle
+import socket
+import threading
+import zlib
+
+from utils import *
+import codec
+
+# Running a server as several shards: with the GIL, one server process only ever uses one core,
+# however many threads it runs. A server started with --shards N instead forks N worker processes
+# ("shards"), which all accept clients from the same listening socket (inherited from the parent).
+# Usernames are split between the shards by hash (see shardOf()), and each shard is a server of
+# its own for its users: it has its own state, operation log, and message spool, and replicates to
+# the same shard of the other servers (on its own internal port; see internalPort()).
+# The shards talk to each other over local (Unix domain) sockets, through a ShardLink to each other
+# shard: a request about a user another shard owns (a registration, a message for them, or part of
+# a search) is made to that shard as a call, and a connection logging in a user another shard owns
+# is handed off to it (the socket itself is passed along), since the owner of a user must also own
+# their connection to deliver messages to it.
+# Frames (see codec.py) on shard links carry pickled arguments and results; only shards of the
+# same server, on the same machine, ever connect to them.
+
+# frame codes on shard links: a call, its result, and a handed off client connection
+SHARD_CALL = 1
+SHARD_RESULT = 2
+SHARD_HANDOFF = 3
+# the longest frame on a shard link (search results can hold every username a shard owns)
+SHARD_FRAME_LIMIT = 1 << 26
+
+# the shard (out of the given number of shards) that owns a username; unlike hash(), this is the
+# same in every process
+def shardOf(username : str, numShards : int) -> int:
+    return zlib.crc32(bytes(username, 'ascii')) % numShards
+
+# the internal port a shard of a server (of the given partition; see partitions.py) listens on for
+# other servers, with each shard's ports following the last one of the previous shard
+def internalPort(server : int, shard : int, partition : int = 0) -> int:
+    return INTERNAL_SERVER_PORTS[server] + partition * PARTITION_PORT_STRIDE + shard * len(INTERNAL_SERVER_PORTS)
+
+# the path of the Unix domain socket a shard listens on for the other shards of its server, in the
+# given directory (the server's state directory)
+def linkPath(directory : str, serverId : int, shard : int, partition : int = 0) -> str:
+    return os.path.join(directory, f"server_{serverId}{f'.partition{partition}' if partition else ''}.shard{shard}.sock")
+
+# create the listening socket of a shard's links; this is done by the parent process before the
+# shards are forked, so that every link can be connected to as soon as any shard starts
+def listenForShards(path : str):
+    if os.path.exists(path):
+        os.remove(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(LISTEN_BACKLOG)
+    return sock
+
+# a link to another shard: calls are made over a small pool of connections that are kept open, so
+# concurrent calls don't wait for each other and don't connect each time
+class ShardLink:
+    def __init__(self, shard : int, path : str):
+        self.shard = shard
+        self.path = path
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock
+
+    # call the function registered under the given name on the other shard (see serveShardLinks()),
+    # returning its result; raises an OSError if the shard can't be reached
+    def call(self, name : str, *args):
+        with self.lock:
+            sock = self.idle.pop() if self.idle else None
+        if sock is None:
+            sock = self.connect()
+        try:
+            sock.sendall(codec.encodeFrame(SHARD_CALL, pickle.dumps((name, args))))
+            frame = codec.recvFrame(sock, SHARD_FRAME_LIMIT)
+            if frame is None:
+                raise ConnectionError(f"shard {self.shard} closed the link")
+        except:
+            sock.close()
+            raise
+        with self.lock:
+            self.idle.append(sock)
+        return pickle.loads(frame[1])
+
+    # hand a client connection off to the other shard, along with the given details (see
+    # serveShardLinks()); the connection can be closed here once this returns
+    def handOff(self, clientSocket, *details):
+        sock = self.connect()
+        try:
+            socket.send_fds(sock, [codec.encodeFrame(SHARD_HANDOFF, pickle.dumps(details))], [clientSocket.fileno()])
+        finally:
+            sock.close()
+
+# accept connections from the other shards on the given listening socket, serving each on its own
+# thread: calls are made to the given functions (a map of names to functions), and handed off
+# client connections are passed to adopt, along with the details they were handed off with
+def serveShardLinks(listenSock, functions : dict, adopt):
+    while True:
+        try:
+            sock, _ = listenSock.accept()
+        except OSError:
+            return
+        server = threading.Thread(target=serveShardLink, args=(sock, functions, adopt))
+        server.daemon = True
+        server.start()
+
+def serveShardLink(sock, functions : dict, adopt):
+    buffer, fds = bytearray(), []
+    try:
+        while True:
+            frame = codec.takeFrame(buffer, SHARD_FRAME_LIMIT)
+            if frame is None:
+                data, received, _, _ = socket.recv_fds(sock, RECV_CHUNK_SIZE, 1)
+                if not data:
+                    break
+                buffer += data
+                fds += received
+                continue
+            code, payload = frame
+            if code == SHARD_HANDOFF and fds:
+                adopt(socket.socket(fileno=fds.pop(0)), *pickle.loads(payload))
+            elif code == SHARD_CALL:
+                name, args = pickle.loads(payload)
+                sock.sendall(codec.encodeFrame(SHARD_RESULT, pickle.dumps(functions[name](*args))))
+    except (OSError, ValueError) as e:
+        print(f"shard link failed ({e})")
+    for fd in fds:
+        os.close(fd)
+    sock.close()
@@ -0,0 +1,287 @@
+import os
+import threading
+
+from utils import *
+import storage
+
+# Undelivered messages are kept on disk rather than in the server's state, in a spool with one file
+# (a mailbox) per recipient, so that memory use doesn't grow with the number of messages waiting for
+# users who haven't logged in: a mailbox is only read when its user logs in. A mailbox is a series
+# of records in the same format as the operation log (see storage.py), one for each buffered
+# message, carrying the sequence number of the send that buffered it. Messages are removed from the
+# front of a mailbox once the user acknowledges receiving them (see server.py), by appending a
+# record with the sequence number of the acknowledgement and the offset in the mailbox at which the
+# unacknowledged messages now start; readers skip straight to the last such offset. The mailbox is
+# only rewritten without the acknowledged messages (behind a marker record) once they take up more
+# than half of it, so that draining a mailbox a chunk at a time costs time proportional to its size
+# rather than rewriting it for every chunk.
+# Operations the primary applied but then failed to replicate are rolled back (see rollback()):
+# the records they appended are cut off the end of each mailbox. So that acknowledgements can be
+# rolled back too, a rewrite only removes the messages acknowledged before the latest one.
+# The operation log stays the source of truth for recent operations: spool writes aren't synced to
+# disk until the log is compacted (see sync()), and on startup the operations still in the log are
+# replayed into the spool, skipping any that a mailbox already reflects.
+
+# name of the file holding the spool's floor (see MessageSpool.floor)
+FLOOR_FILE = "floor"
+
+# the users whose mailboxes a state-changing operation affects (see MessageSpool.apply())
+def mailboxesOf(op : int, data : bytes) -> set:
+    if op == OP_SEND:
+        return {data.decode('ascii').split("|")[1]}
+    elif op == OP_SEND_BATCH:
+        return {recipient for recipient, _ in parseSendBatch(data.decode('ascii'))[1]}
+    elif op in { OP_LOGIN, OP_ACK_MESSAGES }:
+        return {data.decode('ascii').split("|")[0]}
+    return set()
+
+class MessageSpool:
+    def __init__(self, directory : str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        # the spool reflects every operation up to this sequence number; operations at or below
+        # the floor (which only rises when mailboxes are replaced wholesale, see replaceAll()) are
+        # never applied again
+        try:
+            with open(os.path.join(directory, FLOOR_FILE)) as f:
+                self.floor = int(f.read())
+        except FileNotFoundError:
+            self.floor = 0
+        self.lastSeq = self.floor
+        # mailboxes written to since the spool was last synced
+        self.dirty = set()
+        # mailboxes checked for a partially written record since the spool was opened (see repair())
+        self.checked = set()
+        # map of usernames to the offset in their mailbox at which the unacknowledged messages
+        # start, for the mailboxes read since the spool was opened (see startOf())
+        self.starts = {}
+
+    def mailboxPath(self, username : str) -> str:
+        # usernames are hex encoded, so that they're always valid and distinct file names (even on
+        # case-insensitive file systems)
+        return os.path.join(self.directory, username.encode('ascii').hex())
+
+    # the messages waiting in a user's mailbox (or the first limit of them), each formatted as
+    # <sender>|<message>
+    def load(self, username : str, limit : int = None):
+        with self.lock:
+            return self.readMessages(username, limit)
+
+    # the caller should hold self.lock
+    def readMessages(self, username : str, limit : int = None):
+        messages = []
+        for _, op, _, data in storage.readRecords(self.mailboxPath(username), self.startOf(username)):
+            if limit is not None and len(messages) >= limit:
+                break
+            if op == OP_SEND:
+                messages.append(data.decode('ascii'))
+        return messages
+
+    # drop a partially written record from the end of a mailbox (left by a crash in the middle of
+    # an append), so that later appends aren't hidden behind it; the caller should hold self.lock
+    def repair(self, username : str):
+        if username in self.checked:
+            return
+        self.checked.add(username)
+        path = self.mailboxPath(username)
+        if not os.path.exists(path):
+            return
+        size = sum(storage.RECORD_HEADER.size + len(data) + storage.RECORD_CHECKSUM.size
+                   for _, _, _, data in storage.readRecords(path))
+        if size < os.path.getsize(path):
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+
+    # the offset in a user's mailbox at which the unacknowledged messages start: the one carried by
+    # the last acknowledgement record, or 0 if there's none (an acknowledgement record with no offset
+    # marks where the acknowledged messages were removed). Found by reading the whole mailbox the
+    # first time, and kept up to date from then on; the caller should hold self.lock
+    def startOf(self, username : str) -> int:
+        if username not in self.starts:
+            start = 0
+            for _, op, _, data in storage.readRecords(self.mailboxPath(username)):
+                if op == OP_ACK_MESSAGES and data:
+                    start = int.from_bytes(data, "big")
+            self.starts[username] = start
+        return self.starts[username]
+
+    # replace a mailbox with the given records, atomically; the caller should hold self.lock
+    def writeMailbox(self, username : str, records):
+        path = self.mailboxPath(username)
+        with open(path + ".tmp", 'wb') as f:
+            for record in records:
+                f.write(record)
+        os.replace(path + ".tmp", path)
+        self.checked.add(username)
+        self.dirty.add(username)
+        self.starts[username] = 0
+
+    # apply a state-changing operation with the given sequence number to the spool: buffered sends
+    # are appended to the recipient's mailbox (or for batch sends, each recipient's), and
+    # acknowledgements (with data <username>|<count>) remove the given number of messages from the
+    # front of the user's mailbox. Logins (which were logged before messages were acknowledged)
+    # empty the user's mailbox and return the messages that were in it. Other operations don't
+    # affect the spool. If a set of mailboxes is given, batch sends only affect those
+    def apply(self, seq : int, op : int, timestamp : float, data : bytes, mailboxes : set = None):
+        with self.lock:
+            if seq <= self.floor:
+                return None
+            self.lastSeq = max(self.lastSeq, seq)
+            if op == OP_SEND:
+                sender, recipient, message = data.decode('ascii').split("|")
+                self.appendMessage(seq, timestamp, sender, recipient, message)
+            elif op == OP_SEND_BATCH:
+                sender, deliveries = parseSendBatch(data.decode('ascii'))
+                for recipient, message in deliveries:
+                    if mailboxes is None or recipient in mailboxes:
+                        self.appendMessage(seq, timestamp, sender, recipient, message)
+            elif op == OP_LOGIN:
+                username = data.decode('ascii')
+                messages = self.readMessages(username)
+                self.writeMailbox(username, [storage.encodeRecord(seq, OP_LOGIN, timestamp, b"")])
+                return messages
+            elif op == OP_ACK_MESSAGES:
+                username, count = data.decode('ascii').split("|")
+                self.repair(username)
+                self.dropMessages(username, int(count), seq, timestamp)
+            return None
+
+    # append a message to a mailbox; the caller should hold self.lock
+    def appendMessage(self, seq : int, timestamp : float, sender : str, recipient : str, message : str):
+        self.repair(recipient)
+        with open(self.mailboxPath(recipient), 'ab') as f:
+            f.write(storage.encodeRecord(seq, OP_SEND, timestamp, bytes(f"{sender}|{message}", 'ascii')))
+        self.dirty.add(recipient)
+
+    # append many messages (each formatted as <sender>|<message>) to a user's mailbox at once, as
+    # part of the operation with the given sequence number, e.g. when importing state
+    def appendMessages(self, seq : int, timestamp : float, username : str, messages):
+        with self.lock:
+            self.lastSeq = max(self.lastSeq, seq)
+            self.repair(username)
+            with open(self.mailboxPath(username), 'ab') as f:
+                for message in messages:
+                    f.write(storage.encodeRecord(seq, OP_SEND, timestamp, bytes(message, 'ascii')))
+            self.dirty.add(username)
+
+    # remove the first count unacknowledged messages from a mailbox, by appending an
+    # acknowledgement record with the offset just past them. The mailbox is first rewritten without
+    # the messages acknowledged before, if they take up more than half of it (behind a marker with
+    # the sequence number before this acknowledgement's, as the mailbox reflects every operation up
+    # to it); the caller should hold self.lock
+    def dropMessages(self, username : str, count : int, seq : int, timestamp : float):
+        path = self.mailboxPath(username)
+        start = self.startOf(username)
+        if start and 2 * start > os.path.getsize(path):
+            remaining = [storage.encodeRecord(*record) for record in storage.readRecords(path, start)
+                         if record[1] == OP_SEND]
+            self.writeMailbox(username, [storage.encodeRecord(seq - 1, OP_ACK_MESSAGES, timestamp, b"")] + remaining)
+            start = 0
+        offset = start
+        for _, op, _, data in storage.readRecords(path, start):
+            if count == 0:
+                break
+            offset += storage.recordSize(data)
+            if op == OP_SEND:
+                count -= 1
+                start = offset
+        with open(path, 'ab') as f:
+            f.write(storage.encodeRecord(seq, OP_ACK_MESSAGES, timestamp, start.to_bytes(8, "big")))
+        self.dirty.add(username)
+        self.starts[username] = start
+
+    # roll back the operations with the given sequence number and every one after it, which were
+    # applied to the given users' mailboxes: the records they appended are cut off each mailbox
+    def rollback(self, seq : int, usernames):
+        with self.lock:
+            for username in usernames:
+                self.repair(username)
+                path = self.mailboxPath(username)
+                offset = 0
+                for recordSeq, _, _, data in storage.readRecords(path):
+                    if recordSeq >= seq:
+                        with open(path, 'r+b') as f:
+                            f.truncate(offset)
+                        break
+                    offset += storage.recordSize(data)
+                self.starts.pop(username, None)
+                self.dirty.add(username)
+            self.lastSeq = min(self.lastSeq, seq - 1)
+
+    # on startup, apply the operations still in the log (as (seq, op, timestamp, data) tuples) that
+    # the spool doesn't reflect yet: an operation is skipped for each mailbox it affects that already
+    # has a record with the same or a later sequence number
+    def replay(self, records):
+        lastSeqs = {}
+        for seq, op, timestamp, data in records:
+            usernames = mailboxesOf(op, data)
+            if not usernames:
+                continue
+            for username in usernames - lastSeqs.keys():
+                with self.lock:
+                    self.repair(username)
+                    lastSeqs[username] = max((record[0] for record in storage.readRecords(self.mailboxPath(username))), default=0)
+            behind = {username for username in usernames if seq > lastSeqs[username]}
+            if behind:
+                self.apply(seq, op, timestamp, data, behind)
+                for username in behind:
+                    lastSeqs[username] = seq
+
+    # sync every mailbox written since the last sync to disk; done before the log is compacted,
+    # since the log can then no longer be replayed into the spool
+    def sync(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        for username in dirty:
+            try:
+                with open(self.mailboxPath(username), 'rb') as f:
+                    os.fsync(f.fileno())
+            except FileNotFoundError:
+                pass
+        # make sure newly created mailboxes are durable too
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # every non-empty mailbox, as a dictionary mapping usernames to their messages, along with the
+    # sequence number of the last operation reflected; used to send the whole spool to another
+    # server that's too far behind to catch up from the log
+    def export(self):
+        with self.lock:
+            return dict(self.mailboxes()), self.lastSeq
+
+    # generate the (username, messages) pairs of every non-empty mailbox, one mailbox at a time;
+    # the caller should hold self.lock
+    def mailboxes(self):
+        for name in sorted(os.listdir(self.directory)):
+            if name == FLOOR_FILE or name.endswith(".tmp"):
+                continue
+            username = bytes.fromhex(name).decode('ascii')
+            messages = self.readMessages(username)
+            if messages:
+                yield username, messages
+
+    # replace every mailbox with the given ones (as returned by export()), which reflect every
+    # operation up to the given sequence number
+    def replaceAll(self, mailboxes : dict, seq : int):
+        with self.lock:
+            for name in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, name))
+            self.checked.clear()
+            self.dirty.clear()
+            self.starts.clear()
+            for username, messages in mailboxes.items():
+                self.writeMailbox(username, [storage.encodeRecord(seq, OP_SEND, 0, bytes(message, 'ascii'))
+                                             for message in messages])
+            self.floor = self.lastSeq = seq
+        # the new mailboxes are durable before the floor is
+        self.sync()
+        floorPath = os.path.join(self.directory, FLOOR_FILE)
+        with open(floorPath + ".tmp", 'w') as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(floorPath + ".tmp", floorPath)
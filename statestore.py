@@ -0,0 +1,133 @@
+import threading
+from contextlib import ExitStack
+
+from utils import *
+from sessions import SessionRegistry
+
+# The server's in-memory state: the persisted state (the registered users, and the sequence number
+# and timestamp of the last update; see server.empty_server_state()), the client connections and
+# which users are logged in on them (see sessions.py), and which of those users are waiting to
+# acknowledge a chunk of unread messages.
+# Requests from many clients read and change it at once, and most requests first check the state
+# and then act on what they found (e.g. register a username if it isn't taken yet, or buffer a
+# message if its recipient isn't logged in), so each check and action has to happen as one atomic
+# step. Rather than one lock over the whole state, which every request would wait on, each user is
+# covered by one of a fixed number of lock stripes (picked by hashing the username): requests about
+# different users almost always take different locks, and requests about the same user are
+# serialized. Callers that need several steps to be atomic (e.g. logging a user in and delivering
+# their unread messages, before a message sent to them in the meantime is buffered) hold the
+# user's stripe across them with lockFor(); the stripes are reentrant, so the methods below can be
+# called while holding it.
+# Updates applied on a replica (and states installed from another server) don't take the stripes:
+# they're applied one at a time under the log lock, while the replica may be serving reads over
+# read-only sessions. Those reads never check and act on the state in several steps: each one is a
+# single lookup that's atomic by itself (a membership test on the registered users or on the users
+# the primary reported logged in, or a copy of a set), or goes through the username index, which
+# has a lock of its own, so a reader sees the state either before or after each update.
+
+class StateStore:
+    def __init__(self, state : dict, numStripes : int = STATE_LOCK_STRIPES):
+        self.state = state
+        self.stripes = [threading.RLock() for _ in range(numStripes)]
+        # the client connections, and the users logged in on them
+        self.sessions = SessionRegistry()
+        # map of logged in usernames to the number of unread messages in the chunk last delivered
+        # to them, while waiting for them to acknowledge it
+        self.pendingDeliveries = {}
+        # called with a username and whether the user is now logged in whenever a user logs in or
+        # out, while holding the user's lock (so calls about a user are made in order)
+        self.onPresence = None
+
+    # the lock covering a user
+    def lockFor(self, username : str):
+        return self.stripes[hash(username) % len(self.stripes)]
+
+    # a context manager holding the locks covering several users at once; stripes are always taken
+    # in the same order, so two callers locking overlapping sets of users can't deadlock
+    def locked(self, usernames):
+        stack = ExitStack()
+        for i in sorted({hash(username) % len(self.stripes) for username in usernames}):
+            stack.enter_context(self.stripes[i])
+        return stack
+
+    # replace the persisted state, e.g. after loading it from disk or installing a snapshot
+    def replace(self, state : dict):
+        self.state = state
+
+    def isRegistered(self, username : str) -> bool:
+        return username in self.state["registeredUsers"]
+
+    # a copy of the set of registered users (copying a set is atomic, so no locks are needed)
+    def users(self) -> set:
+        return set(self.state["registeredUsers"])
+
+    # a copy of the persisted state that's safe to save while requests keep changing it
+    def snapshot(self) -> dict:
+        state = dict(self.state)
+        state["registeredUsers"] = self.users()
+        return state
+
+    # register a user unless the username is taken, returning whether it was registered
+    def registerIfAbsent(self, username : str) -> bool:
+        with self.lockFor(username):
+            if username in self.state["registeredUsers"]:
+                return False
+            self.state["registeredUsers"].add(username)
+            return True
+
+    # remove a registered user
+    def unregister(self, username : str):
+        with self.lockFor(username):
+            self.state["registeredUsers"].discard(username)
+
+    # the socket a user is logged in on, or None if they aren't logged in
+    def sessionOf(self, username : str):
+        return self.sessions.socketOf(username)
+
+    # log a registered user in on a socket unless they're already logged in, returning whether
+    # they were logged in
+    def login(self, username : str, sock) -> bool:
+        with self.lockFor(username):
+            if username not in self.state["registeredUsers"] or not self.sessions.bind(username, sock):
+                return False
+            if self.onPresence is not None:
+                self.onPresence(username, True)
+            return True
+
+    # log a user out if they're logged in on the given socket, returning whether they were; any
+    # chunk of unread messages they haven't acknowledged yet is delivered again on their next login
+    def logout(self, username : str, sock) -> bool:
+        with self.lockFor(username):
+            if not self.sessions.unbind(username, sock):
+                return False
+            self.pendingDeliveries.pop(username, None)
+            if self.onPresence is not None:
+                self.onPresence(username, False)
+            return True
+
+    # forget a connection that has ended, logging out the users logged in on it, whose usernames
+    # are returned
+    def closeSession(self, sock):
+        usernames = self.sessions.usersOf(sock)
+        for username in usernames:
+            self.logout(username, sock)
+        self.sessions.close(sock)
+        return usernames
+
+    # record that a chunk of the given number of unread messages was delivered to a user, unless a
+    # chunk is already waiting to be acknowledged, returning whether it was recorded
+    def beginDelivery(self, username : str, numMessages : int) -> bool:
+        with self.lockFor(username):
+            if username in self.pendingDeliveries:
+                return False
+            self.pendingDeliveries[username] = numMessages
+            return True
+
+    # the number of unread messages in the chunk a user hasn't acknowledged yet, or None
+    def pendingDelivery(self, username : str):
+        return self.pendingDeliveries.get(username)
+
+    # record that a user acknowledged the chunk delivered to them
+    def endDelivery(self, username : str):
+        with self.lockFor(username):
+            self.pendingDeliveries.pop(username, None)
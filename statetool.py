@@ -0,0 +1,107 @@
+import argparse
+import sys
+import time
+
+from utils import *
+import server
+
+# An offline tool for moving a server's state in and out in bulk, e.g. to provision the users of a
+# new tenant, or to back up, restore, or migrate a server's state. Registering thousands of users
+# one OP_REGISTER request at a time costs a logged and replicated update each; instead, the tool
+# streams the registered users and undelivered messages to or from a line-oriented format, and
+# loads an import straight into the server's persisted state (a fresh snapshot, and the mailboxes
+# of the message spool) as a single update. The username index is rebuilt from the snapshot when
+# the server starts. Only run the tool while the server is stopped.
+# The format has one record per line: "user <username>" for each registered user, and
+# "message <sender>|<recipient>|<message>" for each undelivered message (the same form as the data
+# of a send request), in the order they're to be delivered. Blank lines and lines starting with #
+# are ignored. Messages can only be imported for users that are registered by then, so exports
+# list every user before any message.
+
+# number of imported messages held in memory before they're written to the spool
+IMPORT_FLUSH_MESSAGES = 10000
+
+# write a state and the undelivered messages in a message spool to a (text) file, one mailbox at
+# a time; returns the number of users and messages written
+def exportState(state : dict, spool, out):
+    numMessages = 0
+    for username in sorted(state["registeredUsers"]):
+        out.write(f"user {username}\n")
+    with spool.lock:
+        for recipient, messages in spool.mailboxes():
+            for message in messages:
+                sender, body = message.split("|")
+                out.write(f"message {formatMessage(sender, recipient, body)}\n")
+                numMessages += 1
+    return len(state["registeredUsers"]), numMessages
+
+# read users and undelivered messages from lines in the format above into a state and a message
+# spool, as part of the operation with the given sequence number; returns the number of users and
+# messages read. Raises a ValueError naming the line of any malformed record
+def importState(lines, state : dict, spool, seq : int, timestamp : float):
+    numUsers, numMessages = 0, 0
+    # messages waiting to be written, by recipient
+    pending, numPending = {}, 0
+
+    def flush():
+        for recipient, messages in pending.items():
+            spool.appendMessages(seq, timestamp, recipient, messages)
+        pending.clear()
+
+    for lineNumber, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        kind, _, record = line.partition(" ")
+        if kind == "user" and isValidUsername(record):
+            if record not in state["registeredUsers"]:
+                state["registeredUsers"].add(record)
+                numUsers += 1
+        elif kind == "message" and record.count("|") == 2:
+            sender, recipient, message = record.split("|")
+            if not isValidUsername(sender) or not isValidMessage(message) or recipient not in state["registeredUsers"]:
+                raise ValueError(f"line {lineNumber}: bad message, or message for an unregistered user")
+            pending.setdefault(recipient, []).append(f"{sender}|{message}")
+            numMessages += 1
+            numPending += 1
+            if numPending >= IMPORT_FLUSH_MESSAGES:
+                flush()
+                numPending = 0
+        else:
+            raise ValueError(f"line {lineNumber}: bad record {line!r}")
+    flush()
+    return numUsers, numMessages
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="import or export a stopped server's users and undelivered messages")
+    parser.add_argument("command", choices=["import", "export"])
+    parser.add_argument("id", type=int, choices=range(MAX_REPLICAS), help="server ID")
+    parser.add_argument("file", nargs="?", default="-", help="file to read or write (default: standard input/output)")
+    parser.add_argument("--partition", type=int, default=0, help="the partition the server serves (see partitions.py)")
+    args = parser.parse_args()
+
+    server.SERVER_ID = args.id
+    server.PARTITION = args.partition
+    # the tool's progress goes to standard error, so that exports can be written to standard output
+    sys.stdout, out = sys.stderr, sys.stdout
+    server.load_server_state()
+    start = time.time()
+    if args.command == "export":
+        f = out if args.file == "-" else open(args.file, 'w')
+        numUsers, numMessages = exportState(server.store.state, server.open_message_spool(), f)
+        f.close()
+        print(f"exported {numUsers} users and {numMessages} messages in {time.time() - start:.1f}s")
+    else:
+        f = sys.stdin if args.file == "-" else open(args.file)
+        # the whole import is a single update, which other servers catch up on like any other
+        seq = server.store.state["lastSeq"] + 1
+        timestamp = time.time()
+        try:
+            numUsers, numMessages = importState(f, server.store.state, server.open_message_spool(), seq, timestamp)
+        except ValueError as e:
+            print(f"import failed, nothing was saved ({e})")
+            sys.exit(1)
+        server.store.state["lastSeq"], server.store.state["timestamp"] = seq, timestamp
+        server.save_server_state()
+        print(f"imported {numUsers} users and {numMessages} messages in {time.time() - start:.1f}s, now at update {seq}")
+    server.close_server_state()
@@ -0,0 +1,281 @@
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+from utils import *
+
+# The server's state is persisted as a snapshot (a pickle of the whole state dictionary) plus an
+# append-only log of the state-changing operations applied since that snapshot was taken. Log
+# records have the same types as the updates the primary sends to its replicas (registers, logins,
+# buffered sends, and deletes), so writing one costs the same no matter how big the state is. On
+# startup the log is replayed over the last snapshot to recover the state.
+# The log is split into numbered segment files. To compact it, the log is rotated to a new segment,
+# and a new snapshot is built in the background from the old snapshot and the sealed segments
+# (never from the live state, so that request handling isn't held up), after which the sealed
+# segments can be deleted.
+# Appends are group committed: records from many concurrent client threads are collected by a
+# flusher thread and written to disk together, according to the log's durability policy, and each
+# appending thread waits only until the batch containing its record is durable.
+
+# each log record is a fixed-size header, followed by the operation-specific data (the same data
+# that a client sends for the operation), followed by a checksum of the header and data:
+# <1-byte opcode><8-byte sequence number><8-byte timestamp><2-byte data length><data><4-byte CRC>
+RECORD_HEADER = struct.Struct(">BQdH")
+RECORD_CHECKSUM = struct.Struct(">I")
+
+# encode a single log record as bytes
+def encodeRecord(seq : int, op : int, timestamp : float, data : bytes) -> bytes:
+    record = RECORD_HEADER.pack(op, seq, timestamp, len(data)) + data
+    return record + RECORD_CHECKSUM.pack(zlib.crc32(record))
+
+# the number of bytes a record with the given data takes up in a file
+def recordSize(data : bytes) -> int:
+    return RECORD_HEADER.size + len(data) + RECORD_CHECKSUM.size
+
+# decode a single complete record, returning a (seq, op, timestamp, data) tuple, or None if the
+# record is corrupted
+def decodeRecord(record : bytes):
+    op, seq, timestamp, length = RECORD_HEADER.unpack_from(record)
+    end = RECORD_HEADER.size + length
+    if len(record) != end + RECORD_CHECKSUM.size:
+        return None
+    if RECORD_CHECKSUM.unpack_from(record, end)[0] != zlib.crc32(record[:end]):
+        return None
+    return seq, op, timestamp, record[RECORD_HEADER.size:end]
+
+# marks the point in the pending records where the flusher should move on to a new segment
+ROTATE = None
+
+# path of a numbered segment of the log with the given path
+def segmentPath(path : str, segment : int) -> str:
+    return f"{path}.{segment:08d}"
+
+# list the numbers of the existing segments of the log with the given path, in order
+def logSegments(path : str):
+    directory, prefix = os.path.split(path + ".")
+    try:
+        names = os.listdir(directory or ".")
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[len(prefix):]) for name in names
+                  if name.startswith(prefix) and name[len(prefix):].isdigit())
+
+# read every complete record from every segment of a log (up to and including the given segment, if
+# any), in order
+def readLog(path : str, lastSegment : int = None):
+    for segment in logSegments(path):
+        if lastSegment is not None and segment > lastSegment:
+            return
+        yield from readRecords(segmentPath(path, segment))
+
+# read every complete record from a log file, yielding (seq, op, timestamp, data) tuples in the
+# order they were written; a record that was only partially written (e.g. because the server
+# crashed in the middle of an append) and anything after it is ignored. Records are read one at a
+# time, so a caller that only needs the first few never reads the whole file, and reading can start
+# at the given offset (which should be where a record starts)
+def readRecords(path : str, offset : int = 0):
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        f.seek(offset)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            op, seq, timestamp, length = RECORD_HEADER.unpack(header)
+            rest = f.read(length + RECORD_CHECKSUM.size)
+            if len(rest) < length + RECORD_CHECKSUM.size:
+                return
+            (checksum,) = RECORD_CHECKSUM.unpack_from(rest, length)
+            if checksum != zlib.crc32(header + rest[:length]):
+                return
+            yield seq, op, timestamp, rest[:length]
+
+# a batch of appended records that are written to disk together; threads that appended records to
+# the batch wait on it until it's durable
+class Commit:
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+    # block until the batch is durable, raising an error if it couldn't be written
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+    def finish(self, error=None):
+        self.error = error
+        self.done.set()
+
+# an append-only, segmented log with group commit: append() queues a record and returns the Commit
+# of the batch it belongs to, and a flusher thread writes out and syncs each batch to the current
+# segment under the given durability policy (see utils.py)
+class OperationLog:
+    def __init__(self, path : str, policy : str = FSYNC_POLICY, intervalMs : int = FSYNC_INTERVAL_MS):
+        self.path = path
+        self.policy = policy
+        self.interval = intervalMs / 1000
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # continue appending to the latest segment
+        self.segment = max(logSegments(path), default=0)
+        self.file = open(segmentPath(path, self.segment), 'ab')
+        # the segment that newly appended records will end up in (ahead of self.segment, the one
+        # being written, while rotations are pending)
+        self.appendSegment = self.segment
+        # number of records appended since the log was last rotated
+        self.numRecords = 0
+        # records appended since the last flush, and the commit they'll be acknowledged through
+        self.pending = []
+        self.batch = Commit()
+        # the batch the flusher is currently writing, if any
+        self.flushing = None
+        self.closed = False
+        # number of batches written so far
+        self.numFlushes = 0
+        # protects the pending batch; held by appending threads only briefly
+        self.cond = threading.Condition()
+        # held by the flusher while writing a batch, so that the file isn't truncated underneath it
+        self.fileLock = threading.Lock()
+        self.flusher = threading.Thread(target=self.flushBatches)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def append(self, seq : int, op : int, timestamp : float, data : bytes) -> Commit:
+        return self.appendRecord(encodeRecord(seq, op, timestamp, data))
+
+    # append a record that's already encoded (see encodeRecord())
+    def appendRecord(self, record : bytes) -> Commit:
+        with self.cond:
+            if self.closed:
+                raise ValueError("operation log is closed")
+            self.pending.append(record)
+            self.numRecords += 1
+            self.cond.notify()
+            return self.batch
+
+    # seal the current segment: records appended from now on go to a new segment. Returns the
+    # number of the sealed segment, and the Commit after which it's completely written to disk
+    def rotate(self):
+        with self.cond:
+            self.pending.append(ROTATE)
+            self.numRecords = 0
+            self.appendSegment += 1
+            self.cond.notify()
+            return self.appendSegment - 1, self.batch
+
+    # delete every segment up to and including the given one (once they're covered by a snapshot)
+    def removeSegments(self, lastSegment : int):
+        for segment in logSegments(self.path):
+            if segment <= lastSegment:
+                os.remove(segmentPath(self.path, segment))
+
+    # the flusher thread: repeatedly take every pending record and write them out in one batch
+    def flushBatches(self):
+        lastFlush = 0
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+            # on a timer, let records accumulate until the interval since the last flush is up
+            if self.policy == FSYNC_INTERVAL:
+                time.sleep(max(0, lastFlush + self.interval - time.monotonic()))
+            with self.cond:
+                records, batch = self.pending, self.batch
+                self.pending, self.batch = [], Commit()
+                self.flushing = batch
+            error = None
+            with self.fileLock:
+                try:
+                    # write out the records up to each rotation, then move on to the next segment
+                    start = 0
+                    for i, record in enumerate(records + [ROTATE]):
+                        if record is not ROTATE:
+                            continue
+                        self.file.write(b"".join(records[start:i]))
+                        self.file.flush()
+                        if self.policy != FSYNC_OS:
+                            os.fsync(self.file.fileno())
+                        if i < len(records):
+                            self.file.close()
+                            self.segment += 1
+                            self.file = open(segmentPath(self.path, self.segment), 'ab')
+                        start = i + 1
+                    self.numFlushes += 1
+                except Exception as e:
+                    error = e
+            lastFlush = time.monotonic()
+            batch.finish(error)
+
+    # wait until every record appended so far is durable
+    def sync(self):
+        with self.cond:
+            batches = [self.flushing, self.batch if self.pending else None]
+        for batch in batches:
+            if batch is not None:
+                batch.wait()
+
+    # discard every record in the log (once they're all covered by a snapshot)
+    def truncate(self):
+        self.sync()
+        with self.fileLock:
+            self.file.truncate(0)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.removeSegments(self.segment - 1)
+
+    # discard the record with the given sequence number and every one after it (once they've been
+    # rolled back), returning whether that was possible: they have to all be in the segment being
+    # written, and the caller should hold the lock that orders appends, so none are appended meanwhile
+    def truncateFrom(self, seq : int) -> bool:
+        self.sync()
+        with self.fileLock:
+            if self.appendSegment != self.segment:
+                return False
+            path = segmentPath(self.path, self.segment)
+            offset = 0
+            for recordSeq, _, _, data in readRecords(path):
+                if recordSeq >= seq:
+                    # records before this segment's first one may be rolled back too
+                    if offset == 0 and logSegments(self.path)[0] < self.segment:
+                        return False
+                    self.file.truncate(offset)
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                    return True
+                offset += recordSize(data)
+            return False
+
+    # write out any pending records and stop the flusher
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.flusher.join()
+        self.file.close()
+
+# load a snapshot of the state, returning None if there isn't one
+def loadSnapshot(path : str):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+# write a snapshot of the state; the snapshot is written to a temporary file first and then moved
+# into place, so a crash while writing never leaves a corrupted snapshot behind
+def saveSnapshot(path : str, state : dict):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmpPath = path + ".tmp"
+    with open(tmpPath, 'wb') as f:
+        pickle.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpPath, path)
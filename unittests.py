@@ -6,12 +6,44 @@ import socket
 import time
 import pickle
 import os
+import shutil
+import io
+import tempfile
 
 import sys 
+import server
+import storage
+import replication
+import codec
+import statetool
+from search import UsernameIndex
+from spool import MessageSpool
+from outbox import Outbox, WritePoller
+from statestore import StateStore
+import shards
+import client
+from partitions import PartitionMap, PartitionLink, parsePartitionMap
+from leases import Lease, ShardLease
+from concurrent.futures import ThreadPoolExecutor
 from server import service_connection
 
 SPEEDTEST = False
 TEST_SOCKET_SERVER_ADDR = ("localhost", 55566)
+TEST_EVENT_LOOP_SERVER_ADDR = ("localhost", 55567)
+# the tests keep every file they write (the test servers' state included) in a directory of their
+# own, which is removed once they're done
+TEST_STATE_DIR = tempfile.mkdtemp()
+server.STATE_DIRECTORY = TEST_STATE_DIR
+# the test servers run alone, as a server given only its own host would, so their updates are
+# committed without waiting for any replicas
+server.WRITE_QUORUM = 1
+
+def tearDownModule():
+    shutil.rmtree(TEST_STATE_DIR, ignore_errors=True)
+
+# the path of a file or directory in the tests' state directory
+def statePath(name):
+    return os.path.join(TEST_STATE_DIR, name)
 
 serverState = {
     "timestamp": 0,
@@ -19,10 +51,16 @@ serverState = {
     "messageBuffer": defaultdict(list),
 }
 
-def startTestSocketServer():
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(TEST_SOCKET_SERVER_ADDR)
-    sock.listen(2)
+# remove the test server's persisted state (its snapshot, operation log, and message spool)
+def cleanUpState():
+    server.close_server_state()
+    paths = [storage.segmentPath(server.log_path(), segment) for segment in storage.logSegments(server.log_path())]
+    for path in paths + [server.snapshot_path()]:
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(server.spool_path(), ignore_errors=True)
+
+def startTestSocketServer(sock):
     c, _ = sock.accept()
     service_connection(c)
 
@@ -32,7 +70,11 @@ class TestUtils(unittest.TestCase):
     def setUpClass(cls):
         start = time.time()
         
-        testServer = threading.Thread(target=startTestSocketServer)
+        # listen before starting the server thread, so that connecting can't race it
+        serverSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        serverSock.bind(TEST_SOCKET_SERVER_ADDR)
+        serverSock.listen(2)
+        testServer = threading.Thread(target=startTestSocketServer, args=(serverSock,))
         testServer.daemon = True
         testServer.start()
         cls.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -149,7 +191,8 @@ class TestUtils(unittest.TestCase):
         numResults = self.sock.recv(MSG_HEADER_LENGTH)
         numResults = int.from_bytes(numResults, "big")
         self.assertTrue(numResults == 1)
-        results = self.sock.recv(USERNAME_LENGTH + DELIMITER_LENGTH).decode('ascii')
+        pageLength = int.from_bytes(self.sock.recv(MSG_HEADER_LENGTH), "big")
+        results = self.sock.recv(pageLength).decode('ascii')
         self.assertTrue(results == "foo")
         
         opcode, messageBody = OP_SEARCH, "noresults"
@@ -216,9 +259,17 @@ class TestUtils(unittest.TestCase):
         numMessages = self.sock.recv(MSG_HEADER_LENGTH)
         numMessages = int.from_bytes(numMessages, "big")
         self.assertTrue(numMessages == 1)
-        messages = self.sock.recv(MESSAGE_LENGTH + USERNAME_LENGTH + 2 * DELIMITER_LENGTH).decode("ascii")
+        chunkLength = int.from_bytes(self.sock.recv(MSG_HEADER_LENGTH), "big")
+        messages = self.sock.recv(chunkLength).decode("ascii")
         self.assertTrue(messages == "bar|test2")
         
+        # acknowledge the unread messages, which clears them from the mailbox
+        opcode, messageBody = OP_ACK_MESSAGES, "foo"
+        self.sock.sendall(opcode.to_bytes(CODE_LENGTH, "big") + bytes(messageBody, 'ascii'))
+        code = self.sock.recv(CODE_LENGTH)
+        code = int.from_bytes(code, "big")
+        self.assertTrue(code == ACK_OK)
+        
         opcode, messageBody = OP_SEND, "foo|bar|test3"
         self.sock.sendall(opcode.to_bytes(CODE_LENGTH, "big") + bytes(messageBody, 'ascii'))
         code = self.sock.recv(CODE_LENGTH)
@@ -243,9 +294,7 @@ class TestUtils(unittest.TestCase):
             print(f"socket 100 registers time: {end - start}")
         
         # clean up state
-        os.remove("state/server_-1.pickle")
-        # give system enough time to delete the file
-        time.sleep(0.1)
+        cleanUpState()
     
     # testing functionality added in programming project 3
     def testPersistence(self):
@@ -269,60 +318,1375 @@ class TestUtils(unittest.TestCase):
         
         # give server enough time to write state to file
         time.sleep(0.3)
-        with open(f"state/server_-1.pickle", 'rb') as f:
-            serverState = pickle.load(f)
+        serverState = server.recover_server_state()
         
         self.assertEqual(serverState["registeredUsers"], {"charu", "eric"})
-        self.assertEqual(serverState["messageBuffer"]["charu"], [])
-        self.assertEqual(serverState["messageBuffer"]["eric"], ["charu|hello!"])
+        # the undelivered message is in eric's mailbox in the spool, not in the state
+        self.assertNotIn("messageBuffer", serverState)
+        self.assertEqual(MessageSpool(server.spool_path()).load("charu"), [])
+        self.assertEqual(MessageSpool(server.spool_path()).load("eric"), ["charu|hello!"])
+        
+        # the operations were appended to the log, without a snapshot of the whole state
+        ops = [op for _, op, _, _ in storage.readLog(server.log_path())]
+        self.assertEqual(ops, [OP_REGISTER, OP_REGISTER, OP_SEND])
+        self.assertFalse(os.path.exists(server.snapshot_path()))
 
         # clean up state
-        os.remove("state/server_-1.pickle")
+        cleanUpState()
 
         # receive all communications from before (cleanup)
         self.sock.recv(2048)
     
     def testPrimaryReplicaCommunication(self):
-        testServerSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        testServerSock.bind(("localhost", 22072))
-        testServerSock.settimeout(1.0)
+        # act as a replica: the primary connects to us and we report the last update we applied
+        testServerSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        testServerSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        testServerSock.bind(("localhost", INTERNAL_SERVER_PORTS[-1]))
+        testServerSock.listen()
+        testServerSock.settimeout(5.0)
+        channel = server.start_replica_channels()[0]
+        replicaSock, _ = testServerSock.accept()
+        self.assertEqual(replication.recvChannelFrame(replicaSock), (CHANNEL_REPLICATE, b""))
+        # we're already up to date, so there's nothing to catch up on
+        replicaSock.sendall(replication.formatSeq(server.store.state["lastSeq"]))
+        replicaSock.settimeout(1.0)
+        while not channel.live:
+            time.sleep(0.01)
+        
+        # every state-changing operation is streamed to the replica, and acknowledged by it (records
+        # that aren't updates, such as who's logged in, aren't acknowledged)
+        def receiveUpdate():
+            seq, op, _, data = replication.recvRecord(replicaSock)
+            while seq == UNSEQUENCED:
+                seq, op, _, data = replication.recvRecord(replicaSock)
+            replicaSock.sendall(replication.formatSeq(seq))
+            return op, data
 
         opcode, messageBody = OP_REGISTER, "charu2"
         self.sock.sendall(opcode.to_bytes(CODE_LENGTH, "big") + bytes(messageBody, 'ascii'))
-        data, _ = testServerSock.recvfrom(1024)
-        self.assertEquals(data[0], OP_REGISTER)
+        self.assertEqual(receiveUpdate(), (OP_REGISTER, b"charu2"))
+        self.assertEqual(int.from_bytes(self.sock.recv(CODE_LENGTH), "big"), REGISTER_OK)
         
         opcode, messageBody = OP_REGISTER, "eric2"
         self.sock.sendall(opcode.to_bytes(CODE_LENGTH, "big") + bytes(messageBody, 'ascii'))
-        data, _ = testServerSock.recvfrom(1024)
-        time.sleep(0.1)
+        self.assertEqual(receiveUpdate(), (OP_REGISTER, b"eric2"))
+        self.assertEqual(int.from_bytes(self.sock.recv(CODE_LENGTH), "big"), REGISTER_OK)
 
-        # login as charu and send a message to eric (who is not logged in)
+        # login as charu and send a message to eric (who is not logged in); logging in without
+        # unread messages doesn't change the state
         opcode, messageBody = OP_LOGIN, "charu2"
         self.sock.sendall(opcode.to_bytes(CODE_LENGTH, "big") + bytes(messageBody, 'ascii'))
-        data, _ = testServerSock.recvfrom(1024)
-        self.assertEquals(data[0], OP_LOGIN)
+        self.assertEqual(int.from_bytes(self.sock.recv(CODE_LENGTH), "big"), LOGIN_OK_NO_UNREAD_MSG)
 
         opcode, messageBody = OP_SEND, "charu2|eric2|hello!"
         self.sock.sendall(opcode.to_bytes(CODE_LENGTH, "big") + bytes(messageBody, 'ascii'))
-        data, _ = testServerSock.recvfrom(1024)
-        self.assertEquals(data[0], OP_SEND)
+        self.assertEqual(receiveUpdate(), (OP_SEND, b"charu2|eric2|hello!"))
+        self.assertEqual(int.from_bytes(self.sock.recv(CODE_LENGTH), "big"), SEND_OK_BUFFERED)
 
         # this is NOT a state-changing operation and thus should not be communicated
         opcode, messageBody = OP_SEARCH, "*"
+        self.sock.sendall(opcode.to_bytes(CODE_LENGTH, "big") + bytes(messageBody, 'ascii'))
 
         with self.assertRaises(socket.timeout):
-            testServerSock.recvfrom(1024)
+            replicaSock.recv(1024)
         
         # clean up state
-        os.remove("state/server_-1.pickle")
+        cleanUpState()
 
         # receive all communications from before (cleanup)
-        self.sock.recv(2048)
+        time.sleep(0.1)
+        self.sock.recv(8192)
 
         # close secondary server
+        replicaSock.close()
         testServerSock.close()
     
+    def testReplicaReceivesUpdates(self):
+        # act as the primary, streaming updates to a replica and waiting for its acknowledgements
+        primarySock, replicaSock = socket.socketpair()
+        applied = []
+        def applyUpdate(seq, op, timestamp, data):
+            applied.append((seq, op, data))
+            return None
+        receiver = threading.Thread(target=replication.receiveUpdates, args=(replicaSock, 4, applyUpdate, None))
+        receiver.daemon = True
+        receiver.start()
+        self.assertEqual(replication.recvSeq(primarySock), 4)
+        primarySock.sendall(storage.encodeRecord(5, OP_REGISTER, 1.0, b"a") + storage.encodeRecord(6, OP_DELETE, 2.0, b"a"))
+        acked = 0
+        while acked < 6:
+            acked = replication.recvSeq(primarySock)
+        self.assertEqual(applied, [(5, OP_REGISTER, b"a"), (6, OP_DELETE, b"a")])
+        primarySock.close()
+        receiver.join()
+    
+    def testMissedUpdates(self):
+        # a replica sent an update out of sequence drops the connection rather than skip the
+        # updates in between for good, so that it's caught up from its last update on reconnecting
+        lastSeq = server.store.state["lastSeq"]
+        primarySock, replicaSock = socket.socketpair()
+        receiver = threading.Thread(target=replication.receiveUpdates,
+                                    args=(replicaSock, lastSeq, server.apply_replicated_update, server.install_snapshot))
+        receiver.daemon = True
+        receiver.start()
+        self.assertEqual(replication.recvSeq(primarySock), lastSeq)
+        primarySock.sendall(storage.encodeRecord(lastSeq + 1, OP_REGISTER, 1.0, b"inorder")
+                            + storage.encodeRecord(lastSeq + 3, OP_REGISTER, 2.0, b"skipped"))
+        receiver.join(5)
+        self.assertFalse(receiver.is_alive())
+        # the update before the gap is still acknowledged
+        self.assertEqual(replication.recvSeq(primarySock), lastSeq + 1)
+        self.assertEqual(primarySock.recv(1), b"")
+        primarySock.close()
+        self.assertEqual(server.store.state["lastSeq"], lastSeq + 1)
+        self.assertTrue(server.store.isRegistered("inorder"))
+        self.assertFalse(server.store.isRegistered("skipped"))
+        with self.assertRaises(replication.MissedUpdates):
+            server.apply_replicated_update(lastSeq + 3, OP_REGISTER, 2.0, b"skipped")
+        server.usernameIndex.remove("inorder")
+        server.store.state["registeredUsers"].discard("inorder")
+        cleanUpState()
+    
+    def testWriteQuorum(self):
+        # stand-ins for the channels to the replicas, sharing a condition like real ones
+        class Channel:
+            def __init__(self, cond, live):
+                self.cond, self.live, self.ackedSeq = cond, live, 0
+        cond = threading.Condition()
+        fast, slow, dead = Channel(cond, True), Channel(cond, True), Channel(cond, False)
+        channels = [fast, slow, dead]
+        def ack(channel, seq, delay):
+            time.sleep(delay)
+            with cond:
+                channel.ackedSeq = seq
+                cond.notify_all()
+        
+        # a quorum only waits for the fastest replicas, not the slow one
+        threading.Thread(target=ack, args=(fast, 1, 0.05)).start()
+        start = time.monotonic()
+        self.assertTrue(replication.waitForQuorum(channels, 1, 1, start + 5))
+        self.assertLess(time.monotonic() - start, 1)
+        # the wait gives up as soon as the live replicas can't make up the quorum
+        self.assertFalse(replication.waitForQuorum(channels, 2, 3, time.monotonic() + 5))
+        self.assertLess(time.monotonic() - start, 1)
+        threading.Thread(target=ack, args=(slow, 2, 0.05)).start()
+        self.assertFalse(replication.waitForQuorum(channels, 2, 2, time.monotonic() + 0.2))
+        self.assertTrue(replication.waitForQuorum(channels, 1, 2, time.monotonic()))
+        self.assertTrue(replication.waitForQuorum(channels, 3, 0, time.monotonic()))
+    
+    def testUnreplicatedUpdates(self):
+        # stand-ins for the channels to the replicas, which either acknowledge the updates they're
+        # given (see update()) or don't
+        cond = threading.Condition()
+        class Channel:
+            def __init__(self, live, acks):
+                self.cond, self.live, self.acks, self.ackedSeq, self.rolledBack = cond, live, acks, 0, None
+            def rollBack(self, seq):
+                self.rolledBack = seq
+        def update(op, data, *channels):
+            seq, commit, _, epoch = server.append_update(op, data)
+            for channel in channels:
+                channel.ackedSeq = seq if channel.acks else seq - 1
+            return seq, commit, list(channels), epoch
+        quorum, allowPrimaryOnly = server.WRITE_QUORUM, server.ALLOW_PRIMARY_ONLY
+        try:
+            server.WRITE_QUORUM = 2
+            # an update is committed once a replica acknowledges it
+            server.store.registerIfAbsent("replicated")
+            self.assertTrue(server.await_update(update(OP_REGISTER, b"replicated", Channel(True, True), Channel(False, False))))
+            # but not if no live replica can acknowledge it, or none does in time
+            start = time.monotonic()
+            self.assertFalse(server.await_update(update(OP_REGISTER, b"nobody", Channel(False, False))))
+            self.assertFalse(server.await_update(update(OP_REGISTER, b"nobody")))
+            self.assertLess(time.monotonic() - start, REPLICATION_ACK_TIMEOUT)
+            slow = Channel(True, False)
+            self.assertFalse(server.await_update(update(OP_REGISTER, b"nobody", slow)))
+            self.assertGreaterEqual(time.monotonic() - start, REPLICATION_ACK_TIMEOUT)
+            # in which case the replicas are reset, as they may have applied it
+            self.assertEqual(slow.rolledBack, server.store.state["lastSeq"] + 1)
+            # unless updates may be committed on the primary alone
+            server.ALLOW_PRIMARY_ONLY = True
+            self.assertTrue(server.await_update(update(OP_SEND, b"sender|replicated|hello", Channel(False, False))))
+            self.assertTrue(server.record_update(OP_SEND, b"sender|replicated|again"))
+            server.ALLOW_PRIMARY_ONLY = False
+            
+            # a request whose update isn't committed fails, and the update is rolled back on the
+            # primary, rather than kept (the test server's replica is never reachable)
+            lastSeq = server.store.state["lastSeq"]
+            self.assertEqual(server.register_user("unreplicated"), UPDATE_NOT_REPLICATED)
+            self.assertFalse(server.store.isRegistered("unreplicated"))
+            self.assertNotIn("unreplicated", server.usernameIndex)
+            self.assertEqual(server.deliver_message("sender", "replicated", "lost", b"sender|replicated|lost"), UPDATE_NOT_REPLICATED)
+            self.assertFalse(server.record_update(OP_ACK_MESSAGES, b"replicated|2"))
+            self.assertEqual(server.open_message_spool().load("replicated"), ["sender|hello", "sender|again"])
+            self.assertEqual(server.store.state["lastSeq"], lastSeq)
+            server.close_server_state()
+            self.assertEqual(max(record[0] for record in storage.readLog(server.log_path())), lastSeq)
+            self.assertTrue(all(channel.diverged for channel in server.replicaChannels))
+            
+            # updates logged after one that's rolled back are rolled back with it, and their sequence
+            # numbers reused
+            first, second = update(OP_REGISTER, b"first"), update(OP_REGISTER, b"second")
+            self.assertFalse(server.await_update(first))
+            self.assertFalse(server.await_update(second))
+            reused = update(OP_REGISTER, b"reused", Channel(True, True))
+            self.assertEqual(reused[0], first[0])
+            self.assertTrue(server.await_update(reused))
+        finally:
+            server.WRITE_QUORUM, server.ALLOW_PRIMARY_ONLY = quorum, allowPrimaryOnly
+        server.usernameIndex.remove("replicated")
+        server.store.state["registeredUsers"].discard("replicated")
+        cleanUpState()
+    
+    def testCatchUp(self):
+        cleanUpState()
+        # catch up a server that has applied updates up to fromSeq, returning the updates and
+        # snapshots it receives
+        def catchUp(fromSeq, reset=False):
+            senderSock, receiverSock = socket.socketpair()
+            received, snapshots = [], []
+            def applyUpdate(seq, op, timestamp, data):
+                received.append((seq, op, data))
+            sender = threading.Thread(target=lambda: (
+                server.send_catch_up(senderSock, replication.recvSeq(senderSock), server.store.state["lastSeq"], reset),
+                replication.finishSending(senderSock)))
+            sender.daemon = True
+            sender.start()
+            replication.receiveUpdates(receiverSock, fromSeq, applyUpdate, lambda snapshot: snapshots.append(pickle.loads(snapshot)))
+            sender.join()
+            return received, snapshots
+        
+        start = server.store.state["lastSeq"]
+        for username in ["catchup1", "catchup2", "catchup3"]:
+            server.store.state["registeredUsers"].add(username)
+            server.record_update(OP_REGISTER, bytes(username, 'ascii'))
+        # only the missing updates are sent, straight from the log
+        received, snapshots = catchUp(start + 1)
+        self.assertEqual(received, [(start + 2, OP_REGISTER, b"catchup2"), (start + 3, OP_REGISTER, b"catchup3")])
+        self.assertEqual(snapshots, [])
+        self.assertEqual(catchUp(start + 3), ([], []))
+        
+        # once the log has been compacted past that point, a snapshot is sent first
+        server.compact_server_state()
+        server.store.state["registeredUsers"].discard("catchup1")
+        server.record_update(OP_DELETE, b"catchup1")
+        received, snapshots = catchUp(start + 1)
+        self.assertEqual(received, [(start + 4, OP_DELETE, b"catchup1")])
+        self.assertEqual(len(snapshots), 1)
+        self.assertEqual(snapshots[0]["lastSeq"], start + 3)
+        self.assertTrue({"catchup1", "catchup2", "catchup3"} <= snapshots[0]["registeredUsers"])
+        self.assertFalse(snapshots[0]["reset"])
+        # a server that may have applied updates we rolled back is reset to our state, however far
+        # along it is
+        for fromSeq in [start + 4, start + 9]:
+            received, snapshots = catchUp(fromSeq, reset=True)
+            self.assertEqual(received, [(start + 4, OP_DELETE, b"catchup1")])
+            self.assertEqual([(snapshot["lastSeq"], snapshot["reset"]) for snapshot in snapshots], [(start + 3, True)])
+        for username in ["catchup2", "catchup3"]:
+            server.store.state["registeredUsers"].discard(username)
+        cleanUpState()
+
+    def testSyncHandshake(self):
+        # a server syncing its state is first told whether we're ready, then sent what it's missing
+        otherSock, sock = socket.socketpair()
+        handler = threading.Thread(target=server.handle_server_connection, args=(sock, ("localhost", 0)))
+        handler.daemon = True
+        handler.start()
+        otherSock.sendall(replication.formatChannelFrame(CHANNEL_SYNC, (0).to_bytes(CODE_LENGTH, "big")))
+        self.assertEqual(int.from_bytes(recvExactly(otherSock, CODE_LENGTH), "big"), PEER_STARTING)
+        received = []
+        replication.receiveUpdates(otherSock, server.store.state["lastSeq"], lambda *update: received.append(update), None)
+        handler.join()
+        self.assertEqual(received, [])
+
+# testing the username search index
+class TestSearch(unittest.TestCase):
+    def testUsernameIndex(self):
+        usernames = ["sender1", "sender2", "sender3", "bob", "bobby", "alice"]
+        index = UsernameIndex(usernames)
+        queries = ["*", "s*", "c*", "sender", "bob", "bob*", "b*y", "*1", "*e*", "sender1", "sen*der*"]
+        for query in queries:
+            self.assertEqual(index.search(query), sorted(searchUsernames(usernames, query)))
+        
+        # the index is kept up to date as users register and are deleted
+        index.add("senderX")
+        index.remove("sender1")
+        self.assertEqual(index.search("sender*"), ["sender2", "sender3", "senderX"])
+        self.assertNotIn("sender1", index)
+        self.assertIn("senderX", index)
+    
+    def testNgramIndex(self):
+        usernames = ["jackson", "johnson", "sonia", "mason", "abxbyc", "abc", "son"]
+        index = UsernameIndex(usernames)
+        queries = ["*son*", "*son", "a*b*c", "*o*n*", "j*son", "*ackso*", "*zzz*", "s*n*a"]
+        for query in queries:
+            self.assertEqual(index.search(query), sorted(searchUsernames(usernames, query)))
+        # only usernames containing every trigram of the query are candidates, and literals
+        # shorter than a trigram narrow the candidates down too
+        self.assertEqual(index.gramCandidates("*son*"), {"jackson", "johnson", "sonia", "mason", "son"})
+        self.assertEqual(index.gramCandidates("*ack*son*"), {"jackson"})
+        self.assertEqual(index.gramCandidates("a*b*c"), {"abxbyc", "abc"})
+        self.assertEqual(index.gramCandidates("*so*"), {"jackson", "johnson", "sonia", "mason", "son"})
+        self.assertEqual(index.gramCandidates("*x*"), {"abxbyc"})
+        self.assertIsNone(index.gramCandidates("**"))
+        
+        # the index is kept up to date as users register and are deleted
+        index.remove("jackson")
+        index.add("samsonite")
+        self.assertEqual(index.search("*son*"), ["johnson", "mason", "samsonite", "son", "sonia"])
+        self.assertEqual(index.gramCandidates("*ack*"), set())
+        self.assertEqual(index.gramCandidates("*j*"), {"johnson"})
+        self.assertEqual(index.search("*te"), ["samsonite"])
+    
+    def testSearchAfterCursor(self):
+        index = UsernameIndex(["a1", "a2", "a3", "b1", "ba2"])
+        self.assertEqual(index.search("a*", after="a1", limit=1), ["a2"])
+        self.assertEqual(index.search("*", after="a3"), ["b1", "ba2"])
+        self.assertEqual(index.search("*2", after="a2"), ["ba2"])
+        self.assertEqual(index.search("b1", after="b1"), [])
+
+# testing the operation log and snapshots
+class TestStorage(unittest.TestCase):
+    def testLogReplay(self):
+        path = statePath("test_storage.log")
+        log = storage.OperationLog(path)
+        log.append(1, OP_REGISTER, 1.0, b"foo")
+        log.append(2, OP_SEND, 2.0, b"foo|foo|hi")
+        log.close()
+        # simulate a crash in the middle of appending a third record
+        with open(storage.segmentPath(path, 0), 'ab') as f:
+            f.write(storage.encodeRecord(3, OP_DELETE, 3.0, b"foo")[:-2])
+        
+        records = list(storage.readLog(path))
+        self.assertEqual(records, [(1, OP_REGISTER, 1.0, b"foo"), (2, OP_SEND, 2.0, b"foo|foo|hi")])
+        state = server.empty_server_state()
+        for _, op, _, data in records:
+            server.apply_update(state, op, data)
+        self.assertEqual(state["registeredUsers"], {"foo"})
+        os.remove(storage.segmentPath(path, 0))
+    
+    def testMessageSpool(self):
+        path = statePath("test_spool")
+        shutil.rmtree(path, ignore_errors=True)
+        spool = MessageSpool(path)
+        spool.apply(1, OP_SEND, 1.0, b"foo|bar|hi")
+        spool.apply(2, OP_SEND, 2.0, b"baz|bar|hey")
+        spool.apply(3, OP_SEND, 3.0, b"bar|foo|yo")
+        self.assertEqual(spool.load("bar"), ["foo|hi", "baz|hey"])
+        # logging in empties only that user's mailbox
+        self.assertEqual(spool.apply(4, OP_LOGIN, 4.0, b"bar"), ["foo|hi", "baz|hey"])
+        self.assertEqual(spool.load("bar"), [])
+        self.assertEqual(spool.load("foo"), ["bar|yo"])
+        
+        # replaying operations the mailboxes already reflect (e.g. from the log on startup) has no
+        # effect, but later ones are applied
+        log = [(1, OP_SEND, 1.0, b"foo|bar|hi"), (3, OP_SEND, 3.0, b"bar|foo|yo"), (4, OP_LOGIN, 4.0, b"bar"),
+               (5, OP_SEND, 5.0, b"foo|bar|again")]
+        spool = MessageSpool(path)
+        spool.replay(log)
+        self.assertEqual(spool.load("bar"), ["foo|again"])
+        self.assertEqual(spool.load("foo"), ["bar|yo"])
+        
+        # a record that was only partially written is dropped before the next append
+        with open(spool.mailboxPath("foo"), 'ab') as f:
+            f.write(storage.encodeRecord(6, OP_SEND, 6.0, b"bar|torn")[:-3])
+        spool = MessageSpool(path)
+        spool.apply(7, OP_SEND, 7.0, b"baz|foo|later")
+        self.assertEqual(spool.load("foo"), ["bar|yo", "baz|later"])
+        
+        # the spool can be replaced wholesale, after which operations up to that point are ignored
+        mailboxes, seq = spool.export()
+        self.assertEqual((mailboxes, seq), ({"foo": ["bar|yo", "baz|later"], "bar": ["foo|again"]}, 7))
+        other = MessageSpool(statePath("test_spool_other"))
+        other.replaceAll(mailboxes, seq)
+        other = MessageSpool(statePath("test_spool_other"))
+        other.apply(7, OP_SEND, 7.0, b"baz|foo|later")
+        self.assertEqual(other.load("foo"), ["bar|yo", "baz|later"])
+        
+        # acknowledged messages are removed from the front of a mailbox, exactly once
+        other.apply(8, OP_ACK_MESSAGES, 8.0, b"foo|1")
+        other.replay([(8, OP_ACK_MESSAGES, 8.0, b"foo|1")])
+        self.assertEqual(other.load("foo"), ["baz|later"])
+        self.assertEqual(other.load("bar", limit=0), [])
+        
+        # a batch send adds to every recipient's mailbox, and replaying it only fills in the
+        # mailboxes that don't have it yet
+        batch = bytes(formatSendBatch("baz", [(["foo", "bar"], "all"), (["qux"], "one")]), 'ascii')
+        other.apply(9, OP_SEND_BATCH, 9.0, batch, {"foo"})
+        other.replay([(9, OP_SEND_BATCH, 9.0, batch)])
+        self.assertEqual(other.load("foo"), ["baz|later", "baz|all"])
+        self.assertEqual(other.load("bar"), ["foo|again", "baz|all"])
+        self.assertEqual(other.load("qux"), ["baz|one"])
+        
+        # draining a long mailbox a chunk at a time only appends acknowledgements, and only
+        # occasionally rewrites the mailbox without the acknowledged messages
+        other.appendMessages(10, 10.0, "long", [f"baz|{n}" for n in range(100)])
+        rewrites, inode = 0, os.stat(other.mailboxPath("long")).st_ino
+        for chunk in range(10):
+            other.apply(11 + chunk, OP_ACK_MESSAGES, 11.0, b"long|10")
+            self.assertEqual(other.load("long", limit=1), [f"baz|{10 * chunk + 10}"] if chunk < 9 else [])
+            rewrites += os.stat(other.mailboxPath("long")).st_ino != inode
+            inode = os.stat(other.mailboxPath("long")).st_ino
+        self.assertLess(rewrites, 5)
+        # the offset the unacknowledged messages start at survives reopening the spool (the
+        # messages acknowledged before are only removed now, as they take up most of the mailbox)
+        other.appendMessages(21, 21.0, "long", ["baz|a", "baz|b", "baz|c"])
+        other.apply(22, OP_ACK_MESSAGES, 22.0, b"long|1")
+        self.assertNotEqual(os.stat(other.mailboxPath("long")).st_ino, inode)
+        self.assertEqual(MessageSpool(statePath("test_spool_other")).load("long"), ["baz|b", "baz|c"])
+        # operations that are rolled back are cut off the mailboxes they were applied to,
+        # acknowledgements included
+        other.rollback(22, {"long"})
+        self.assertEqual(other.load("long"), ["baz|a", "baz|b", "baz|c"])
+        other.rollback(21, {"long"})
+        self.assertEqual(MessageSpool(statePath("test_spool_other")).load("long"), [])
+        self.assertEqual(other.lastSeq, 20)
+        shutil.rmtree(path)
+        shutil.rmtree(statePath("test_spool_other"))
+
+    def testStateTool(self):
+        for path in [statePath("test_tool_source"), statePath("test_tool_dest")]:
+            shutil.rmtree(path, ignore_errors=True)
+        state = server.empty_server_state()
+        state["registeredUsers"] = {"foo", "bar"}
+        spool = MessageSpool(statePath("test_tool_source"))
+        spool.apply(1, OP_SEND, 1.0, b"foo|bar|hi")
+        spool.apply(2, OP_SEND, 2.0, b"baz|bar|hey")
+        out = io.StringIO()
+        self.assertEqual(statetool.exportState(state, spool, out), (2, 2))
+        self.assertEqual(out.getvalue(), "user bar\nuser foo\nmessage foo|bar|hi\nmessage baz|bar|hey\n")
+
+        # an export imports back into the same state, with the messages in order
+        imported = server.empty_server_state()
+        dest = MessageSpool(statePath("test_tool_dest"))
+        lines = ["# provisioned", ""] + out.getvalue().splitlines() + ["message bar|foo|yo"]
+        self.assertEqual(statetool.importState(lines, imported, dest, 5, 5.0), (2, 3))
+        self.assertEqual(imported["registeredUsers"], {"foo", "bar"})
+        self.assertEqual(dest.load("bar"), ["foo|hi", "baz|hey"])
+        self.assertEqual(dest.load("foo"), ["bar|yo"])
+        self.assertEqual(dest.lastSeq, 5)
+
+        # malformed records, and messages for users who aren't registered, are rejected by line
+        for lines in [["user not-valid!"], ["message foo|nobody|hi"], ["message foo|bar"], ["group foo"]]:
+            with self.assertRaisesRegex(ValueError, "line 1"):
+                statetool.importState(lines, imported, dest, 6, 6.0)
+        shutil.rmtree(statePath("test_tool_source"))
+        shutil.rmtree(statePath("test_tool_dest"))
+
+    def testGroupCommit(self):
+        # concurrent appends are written out together in a few batches, and each thread is only
+        # acknowledged once its batch is durable
+        for policy in [FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_OS]:
+            path = statePath(f"test_group_commit_{policy}.log")
+            log = storage.OperationLog(path, policy, intervalMs=50)
+            acknowledged = []
+            def appendAndWait(seq):
+                log.append(seq, OP_REGISTER, 0.0, bytes(f"user{seq}", 'ascii')).wait()
+                acknowledged.append(seq in [s for s, _, _, _ in storage.readLog(path)])
+            appenders = [threading.Thread(target=appendAndWait, args=(seq,)) for seq in range(1, 41)]
+            for appender in appenders:
+                appender.start()
+            for appender in appenders:
+                appender.join()
+            self.assertEqual(acknowledged, [True] * 40)
+            self.assertEqual(len(list(storage.readLog(path))), 40)
+            if policy == FSYNC_INTERVAL:
+                self.assertLess(log.numFlushes, 40)
+            log.close()
+            os.remove(storage.segmentPath(path, 0))
+
+    def testCompaction(self):
+        path = statePath("test_compaction.log")
+        log = storage.OperationLog(path)
+        log.append(1, OP_REGISTER, 1.0, b"foo")
+        sealedSegment, commit = log.rotate()
+        log.append(2, OP_REGISTER, 2.0, b"bar").wait()
+        commit.wait()
+        # records appended after the rotation go to a new segment
+        self.assertEqual(storage.logSegments(path), [sealedSegment, sealedSegment + 1])
+        self.assertEqual([seq for seq, _, _, _ in storage.readLog(path, sealedSegment)], [1])
+        log.removeSegments(sealedSegment)
+        self.assertEqual([seq for seq, _, _, _ in storage.readLog(path)], [2])
+        log.close()
+        os.remove(storage.segmentPath(path, sealedSegment + 1))
+    
+    def testBackgroundSnapshot(self):
+        cleanUpState()
+        for username in ["snap1", "snap2", "snap3"]:
+            server.store.state["registeredUsers"].add(username)
+            server.record_update(OP_REGISTER, bytes(username, 'ascii'))
+        server.compact_server_state()
+        # the snapshot covers everything logged so far, so the sealed log segments are gone
+        snapshot = storage.loadSnapshot(server.snapshot_path())
+        self.assertTrue({"snap1", "snap2", "snap3"} <= snapshot["registeredUsers"])
+        self.assertEqual(snapshot["lastSeq"], server.store.state["lastSeq"])
+        self.assertEqual(list(storage.readLog(server.log_path())), [])
+        
+        # operations logged after the snapshot are replayed over it
+        server.store.state["registeredUsers"].discard("snap1")
+        server.record_update(OP_DELETE, b"snap1")
+        recovered = server.recover_server_state()
+        self.assertNotIn("snap1", recovered["registeredUsers"])
+        self.assertIn("snap2", recovered["registeredUsers"])
+        for username in ["snap2", "snap3"]:
+            server.store.state["registeredUsers"].discard(username)
+        cleanUpState()
+
+# more than a socket pair's buffers hold, so that a client that doesn't read it stalls the writes
+STALLING_RESPONSE = b"x" * (1 << 21)
+
+# read a given number of bytes from a socket, however many reads it takes
+def readAll(sock, length):
+    data = b""
+    while len(data) < length:
+        data += sock.recv(length - len(data))
+    return data
+
+# testing outbound queues to clients
+class TestOutbox(unittest.TestCase):
+    def testSlowClient(self):
+        sock, client = socket.socketpair()
+        writers = ThreadPoolExecutor(max_workers=2)
+        failed = []
+        outbox = Outbox(sock, writers, WritePoller(writers), highWatermark=len(STALLING_RESPONSE) + 7,
+                        lowWatermark=4, onFailure=failed.extend)
+        # responses are always queued, while delivered messages are only queued up to the high
+        # watermark; neither waits for the client
+        outbox.send(STALLING_RESPONSE)
+        self.assertTrue(outbox.offer(b"12345", "first"))
+        self.assertFalse(outbox.offer(b"678", "second"))
+        # once congested, the outbox turns messages away even if they'd fit
+        self.assertFalse(outbox.offer(b"9", "second"))
+        self.assertEqual(outbox.timesCongested, 1)
+        drained = threading.Event()
+        outbox.whenUncongested(drained.set)
+        self.assertFalse(drained.is_set())
+        
+        # once the client catches up, everything queued is written in order, and messages are
+        # let in again after the outbox drains below the low watermark
+        self.assertEqual(readAll(client, len(STALLING_RESPONSE) + 5), STALLING_RESPONSE + b"12345")
+        self.assertTrue(drained.wait(5))
+        self.assertFalse(outbox.congested)
+        self.assertTrue(outbox.offer(b"678", "second"))
+        self.assertEqual(readAll(client, 3), b"678")
+        
+        # when the connection fails, only the messages that weren't fully written are handed back
+        outbox.send(STALLING_RESPONSE)
+        outbox.offer(b"9", "third")
+        client.close()
+        for _ in range(500):
+            if failed:
+                break
+            time.sleep(0.01)
+        self.assertEqual(failed, ["third"])
+        self.assertFalse(outbox.offer(b"0", "fourth"))
+        sock.close()
+        writers.shutdown()
+    
+    def testStalledClients(self):
+        # clients that stop reading don't tie up the writers: with a single writer thread, a
+        # client that keeps reading is written to while several others are stalled
+        writers = ThreadPoolExecutor(max_workers=1)
+        poller = WritePoller(writers, timeout=1)
+        failed = []
+        stalled = [socket.socketpair() for _ in range(3)]
+        for sock, _ in stalled:
+            outbox = Outbox(sock, writers, poller, highWatermark=2 * len(STALLING_RESPONSE), onFailure=failed.extend)
+            outbox.send(STALLING_RESPONSE)
+            self.assertTrue(outbox.offer(b"late", "late"))
+        sock, client = socket.socketpair()
+        outbox = Outbox(sock, writers, poller)
+        startedAt = time.monotonic()
+        outbox.send(b"prompt")
+        self.assertEqual(readAll(client, 6), b"prompt")
+        self.assertLess(time.monotonic() - startedAt, 0.5)
+        
+        # clients that take nothing for longer than the timeout are given up on
+        for _ in range(500):
+            if len(failed) == 3:
+                break
+            time.sleep(0.01)
+        self.assertEqual(failed, ["late"] * 3)
+        for pair in stalled + [(sock, client)]:
+            for end in pair:
+                end.close()
+        writers.shutdown()
+
+# testing the lock-striped state store
+class TestStateStore(unittest.TestCase):
+    def testConcurrentUpdates(self):
+        store = StateStore(server.empty_server_state(), numStripes=4)
+        # many threads racing to register and log in the same users: each user is registered, and
+        # logged in, exactly once
+        results = defaultdict(list)
+        def worker(i):
+            for n in range(50):
+                username = f"user{n}"
+                results["registered"].append(store.registerIfAbsent(username))
+                results["loggedIn"].append(store.login(username, i))
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        self.assertEqual(results["registered"].count(True), 50)
+        self.assertEqual(results["loggedIn"].count(True), 50)
+        self.assertEqual(store.users(), {f"user{n}" for n in range(50)})
+
+        # users are only logged out from the connection they're logged in on, which also drops
+        # the chunk of unread messages they were delivered
+        sock = store.sessionOf("user0")
+        self.assertTrue(store.beginDelivery("user0", 3))
+        self.assertFalse(store.beginDelivery("user0", 5))
+        self.assertFalse(store.logout("user0", object()))
+        self.assertTrue(store.logout("user0", sock))
+        self.assertIsNone(store.pendingDelivery("user0"))
+        self.assertFalse(store.login("nobody", sock))
+
+        # locking several users at once takes each stripe once, in order
+        with store.locked([f"user{n}" for n in range(50)]):
+            self.assertTrue(all(stripe._is_owned() for stripe in store.stripes))
+        self.assertFalse(any(stripe._is_owned() for stripe in store.stripes))
+        snapshot = store.snapshot()
+        store.unregister("user1")
+        self.assertIn("user1", snapshot["registeredUsers"])
+
+# testing the links between the shards of a server
+class TestShards(unittest.TestCase):
+    def testShardLink(self):
+        # usernames are split between the shards the same way in every process
+        owners = [shards.shardOf(f"user{n}", 4) for n in range(100)]
+        self.assertEqual(set(owners), {0, 1, 2, 3})
+        self.assertEqual(shards.shardOf("user0", 4), owners[0])
+        self.assertEqual(shards.shardOf("user0", 1), 0)
+        self.assertEqual(shards.internalPort(1, 2), INTERNAL_SERVER_PORTS[1] + 2 * len(INTERNAL_SERVER_PORTS))
+
+        self.assertEqual(shards.linkPath(TEST_STATE_DIR, 1, 2), statePath("server_1.shard2.sock"))
+        self.assertEqual(shards.linkPath(TEST_STATE_DIR, 1, 2, 3), statePath("server_1.partition3.shard2.sock"))
+        path = statePath("test_shard_link.sock")
+        listenSock = shards.listenForShards(path)
+        adopted = []
+        functions = {"search": lambda query, limit: [f"{query}{n}" for n in range(limit)]}
+        linkServer = threading.Thread(target=shards.serveShardLinks,
+                                      args=(listenSock, functions, lambda sock, *details: adopted.append((sock, details))))
+        linkServer.daemon = True
+        linkServer.start()
+        link = shards.ShardLink(1, path)
+        # concurrent calls each get their own result, and connections are reused afterwards
+        results = {}
+        def call(n):
+            results[n] = link.call("search", "user", n)
+        callers = [threading.Thread(target=call, args=(n,)) for n in range(8)]
+        for t in callers:
+            t.start()
+        for t in callers:
+            t.join()
+        self.assertEqual(results, {n: [f"user{i}" for i in range(n)] for n in range(8)})
+        numIdle = len(link.idle)
+        link.call("search", "user", 1)
+        self.assertEqual(len(link.idle), numIdle)
+
+        # a handed off connection keeps working on the other side after it's closed here
+        client, serverSide = socket.socketpair()
+        link.handOff(serverSide, 2, OP_LOGIN, b"user1", b"")
+        serverSide.close()
+        for _ in range(100):
+            if adopted:
+                break
+            time.sleep(0.01)
+        sock, details = adopted[0]
+        self.assertEqual(details, (2, OP_LOGIN, b"user1", b""))
+        sock.sendall(b"hi")
+        self.assertEqual(client.recv(2), b"hi")
+        sock.close()
+        client.close()
+        listenSock.close()
+
+# testing failure detection and the primary's lease
+class TestLeases(unittest.TestCase):
+    # every server that's up sends every other one a heartbeat, then decides who to vote for
+    def exchange(self, leases, up):
+        for sender in up:
+            for receiver in up:
+                if sender != receiver:
+                    leases[receiver].receive(leases[sender].heartbeatFor(receiver))
+        for server in up:
+            leases[server].tick()
+    
+    def testFailover(self):
+        changes = [[], [], []]
+        leases = [Lease(i, 3, lambda: 7, changes[i].append, 0.05, 0.3) for i in range(3)]
+        # the servers agree on the server with the lowest ID, which holds the lease once the
+        # others' votes come back to it, and every server learns it's the primary
+        for _ in range(3):
+            self.exchange(leases, [0, 1, 2])
+        self.assertTrue(leases[0].isPrimary())
+        self.assertFalse(leases[1].isPrimary() or leases[2].isPrimary())
+        self.assertEqual([lease.primary() for lease in leases], [0, 0, 0])
+        self.assertEqual(changes, [[0], [0], [0]])
+        self.assertEqual(leases[1].peerSeqs(), {0: 7, 2: 7})
+        
+        # once the primary is cut off, the next server takes over within a bounded time, and
+        # only after the old primary's lease has run out
+        failedAt = time.monotonic()
+        while not leases[1].isPrimary():
+            self.assertFalse(leases[2].isPrimary())
+            self.assertLess(time.monotonic() - failedAt, 1)
+            leases[0].tick()
+            self.exchange(leases, [1, 2])
+            time.sleep(0.05)
+        self.assertFalse(leases[0].isPrimary())
+        self.assertGreater(time.monotonic() - failedAt, 0.3)
+        self.exchange(leases, [1, 2])
+        self.assertEqual([lease.primary() for lease in leases], [NO_SERVER, 1, 1])
+        self.assertEqual(changes[0], [0, NO_SERVER])
+        self.assertEqual(changes[2][-1], 1)
+        
+        # the old primary rejoins as a secondary, since the new one keeps its lease
+        for _ in range(3):
+            self.exchange(leases, [0, 1, 2])
+        self.assertEqual([lease.primary() for lease in leases], [1, 1, 1])
+        self.assertFalse(leases[0].isPrimary())
+        
+        # heartbeats from unknown servers are refused, and a lone server is its own majority
+        with self.assertRaises(ValueError):
+            leases[0].receive(Lease(5, 6, lambda: 0, print).heartbeatFor(0))
+        alone = Lease(0, 1, lambda: 0, print)
+        alone.tick()
+        self.assertTrue(alone.isPrimary())
+    
+    def testShardLease(self):
+        # a stand-in for the link to shard 0, which runs the lease
+        class Link:
+            def __init__(self, lease):
+                self.lease = lease
+            def call(self, name):
+                if self.lease is None:
+                    raise ConnectionError("shard 0 is down")
+                return {"lease": self.lease.share}[name]()
+        leases = [Lease(i, 3, lambda: 7, print, 0.05, 0.3) for i in range(3)]
+        changes = [[], []]
+        shards = [ShardLease(i, Link(leases[i]), changes[i].append, 0.05, 0.3) for i in range(2)]
+        # the other shards of a server follow shard 0's lease, rather than electing a primary of
+        # their own, so they agree with it on the primary
+        for _ in range(3):
+            self.exchange(leases, [0, 1, 2])
+        for shard in shards:
+            shard.update(shard.link.call("lease"))
+        self.assertTrue(shards[0].isPrimary())
+        self.assertFalse(shards[1].isPrimary())
+        self.assertEqual([shard.primary() for shard in shards], [0, 0])
+        self.assertEqual(changes, [[0], [0]])
+        # any server that's up may be ahead of another shard on its own updates
+        self.assertEqual(shards[1].peerSeqs(), {0: float("inf"), 2: float("inf")})
+        
+        # a shard that stops hearing from shard 0 acts as the primary no longer than shard 0 may,
+        # and then knows of no primary
+        shards[0].link.lease = shards[1].link.lease = None
+        stoppedAt = time.monotonic()
+        while shards[0].isPrimary():
+            self.assertLess(time.monotonic() - stoppedAt, 1)
+            shards[0].update(None)
+            time.sleep(0.05)
+        self.assertFalse(leases[0].isPrimary())
+        for shard in shards:
+            shard.update(None)
+        self.assertEqual([shard.primary() for shard in shards], [NO_SERVER, NO_SERVER])
+        self.assertEqual(changes, [[0, NO_SERVER], [0, NO_SERVER]])
+
+# testing the framed wire protocol
+class TestCodec(unittest.TestCase):
+    def testVarint(self):
+        for value in [0, 1, 127, 128, 300, 16384, MAX_FRAME_LENGTH]:
+            encoded = codec.encodeVarint(value)
+            self.assertEqual(codec.decodeVarint(encoded), (value, len(encoded)))
+            # a varint cut short isn't decoded
+            self.assertIsNone(codec.decodeVarint(encoded[:-1]))
+        self.assertEqual(len(codec.encodeVarint(127)), 1)
+        self.assertEqual(len(codec.encodeVarint(128)), 2)
+    
+    def testFrames(self):
+        # back-to-back frames arriving in one read are split apart, and a frame split across
+        # reads is only taken once all of it has arrived
+        long = codec.encodeFrame(OP_SEND, b"x" * 200)
+        buffer = bytearray(codec.encodeFrame(OP_LOGIN, b"alice") + codec.encodeFrame(OP_LOGOUT, b"alice") + long[:100])
+        self.assertEqual(codec.takeFrame(buffer), (OP_LOGIN, b"alice"))
+        self.assertEqual(codec.takeFrame(buffer), (OP_LOGOUT, b"alice"))
+        self.assertIsNone(codec.takeFrame(buffer))
+        buffer += long[100:]
+        self.assertEqual(codec.takeFrame(buffer), (OP_SEND, b"x" * 200))
+        self.assertEqual(buffer, bytearray())
+        
+        # frames longer than allowed (or empty ones) are rejected
+        with self.assertRaises(codec.ProtocolError):
+            codec.takeFrame(bytearray(long), maxLength=100)
+        with self.assertRaises(codec.ProtocolError):
+            codec.takeFrame(bytearray(b"\0"))
+        
+        # counted payloads carry a varint count ahead of the items
+        page = codec.encodeSearchPage(PROTOCOL_FRAMED, SEARCH_OK, ["a", "b", "c"])
+        code, payload = codec.takeFrame(bytearray(page))
+        self.assertEqual(code, SEARCH_OK)
+        self.assertEqual(codec.decodeCountedPayload(payload), (3, b"a|b|c"))
+        # the legacy encoding is unchanged
+        self.assertEqual(codec.encodeSearchPage(PROTOCOL_LEGACY, SEARCH_OK, ["a"]), formatSearchPage(SEARCH_OK, ["a"]))
+    
+    def testConcurrentClientRequests(self):
+        # a client socket that writes a few bytes at a time, letting other threads run in between
+        class TricklingSocket:
+            def __init__(self, sock):
+                self.sock = sock
+            def sendall(self, data):
+                for start in range(0, len(data), 3):
+                    self.sock.sendall(data[start:start + 3])
+                    time.sleep(0)
+        sent, received = socket.socketpair()
+        clientSock, version = client.sock, client.protocolVersion
+        client.sock, client.protocolVersion = TricklingSocket(sent), PROTOCOL_VERSION
+        try:
+            # requests sent from several threads at once each arrive as a whole frame
+            def sendMany(sender):
+                for n in range(20):
+                    client.sendRequest(OP_SEARCH, f"{sender}-{n}")
+            senders = [threading.Thread(target=sendMany, args=(sender,)) for sender in "abcd"]
+            for sender in senders:
+                sender.start()
+            for sender in senders:
+                sender.join()
+            payloads = set()
+            for _ in range(80):
+                op, payload = codec.recvFrame(received)
+                self.assertEqual(op, OP_SEARCH)
+                payloads.add(codec.decodeTagged(PROTOCOL_VERSION, payload)[1])
+            self.assertEqual(payloads, {bytes(f"{sender}-{n}", 'ascii') for sender in "abcd" for n in range(20)})
+        finally:
+            client.sock, client.protocolVersion = clientSock, version
+            with client.requestsLock:
+                client.pendingRequests.clear()
+        sent.close()
+        received.close()
+
+# testing the selector-based server mode
+class TestEventLoop(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        server.clientSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # connections the server shut down may linger from a previous run
+        server.clientSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.clientSock.bind(TEST_EVENT_LOOP_SERVER_ADDR)
+        server.clientSock.listen(LISTEN_BACKLOG)
+        loop = threading.Thread(target=server.run_event_loop)
+        loop.daemon = True
+        loop.start()
+    
+    def testManyClients(self):
+        # many concurrent clients are served by the one event loop thread and the worker pool
+        socks = []
+        for _ in range(100):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+            socks.append(sock)
+        for sock in socks:
+            opcode, messageBody = OP_LOGIN, "nobody"
+            sock.sendall(opcode.to_bytes(CODE_LENGTH, "big") + bytes(messageBody, 'ascii'))
+        for sock in socks:
+            code = int.from_bytes(sock.recv(CODE_LENGTH), "big")
+            self.assertEqual(code, LOGIN_NOT_REGISTERED)
+        
+        # requests from the same client are answered in order
+        sock = socks[0]
+        sock.sendall(OP_SEARCH.to_bytes(CODE_LENGTH, "big") + bytes("nobody*", 'ascii'))
+        self.assertEqual(int.from_bytes(sock.recv(CODE_LENGTH), "big"), SEARCH_NO_RESULTS)
+        sock.sendall((72).to_bytes(CODE_LENGTH, "big"))
+        self.assertEqual(int.from_bytes(sock.recv(CODE_LENGTH), "big"), BAD_OPERATION)
+        for sock in socks:
+            sock.close()
+    
+    def testSplitLegacyPayload(self):
+        # a legacy request's data that arrives in several segments is read as a whole
+        server.usernameIndex.add("legacysplit")
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(5)
+        self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+        sock.sendall(OP_SEARCH.to_bytes(CODE_LENGTH, "big") + b"legacy")
+        time.sleep(LEGACY_PAYLOAD_WAIT / 4)
+        sock.sendall(b"split")
+        self.assertEqual(self.readSearchPage(sock), (SEARCH_OK, ["legacysplit"]))
+        sock.sendall(OP_SEARCH.to_bytes(CODE_LENGTH, "big") + b"nobody*")
+        self.assertEqual(int.from_bytes(sock.recv(CODE_LENGTH), "big"), SEARCH_NO_RESULTS)
+        sock.close()
+        server.usernameIndex.remove("legacysplit")
+    
+    # read one page of search results, returning its status code and results
+    def readSearchPage(self, sock):
+        code = int.from_bytes(recvExactly(sock, CODE_LENGTH), "big")
+        numResults = int.from_bytes(recvExactly(sock, MSG_HEADER_LENGTH), "big")
+        pageLength = int.from_bytes(recvExactly(sock, MSG_HEADER_LENGTH), "big")
+        results = recvExactly(sock, pageLength).decode('ascii').split("|")
+        self.assertEqual(len(results), numResults)
+        return code, results
+    
+    def testSearchPages(self):
+        usernames = [f"page{i:04d}" for i in range(250)]
+        for username in usernames:
+            server.usernameIndex.add(username)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+        
+        # a search streams every result back in pages, each searched for on its own rather than
+        # sliced out of every result
+        limits = []
+        search = server.usernameIndex.search
+        def recordingSearch(query, after="", limit=None):
+            limits.append(limit)
+            return search(query, after=after, limit=limit)
+        server.usernameIndex.search = recordingSearch
+        try:
+            sock.sendall(OP_SEARCH.to_bytes(CODE_LENGTH, "big") + bytes("page*", 'ascii'))
+            received = []
+            code = SEARCH_OK_MORE
+            while code == SEARCH_OK_MORE:
+                code, results = self.readSearchPage(sock)
+                self.assertLessEqual(len(results), SEARCH_PAGE_SIZE)
+                received += results
+        finally:
+            del server.usernameIndex.search
+        self.assertEqual(code, SEARCH_OK)
+        self.assertEqual(received, usernames)
+        self.assertEqual(limits, [SEARCH_PAGE_SIZE + 1] * 3)
+        
+        # with a limit and a cursor, one page is returned at a time; the last result of a page is
+        # the cursor for the next one
+        received, cursor = [], ""
+        code = SEARCH_OK_MORE
+        while code == SEARCH_OK_MORE:
+            request = formatSearchPageRequest(60, cursor, "*ge01*")
+            sock.sendall(OP_SEARCH_PAGE.to_bytes(CODE_LENGTH, "big") + bytes(request, 'ascii'))
+            code, results = self.readSearchPage(sock)
+            self.assertLessEqual(len(results), 60)
+            received += results
+            cursor = results[-1]
+        self.assertEqual(code, SEARCH_OK)
+        self.assertEqual(received, [username for username in usernames if "ge01" in username])
+        
+        sock.close()
+        for username in usernames:
+            server.usernameIndex.remove(username)
+    
+    def testFramedClient(self):
+        server.store.state["registeredUsers"].add("framed")
+        server.usernameIndex.add("framed")
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+        # a client may ask for an older version of the protocol, here one without request IDs
+        sock.sendall(codec.encodeHello(PROTOCOL_FRAMED))
+        self.assertEqual(recvExactly(sock, 2 * CODE_LENGTH), bytes([HELLO_OK, PROTOCOL_FRAMED]))
+        
+        # back-to-back requests sent in one write are each answered in turn
+        sock.sendall(codec.encodeFrame(OP_LOGIN, b"framed") + codec.encodeFrame(OP_SEND, b"framed|framed|hi") +
+                     codec.encodeFrame(OP_SEARCH, b"frame*"))
+        self.assertEqual(codec.recvFrame(sock), (LOGIN_OK_NO_UNREAD_MSG, b""))
+        self.assertEqual(codec.recvFrame(sock), (RECEIVE_OK, b"framed|hi"))
+        code, payload = codec.recvFrame(sock)
+        self.assertEqual(code, SEARCH_OK)
+        self.assertEqual(codec.decodeCountedPayload(payload), (1, b"framed"))
+        # negotiating again isn't allowed
+        sock.sendall(codec.encodeFrame(OP_HELLO, bytes([PROTOCOL_FRAMED])))
+        self.assertEqual(codec.recvFrame(sock), (BAD_OPERATION, b""))
+        sock.sendall(codec.encodeFrame(OP_LOGOUT, b"framed"))
+        self.assertEqual(codec.recvFrame(sock), (LOGOUT_OK, b""))
+        
+        # an oversized frame is a protocol error, which ends the connection
+        sock.sendall(codec.encodeVarint(MAX_REQUEST_LENGTH + 1))
+        self.assertIsNone(codec.recvFrame(sock))
+        sock.close()
+        server.store.state["registeredUsers"].discard("framed")
+        server.usernameIndex.remove("framed")
+        cleanUpState()
+    
+    def testPrimaryRedirects(self):
+        # a stand-in for the lease of a server that isn't the primary, server 2 is
+        class Secondary:
+            def isPrimary(self):
+                return False
+            def primary(self):
+                return 2
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+        sock.sendall(codec.encodeHello())
+        self.assertEqual(recvExactly(sock, 2 * CODE_LENGTH), bytes([HELLO_OK, PROTOCOL_VERSION]))
+        server.lease = Secondary()
+        try:
+            # clients are told where the primary is, whether they ask or make a request only it serves
+            sock.sendall(codec.encodeRequest(PROTOCOL_VERSION, OP_PRIMARY, b"", 1) +
+                         codec.encodeRequest(PROTOCOL_VERSION, OP_REGISTER, b"redirected", 2))
+            self.assertEqual(codec.recvFrame(sock), (PRIMARY_IS, codec.encodeVarint(1) + bytes([2])))
+            self.assertEqual(codec.recvFrame(sock), (NOT_PRIMARY, codec.encodeVarint(2) + bytes([2])))
+            self.assertFalse(server.store.isRegistered("redirected"))
+            # and they're told whenever it changes
+            server.announce_primary(1)
+            self.assertEqual(codec.recvFrame(sock), (PRIMARY_IS, codec.encodeVarint(NO_REQUEST_ID) + bytes([1])))
+        finally:
+            server.lease = None
+        sock.close()
+        cleanUpState()
+    
+    def testPipelinedRequests(self):
+        usernames = [f"bot{i}" for i in range(20)]
+        server.store.state["registeredUsers"] |= set(usernames)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+        sock.sendall(codec.encodeHello())
+        self.assertEqual(recvExactly(sock, 2 * CODE_LENGTH), bytes([HELLO_OK, PROTOCOL_REQUEST_IDS]))
+        
+        # many requests are sent without waiting for responses, and each response carries the ID
+        # of the request it answers
+        def request(op, payload, requestId):
+            return codec.encodeRequest(PROTOCOL_REQUEST_IDS, op, payload, requestId)
+        requests = request(OP_LOGIN, b"bot0", 1)
+        for i, username in enumerate(usernames[1:]):
+            requests += request(OP_SEND, bytes(f"bot0|{username}|bulk", 'ascii'), 100 + i)
+        requests += request(OP_SEND, b"bot0|nobody|bulk", 200)
+        sock.sendall(requests)
+        responses = {}
+        for _ in range(len(usernames) + 1):
+            code, payload = codec.recvFrame(sock)
+            requestId, body = codec.decodeTagged(PROTOCOL_REQUEST_IDS, payload)
+            responses[requestId] = code
+        self.assertEqual(responses.pop(1), LOGIN_OK_NO_UNREAD_MSG)
+        self.assertEqual(responses.pop(200), SEND_RECIPIENT_DNE)
+        self.assertEqual(responses, {100 + i: SEND_OK_BUFFERED for i in range(len(usernames) - 1)})
+        
+        # messages delivered to the client aren't answers to any of its requests
+        sock.sendall(request(OP_SEND, b"bot0|bot0|echo", 300))
+        code, payload = codec.recvFrame(sock)
+        self.assertEqual((code, codec.decodeTagged(PROTOCOL_REQUEST_IDS, payload)), (RECEIVE_OK, (NO_REQUEST_ID, b"bot0|echo")))
+        sock.sendall(request(OP_LOGOUT, b"bot0", 301))
+        code, payload = codec.recvFrame(sock)
+        self.assertEqual((code, codec.decodeTagged(PROTOCOL_REQUEST_IDS, payload)), (LOGOUT_OK, (301, b"")))
+        sock.close()
+        server.store.state["registeredUsers"] -= set(usernames)
+        cleanUpState()
+    
+    def testBatchSend(self):
+        usernames = ["batcher", "online", "offline1", "offline2"]
+        server.store.state["registeredUsers"] |= set(usernames)
+        socks = {}
+        for i, username in enumerate(["batcher", "online"]):
+            sock = socks[username] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+            sock.sendall(codec.encodeHello(PROTOCOL_FRAMED))
+            self.assertEqual(recvExactly(sock, 2 * CODE_LENGTH), bytes([HELLO_OK, PROTOCOL_FRAMED]))
+            sock.sendall(codec.encodeFrame(OP_LOGIN, bytes(username, 'ascii')))
+            self.assertEqual(codec.recvFrame(sock), (LOGIN_OK_NO_UNREAD_MSG, b""))
+        
+        # one request sends a message to many recipients, and distinct messages to others; every
+        # delivery gets its own status, and the buffered messages are logged as a single update
+        lastSeq = server.store.state["lastSeq"]
+        batch = formatSendBatch("batcher", [(["online", "offline1", "ghost"], "hello all"), (["offline2"], "just you")])
+        socks["batcher"].sendall(codec.encodeFrame(OP_SEND_BATCH, bytes(batch, 'ascii')))
+        code, payload = codec.recvFrame(socks["batcher"])
+        self.assertEqual(code, SEND_BATCH_OK)
+        self.assertEqual(codec.decodeCountedPayload(payload),
+                         (4, bytes([SEND_OK_DELIVERED, SEND_OK_BUFFERED, SEND_RECIPIENT_DNE, SEND_OK_BUFFERED])))
+        self.assertEqual(codec.recvFrame(socks["online"]), (RECEIVE_OK, b"batcher|hello all"))
+        self.assertEqual(server.store.state["lastSeq"], lastSeq + 1)
+        self.assertEqual(server.open_message_spool().load("offline1"), ["batcher|hello all"])
+        self.assertEqual(server.open_message_spool().load("offline2"), ["batcher|just you"])
+        
+        for username, sock in socks.items():
+            sock.sendall(codec.encodeFrame(OP_LOGOUT, bytes(username, 'ascii')))
+            self.assertEqual(codec.recvFrame(sock), (LOGOUT_OK, b""))
+            sock.close()
+        # batches can't be sent with the legacy protocol
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+        sock.sendall(OP_SEND_BATCH.to_bytes(CODE_LENGTH, "big"))
+        self.assertEqual(int.from_bytes(recvExactly(sock, CODE_LENGTH), "big"), BAD_OPERATION)
+        sock.close()
+        server.store.state["registeredUsers"] -= set(usernames)
+        cleanUpState()
+    
+    # read one chunk of unread messages, returning its status code and messages
+    def readMessageChunk(self, sock):
+        code = int.from_bytes(recvExactly(sock, CODE_LENGTH), "big")
+        numMessages = int.from_bytes(recvExactly(sock, MSG_HEADER_LENGTH), "big")
+        chunkLength = int.from_bytes(recvExactly(sock, MSG_HEADER_LENGTH), "big")
+        messages = recvExactly(sock, chunkLength).decode('ascii').split("\n")
+        self.assertEqual(len(messages), numMessages)
+        return code, messages
+    
+    # the outbox of a logged in user, once its writer is done with what was queued (the response to
+    # the login may have been read before the writer finished with it)
+    def idleOutbox(self, username):
+        outbox = server.get_outbox(server.store.sessionOf(username))
+        while outbox.writing:
+            time.sleep(0.01)
+        return outbox
+    
+    def testFullOutbox(self):
+        server.store.state["registeredUsers"] |= {"slowpoke", "speedy"}
+        slowSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertEqual(slowSock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+        slowSock.sendall(OP_LOGIN.to_bytes(CODE_LENGTH, "big") + b"slowpoke")
+        self.assertEqual(int.from_bytes(recvExactly(slowSock, CODE_LENGTH), "big"), LOGIN_OK_NO_UNREAD_MSG)
+        
+        # a message to a recipient whose outbox is over its high watermark is buffered rather
+        # than waiting for them...
+        outbox = self.idleOutbox("slowpoke")
+        with outbox.lock:
+            outbox.queuedBytes = outbox.highWatermark
+        buffered = server.slowConsumerCounters[SLOW_CONSUMER_BUFFER]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+        sock.sendall(OP_SEND.to_bytes(CODE_LENGTH, "big") + b"speedy|slowpoke|catch up")
+        self.assertEqual(int.from_bytes(recvExactly(sock, CODE_LENGTH), "big"), SEND_OK_BUFFERED)
+        self.assertEqual(server.slowConsumerCounters[SLOW_CONSUMER_BUFFER], buffered + 1)
+        # ...and delivered as unread messages once they've caught up (pretend the queued data was
+        # written, and let the writer notice)
+        with outbox.lock:
+            outbox.queuedBytes = 0
+        outbox.send(b"")
+        self.assertEqual(self.readMessageChunk(slowSock), (RECEIVE_UNREAD, ["speedy|catch up"]))
+        slowSock.sendall(OP_ACK_MESSAGES.to_bytes(CODE_LENGTH, "big") + b"slowpoke")
+        self.assertEqual(int.from_bytes(recvExactly(slowSock, CODE_LENGTH), "big"), ACK_OK)
+        
+        # otherwise messages are delivered straight away
+        sock.sendall(OP_SEND.to_bytes(CODE_LENGTH, "big") + b"speedy|slowpoke|hi")
+        self.assertEqual(int.from_bytes(recvExactly(sock, CODE_LENGTH), "big"), SEND_OK_DELIVERED)
+        self.assertEqual(recvExactly(slowSock, CODE_LENGTH + len("speedy|hi")), RECEIVE_OK.to_bytes(CODE_LENGTH, "big") + b"speedy|hi")
+        slowSock.sendall(OP_LOGOUT.to_bytes(CODE_LENGTH, "big") + b"slowpoke")
+        self.assertEqual(int.from_bytes(recvExactly(slowSock, CODE_LENGTH), "big"), LOGOUT_OK)
+        slowSock.close()
+        sock.close()
+        server.store.state["registeredUsers"] -= {"slowpoke", "speedy"}
+        cleanUpState()
+    
+    def testDisconnectSlowConsumer(self):
+        server.store.state["registeredUsers"] |= {"laggard", "speedy"}
+        server.SLOW_CONSUMER_POLICY = SLOW_CONSUMER_DISCONNECT
+        slowSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertEqual(slowSock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+        slowSock.sendall(OP_LOGIN.to_bytes(CODE_LENGTH, "big") + b"laggard")
+        self.assertEqual(int.from_bytes(recvExactly(slowSock, CODE_LENGTH), "big"), LOGIN_OK_NO_UNREAD_MSG)
+        
+        # with the disconnect policy, a recipient over its high watermark is logged out and
+        # disconnected, and the message is buffered for when they next log in
+        outbox = self.idleOutbox("laggard")
+        with outbox.lock:
+            outbox.congested = True
+        disconnected = server.slowConsumerCounters[SLOW_CONSUMER_DISCONNECT]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+        sock.sendall(OP_SEND.to_bytes(CODE_LENGTH, "big") + b"speedy|laggard|too slow")
+        self.assertEqual(int.from_bytes(recvExactly(sock, CODE_LENGTH), "big"), SEND_OK_BUFFERED)
+        self.assertEqual(server.slowConsumerCounters[SLOW_CONSUMER_DISCONNECT], disconnected + 1)
+        self.assertIsNone(server.store.sessionOf("laggard"))
+        self.assertEqual(slowSock.recv(1), b"")
+        slowSock.close()
+        
+        slowSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertEqual(slowSock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+        slowSock.sendall(OP_LOGIN.to_bytes(CODE_LENGTH, "big") + b"laggard")
+        self.assertEqual(self.readMessageChunk(slowSock), (LOGIN_OK_UNREAD_MSG, ["speedy|too slow"]))
+        slowSock.sendall(OP_ACK_MESSAGES.to_bytes(CODE_LENGTH, "big") + b"laggard")
+        self.assertEqual(int.from_bytes(recvExactly(slowSock, CODE_LENGTH), "big"), ACK_OK)
+        slowSock.sendall(OP_LOGOUT.to_bytes(CODE_LENGTH, "big") + b"laggard")
+        self.assertEqual(int.from_bytes(recvExactly(slowSock, CODE_LENGTH), "big"), LOGOUT_OK)
+        server.SLOW_CONSUMER_POLICY = SLOW_CONSUMER_BUFFER
+        slowSock.close()
+        sock.close()
+        server.store.state["registeredUsers"] -= {"laggard", "speedy"}
+        cleanUpState()
+
+    def testSessions(self):
+        server.store.state["registeredUsers"] |= {"closer", "quiet"}
+        # a client that closes its connection without logging out is logged out
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+        sock.sendall(OP_LOGIN.to_bytes(CODE_LENGTH, "big") + b"closer")
+        self.assertEqual(int.from_bytes(recvExactly(sock, CODE_LENGTH), "big"), LOGIN_OK_NO_UNREAD_MSG)
+        serverSock = server.store.sessionOf("closer")
+        self.assertEqual(server.store.sessions.usersOf(serverSock), ["closer"])
+        sock.close()
+        deadline = time.time() + 5
+        while server.store.sessionOf("closer") is not None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(server.store.sessionOf("closer"))
+        self.assertEqual(server.store.sessions.usersOf(serverSock), [])
+
+        # pings keep a connection open, but once it has been idle for too long it's closed, and
+        # its user logged out
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+        sock.sendall(OP_LOGIN.to_bytes(CODE_LENGTH, "big") + b"quiet")
+        self.assertEqual(int.from_bytes(recvExactly(sock, CODE_LENGTH), "big"), LOGIN_OK_NO_UNREAD_MSG)
+        server.CLIENT_IDLE_TIMEOUT = 0.5
+        time.sleep(0.3)
+        sock.sendall(OP_PING.to_bytes(CODE_LENGTH, "big"))
+        self.assertEqual(int.from_bytes(recvExactly(sock, CODE_LENGTH), "big"), PING_OK)
+        time.sleep(0.3)
+        server.reap_sessions()
+        self.assertIsNotNone(server.store.sessionOf("quiet"))
+        time.sleep(0.3)
+        server.reap_sessions()
+        server.CLIENT_IDLE_TIMEOUT = CLIENT_IDLE_TIMEOUT
+        self.assertEqual(sock.recv(1), b"")
+        deadline = time.time() + 5
+        while server.store.sessionOf("quiet") is not None and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertIsNone(server.store.sessionOf("quiet"))
+        sock.close()
+        server.store.state["registeredUsers"] -= {"closer", "quiet"}
+
+    def testPartitions(self):
+        # adding a partition to the map only moves users to the new partition, and about as many
+        # as its share
+        hosts = ["localhost"] * 3
+        partitions = PartitionMap({0: hosts, 1: hosts, 2: hosts})
+        grown = parsePartitionMap(partitions.format() + "3 localhost localhost localhost\n")
+        usernames = [f"user{n}" for n in range(4000)]
+        moved = [username for username in usernames if partitions.partitionOf(username) != grown.partitionOf(username)]
+        self.assertTrue(all(grown.partitionOf(username) == 3 for username in moved))
+        self.assertTrue(500 < len(moved) < 1500)
+        self.assertEqual(grown.addressesOf(3)[1], ("localhost", SERVER_PORTS[1] + 3 * PARTITION_PORT_STRIDE))
+
+        # requests forwarded to another partition reach its primary: the server the first of its
+        # servers that's up says is the primary (here, itself)
+        server.store.state["registeredUsers"] |= {"part0", "part1", "part2"}
+        for username in ["part0", "part1", "part2"]:
+            server.usernameIndex.add(username)
+        server.SERVER_ID = 1
+        try:
+            link = PartitionLink(1, [("localhost", 1), TEST_EVENT_LOOP_SERVER_ADDR])
+            self.assertEqual(link.search("part*"), ["part0", "part1", "part2"])
+            self.assertEqual(link.search("part*", after="part0", limit=1), ["part1"])
+            self.assertEqual(link.send(b"someone|part0|hi"), SEND_OK_BUFFERED)
+            self.assertEqual(link.sendBatch("someone", [("part1", "hi"), ("nobody", "hi")]), [SEND_OK_BUFFERED, SEND_RECIPIENT_DNE])
+            self.assertEqual(len(link.idle), 1)
+            # a change of primary pushed to the link's connection isn't taken for a response
+            server.announce_primary(1)
+            self.assertEqual(link.send(b"someone|part1|hi"), SEND_OK_BUFFERED)
+            self.assertEqual(link.search("part2"), ["part2"])
+            self.assertEqual(len(link.idle), 1)
+        finally:
+            server.SERVER_ID = -1
+
+        # users of other partitions can't register or log in here
+        server.partitionMap = PartitionMap({0: hosts, 1: hosts})
+        try:
+            username = next(username for username in usernames if server.partitionMap.partitionOf(username) == 1)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+            for op in [OP_REGISTER, OP_LOGIN]:
+                sock.sendall(op.to_bytes(CODE_LENGTH, "big") + bytes(username, 'ascii'))
+                self.assertEqual(int.from_bytes(recvExactly(sock, CODE_LENGTH), "big"), WRONG_PARTITION)
+            sock.close()
+        finally:
+            server.partitionMap = None
+        for username in ["part0", "part1", "part2"]:
+            server.usernameIndex.remove(username)
+        server.store.state["registeredUsers"] -= {"part0", "part1", "part2"}
+        cleanUpState()
+
+    def testReadOnlySessions(self):
+        server.store.state["registeredUsers"] |= {"reader", "idler"}
+        server.usernameIndex.add("reader")
+        channels, onPresence, lastSynced = server.replicaChannels, server.store.onPresence, server.lastSynced
+        try:
+            # the primary tells its replicas who logs in and out, along with sync marks
+            class Recorder:
+                def __init__(self):
+                    self.records = []
+                def send(self, record):
+                    self.records.append(record)
+            recorder = Recorder()
+            server.replicaChannels = [recorder]
+            server.store.onPresence = server.broadcast_presence
+            session = object()
+            self.assertTrue(server.store.login("reader", session))
+            server.send_presence(recorder)
+            self.assertEqual(server.store.closeSession(session), ["reader"])
+            sent, received = socket.socketpair()
+            sent.sendall(b"".join(recorder.records))
+            records = [replication.recvRecord(received) for _ in range(4)]
+            sent.close()
+            received.close()
+            self.assertEqual([(seq, op, data) for seq, op, _, data in records], [
+                (UNSEQUENCED, OP_PRESENCE_UPDATE, b"1reader"), (UNSEQUENCED, OP_PRESENCE_RESET, b""),
+                (UNSEQUENCED, OP_PRESENCE_UPDATE, b"1reader"), (UNSEQUENCED, OP_PRESENCE_UPDATE, b"0reader")])
+
+            # a secondary applies them, and serves reads on read-only sessions while it's up to date
+            server.replicaChannels, server.lastSynced = None, None
+            server.apply_replicated_update(UNSEQUENCED, OP_PRESENCE_UPDATE, 0, b"1reader")
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+            sock.sendall(codec.encodeHello(PROTOCOL_FRAMED))
+            self.assertEqual(recvExactly(sock, 2 * CODE_LENGTH), bytes([HELLO_OK, PROTOCOL_FRAMED]))
+            sock.sendall(codec.encodeFrame(OP_READ_ONLY))
+            code, payload = codec.recvFrame(sock)
+            self.assertEqual((code, codec.decodeVarint(payload)[0]), (READ_STALE, STALENESS_REPORT_LIMIT * 1000))
+            server.apply_replicated_update(UNSEQUENCED, OP_SYNC_MARK, 0, replication.formatSeq(server.store.state["lastSeq"]))
+            sock.sendall(codec.encodeFrame(OP_READ_ONLY))
+            code, payload = codec.recvFrame(sock)
+            self.assertEqual(code, READ_ONLY_OK)
+            self.assertLess(codec.decodeVarint(payload)[0], 1000)
+            for username, status in [("reader", PRESENCE_ONLINE), ("idler", PRESENCE_OFFLINE), ("nobody", PRESENCE_NOT_REGISTERED)]:
+                sock.sendall(codec.encodeFrame(OP_PRESENCE, bytes(username, 'ascii')))
+                self.assertEqual(codec.recvFrame(sock), (status, b""))
+            sock.sendall(codec.encodeFrame(OP_SEARCH, b"read*"))
+            code, payload = codec.recvFrame(sock)
+            self.assertEqual((code, codec.decodeCountedPayload(payload)), (SEARCH_OK, (1, b"reader")))
+            # writes are refused, and don't make the secondary act as the primary
+            sock.sendall(codec.encodeFrame(OP_LOGIN, b"idler"))
+            self.assertEqual(codec.recvFrame(sock), (READ_ONLY_SESSION, b""))
+            self.assertIsNone(server.replicaChannels)
+            # once the secondary has fallen too far behind, reads are refused too
+            server.lastSynced = time.monotonic() - MAX_READ_STALENESS - 1
+            sock.sendall(codec.encodeFrame(OP_SEARCH, b"read*"))
+            self.assertEqual(codec.recvFrame(sock), (READ_STALE, b""))
+            sock.close()
+        finally:
+            server.replicaChannels, server.store.onPresence, server.lastSynced = channels, onPresence, lastSynced
+            server.replicaPresence.clear()
+        server.usernameIndex.remove("reader")
+        server.store.state["registeredUsers"] -= {"reader", "idler"}
+
+    def testUnreadMessageChunks(self):
+        server.store.state["registeredUsers"].add("drainee")
+        expected = [f"sender|message {i}" for i in range(120)]
+        for i in range(120):
+            server.record_update(OP_SEND, bytes(f"sender|drainee|message {i}", 'ascii'))
+        def login():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.assertEqual(sock.connect_ex(TEST_EVENT_LOOP_SERVER_ADDR), 0)
+            sock.sendall(OP_LOGIN.to_bytes(CODE_LENGTH, "big") + b"drainee")
+            return sock
+        def ack(sock):
+            sock.sendall(OP_ACK_MESSAGES.to_bytes(CODE_LENGTH, "big") + b"drainee")
+        
+        # unread messages are delivered in chunks, each sent once the previous one is acknowledged
+        sock = login()
+        self.assertEqual(self.readMessageChunk(sock), (LOGIN_OK_UNREAD_MSG_MORE, expected[:50]))
+        ack(sock)
+        self.assertEqual(self.readMessageChunk(sock), (RECEIVE_UNREAD_MORE, expected[50:100]))
+        # logging out (or disconnecting) before acknowledging a chunk only redelivers that chunk on
+        # the next login
+        sock.sendall(OP_LOGOUT.to_bytes(CODE_LENGTH, "big") + b"drainee")
+        self.assertEqual(int.from_bytes(recvExactly(sock, CODE_LENGTH), "big"), LOGOUT_OK)
+        sock.close()
+        self.assertEqual(server.open_message_spool().load("drainee"), expected[50:])
+        sock = login()
+        self.assertEqual(self.readMessageChunk(sock), (LOGIN_OK_UNREAD_MSG_MORE, expected[50:100]))
+        ack(sock)
+        self.assertEqual(self.readMessageChunk(sock), (RECEIVE_UNREAD, expected[100:]))
+        ack(sock)
+        self.assertEqual(int.from_bytes(recvExactly(sock, CODE_LENGTH), "big"), ACK_OK)
+        self.assertEqual(server.open_message_spool().load("drainee"), [])
+        sock.close()
+        server.store.state["registeredUsers"].discard("drainee")
+        cleanUpState()
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,14 +1,27 @@
 from typing import List
+from functools import lru_cache
 import re
 import string
 
 # *** CONSTS ***
-# set ports for client-to-server communication
-# we need three replicas in total, for which we'll use these identifying ports
-SERVER_PORTS = [22067, 22068, 22069]
+# a replica group is made up of any number of servers up to MAX_REPLICAS (usually three), one of
+# which acts as the primary; its size is the number of hosts given when starting servers and clients
+MAX_REPLICAS = 7
+
+# set ports for client-to-server communication, one for each server of the group
+SERVER_PORTS = [22067 + server for server in range(MAX_REPLICAS)]
 
 # maintain another set of ports that the servers will use for internal commication (between primary and replicas)
-INTERNAL_SERVER_PORTS = [22070, 22071, 22072]
+INTERNAL_SERVER_PORTS = [22067 + MAX_REPLICAS + server for server in range(MAX_REPLICAS)]
+
+# the users can be split between several partitions, each served by a replica group of its own
+# (see partitions.py); the ports of each partition's servers follow those of the previous partition
+# by this much
+PARTITION_PORT_STRIDE = 1000
+# number of points each partition has on the hash ring its users are spread over
+PARTITION_VNODES = 64
+# how long a server waits on the primary of another partition it forwards a request to
+PARTITION_CALL_TIMEOUT = 10
 
 # operation codes
 OP_REGISTER = 1
@@ -18,6 +31,16 @@ OP_SEND = 4
 OP_LOGOUT = 5
 OP_DELETE = 6
 OP_DISCONNECT = 7
+OP_SEARCH_PAGE = 8
+OP_ACK_MESSAGES = 9
+OP_HELLO = 10
+OP_SEND_BATCH = 11
+OP_PING = 12
+OP_SEARCH_PARTITION = 13
+OP_PARTITION_MAP = 14
+OP_READ_ONLY = 15
+OP_PRESENCE = 16
+OP_PRIMARY = 17
 
 # server status codes
 REGISTER_OK = 1
@@ -26,15 +49,34 @@ LOGIN_OK_NO_UNREAD_MSG = 8
 LOGIN_OK_UNREAD_MSG = 9
 LOGIN_NOT_REGISTERED = 10
 LOGIN_ALREADY_LOGGED_IN = 11
+LOGIN_OK_UNREAD_MSG_MORE = 12
 SEARCH_OK = 16
 SEARCH_NO_RESULTS = 17
+SEARCH_OK_MORE = 18
 SEND_OK_DELIVERED = 24
 SEND_OK_BUFFERED = 25
 SEND_RECIPIENT_DNE = 26
 SEND_FAILED = 27
+SEND_BATCH_OK = 28
 RECEIVE_OK = 32
+RECEIVE_UNREAD = 33
+RECEIVE_UNREAD_MORE = 34
 LOGOUT_OK = 40
 DELETE_OK = 48
+ACK_OK = 56
+HELLO_OK = 64
+PING_OK = 72
+PARTITION_MAP_OK = 80
+WRONG_PARTITION = 81
+READ_ONLY_OK = 88
+READ_STALE = 89
+READ_ONLY_SESSION = 90
+PRESENCE_ONLINE = 96
+PRESENCE_OFFLINE = 97
+PRESENCE_NOT_REGISTERED = 98
+PRIMARY_IS = 104
+NOT_PRIMARY = 105
+UPDATE_NOT_REPLICATED = 125
 BAD_OPERATION = 126
 UNKNOWN_ERROR = 127
 
@@ -44,6 +86,8 @@ commandToOpcode = {
     "login" : OP_LOGIN,
     "search" : OP_SEARCH,
     "send" : OP_SEND,
+    "sendmany" : OP_SEND_BATCH,
+    "online" : OP_PRESENCE,
     "logout" : OP_LOGOUT,
     "delete" : OP_DELETE,
     "quit" : OP_DISCONNECT,
@@ -58,13 +102,185 @@ DELIMITER_LENGTH = 1
 CODE_LENGTH = 1
 MSG_HEADER_LENGTH = 2
 
-# support up to 10 clients
-CLIENT_CAPACITY = 10
+# search results are sent in pages of at most this many usernames
+SEARCH_PAGE_SIZE = 100
+# the most results a client can ask for in one page; the page still fits in a 2-byte length
+SEARCH_PAGE_LIMIT = 1000
+# number of digits used to send a page limit
+SEARCH_LIMIT_LENGTH = 4
+
+# unread messages are delivered on login in chunks of at most this many messages, each of which
+# the client acknowledges before the next is sent; the chunk still fits in a 2-byte length
+UNREAD_CHUNK_SIZE = 50
+
+# a batch send delivers messages from one sender to at most this many recipients; the batch is a
+# series of lines, the first being the sender's username, and each following one a message along
+# with the recipients it's for (see formatSendBatch()), and can only be sent in a frame
+SEND_BATCH_LIMIT = 100
+SEND_BATCH_LENGTH = USERNAME_LENGTH + SEND_BATCH_LIMIT * (USERNAME_LENGTH + 2 * DELIMITER_LENGTH + MESSAGE_LENGTH)
+
+# maximum number of bytes of operation-specific data that follow each operation code; the
+# server reads at most this many bytes after the code (unknown operations carry no data)
+OP_PAYLOAD_LENGTHS = {
+    OP_REGISTER : USERNAME_LENGTH,
+    OP_LOGIN : USERNAME_LENGTH,
+    OP_SEARCH : USERNAME_LENGTH,
+    OP_SEND : MESSAGE_LENGTH + 2 * USERNAME_LENGTH + 2 * DELIMITER_LENGTH,
+    OP_LOGOUT : USERNAME_LENGTH,
+    OP_DELETE : USERNAME_LENGTH,
+    OP_SEARCH_PAGE : SEARCH_LIMIT_LENGTH + 2 * USERNAME_LENGTH + 2 * DELIMITER_LENGTH,
+    OP_SEARCH_PARTITION : SEARCH_LIMIT_LENGTH + 2 * USERNAME_LENGTH + 2 * DELIMITER_LENGTH,
+    OP_ACK_MESSAGES : USERNAME_LENGTH,
+    OP_HELLO : CODE_LENGTH,
+}
+
+# wire protocol versions. Clients that open a connection with OP_HELLO (carrying the latest version
+# they speak) and are answered with HELLO_OK (carrying the version chosen) speak the framed protocol
+# from then on (see codec.py); every other client speaks the legacy protocol, in which a code is
+# followed by unframed data. From PROTOCOL_REQUEST_IDS on, every framed request carries an ID that's
+# echoed back in the responses to it, so that clients can pipeline requests
+PROTOCOL_LEGACY = 0
+PROTOCOL_FRAMED = 1
+PROTOCOL_REQUEST_IDS = 2
+PROTOCOL_VERSION = PROTOCOL_REQUEST_IDS
+# the request ID of responses that don't answer any request, e.g. incoming messages
+NO_REQUEST_ID = 0
+# the most bytes a varint (see codec.py) may take up
+MAX_VARINT_LENGTH = 5
+# the longest frame accepted, and the longest request a client may send in one
+MAX_FRAME_LENGTH = 1 << 20
+MAX_REQUEST_LENGTH = CODE_LENGTH + MAX_VARINT_LENGTH + max(max(OP_PAYLOAD_LENGTHS.values()), SEND_BATCH_LENGTH)
+
+# backlog of pending client connections the OS queues for us; this is sized for reconnect storms
+# (every client failing over to a new primary at once) rather than for the number of live clients
+LISTEN_BACKLOG = 1024
+
+# server modes: "selector" multiplexes every client socket on one event loop thread and runs
+# requests on a fixed pool of worker threads; "threads" opens a new thread for each client
+SERVER_MODE_SELECTOR = "selector"
+SERVER_MODE_THREADS = "threads"
+# number of worker threads executing client requests in selector mode
+WORKER_THREADS = 8
+# maximum number of bytes read from a client socket at once in selector mode
+RECV_CHUNK_SIZE = 4096
+# legacy requests aren't framed, and their data can be shorter than OP_PAYLOAD_LENGTHS, so a
+# request whose data is shorter is only taken to be complete once no more of it has arrived for
+# this many seconds (legacy clients send each request in one go, and wait for its response)
+LEGACY_PAYLOAD_WAIT = 0.02
+# how long a client may go without taking any data we have queued for it before we consider its
+# connection dead
+CLIENT_SEND_TIMEOUT = 10
+# TCP keepalive settings for client connections, so that the OS notices connections whose other end
+# vanished without closing them: probes start after TCP_KEEPALIVE_IDLE idle seconds and are sent
+# TCP_KEEPALIVE_INTERVAL seconds apart, and the connection fails after TCP_KEEPALIVE_COUNT of them
+# go unanswered
+TCP_KEEPALIVE_IDLE = 30
+TCP_KEEPALIVE_INTERVAL = 10
+TCP_KEEPALIVE_COUNT = 3
+# clients send OP_PING every CLIENT_PING_INTERVAL seconds, and the server closes connections it
+# hasn't received a request on for CLIENT_IDLE_TIMEOUT seconds (0 to never close idle connections);
+# idle and dead sessions are looked for every REAPER_INTERVAL seconds (see sessions.py)
+CLIENT_PING_INTERVAL = 30
+CLIENT_IDLE_TIMEOUT = 120
+# how long a client waits to connect to a server, and how long it keeps looking for the primary of
+# its group (e.g. while a new one takes over) before giving up, trying again every
+# CLIENT_RETRY_INTERVAL seconds
+CLIENT_CONNECT_TIMEOUT = 1
+CLIENT_FAILOVER_TIMEOUT = 10
+CLIENT_RETRY_INTERVAL = 0.2
+REAPER_INTERVAL = 5
+# number of threads writing queued data out to clients (see outbox.py)
+WRITER_THREADS = 4
+# number of locks the server's in-memory state is striped across (see statestore.py)
+STATE_LOCK_STRIPES = 64
+# watermarks for the data queued to a client: once more than the high watermark of bytes is
+# queued, the client is considered a slow consumer until its queue drains below the low watermark
+OUTBOX_HIGH_WATERMARK = 65536
+OUTBOX_LOW_WATERMARK = 16384
+# what happens to messages sent to a slow consumer: they're buffered in its mailbox and delivered
+# once it catches up, or the slow consumer is disconnected (and its messages buffered until it
+# logs in again)
+SLOW_CONSUMER_BUFFER = "buffer"
+SLOW_CONSUMER_DISCONNECT = "disconnect"
+SLOW_CONSUMER_POLICY = SLOW_CONSUMER_BUFFER
+
+# durability policies for the operation log: sync every batch of logged operations to disk before
+# acknowledging it, sync batches every FSYNC_INTERVAL_MS milliseconds, or let the OS decide when to
+# write logged operations to disk (acknowledging them as soon as they're handed to the OS)
+FSYNC_ALWAYS = "always"
+FSYNC_INTERVAL = "interval"
+FSYNC_OS = "os"
+FSYNC_POLICY = FSYNC_ALWAYS
+FSYNC_INTERVAL_MS = 10
+
+# a snapshot of the state is taken in the background (and the operation log compacted) once this
+# many operations have been logged since the last one, or every SNAPSHOT_INTERVAL seconds if any were
+SNAPSHOT_LOG_RECORDS = 10000
+SNAPSHOT_INTERVAL = 60
 
-# time to wait for server sockets to initialize and share state
-SOCKET_SETUP_DURATION = 5
-# time to wait for other sockets to implement updates
-SOCKET_UPDATE_DURATION = 0.25
+# replication: the primary keeps a streaming connection open to each replica, over which it sends
+# every logged operation (in the same form as a log record); the replica acknowledges each one by
+# sending back its sequence number once it's durable. Length in bytes of a sequence number
+SEQ_LENGTH = 8
+# a server connecting to another server's internal port first sends a frame (see codec.py) with a
+# code for what the connection is for, carrying the protocol version it speaks: the primary
+# streaming updates to a replica, or a server syncing its state from a peer (e.g. on startup, in
+# which case the frame also carries its 1-byte server ID), or a server sending heartbeats
+CHANNEL_REPLICATE = 1
+CHANNEL_SYNC = 2
+CHANNEL_HEARTBEAT = 3
+# failure detection (see leases.py): the servers of a group send each other heartbeats every
+# HEARTBEAT_INTERVAL seconds, and a server that hasn't been heard from for HEARTBEAT_TIMEOUT seconds
+# is taken to be down; this is also how long the votes making up the primary's lease last. Server
+# IDs are sent as a byte, with NO_SERVER standing for none (e.g. when the group has no primary)
+HEARTBEAT_INTERVAL = 0.2
+HEARTBEAT_TIMEOUT = 1
+NO_SERVER = 255
+# internal operation codes, only sent between servers: when a server is too far behind to catch
+# up from the log alone, a snapshot of the whole state is sent in chunks of at most
+# SNAPSHOT_CHUNK_SIZE bytes, followed by an end marker
+OP_SNAPSHOT_CHUNK = 64
+OP_SNAPSHOT_END = 65
+SNAPSHOT_CHUNK_SIZE = 60000
+# the primary also sends replicas records that aren't logged (or acknowledged), with the UNSEQUENCED
+# sequence number: every SYNC_MARK_INTERVAL seconds, a sync mark carrying the sequence number of its
+# latest update, which tells a replica it's up to date as of when the mark arrives, and the users
+# logging in and out (a reset, clearing every user, whenever a replica connects, then an update
+# per login or logout, carrying "1" or "0" and the username)
+UNSEQUENCED = 0
+OP_SYNC_MARK = 66
+OP_PRESENCE_RESET = 67
+OP_PRESENCE_UPDATE = 68
+SYNC_MARK_INTERVAL = 0.5
+# secondaries serve read-only sessions (see OP_READ_ONLY) as long as they've been up to date with
+# the primary within this many seconds
+MAX_READ_STALENESS = 5
+# staleness is reported in milliseconds, capped at this many seconds (e.g. for a secondary that has
+# never heard from a primary)
+STALENESS_REPORT_LIMIT = 3600
+# the operations served on read-only sessions
+READ_ONLY_OPS = { OP_HELLO, OP_PING, OP_READ_ONLY, OP_PRIMARY, OP_PARTITION_MAP, OP_SEARCH, OP_SEARCH_PAGE, OP_SEARCH_PARTITION, OP_PRESENCE }
+# how long the primary waits to connect to a replica, and between attempts to (re)connect
+REPLICA_CONNECT_TIMEOUT = 1
+REPLICA_RETRY_INTERVAL = 0.5
+# how long a state-changing request waits for the replicas to acknowledge its update
+REPLICATION_ACK_TIMEOUT = 1
+# an update is committed once it's durable on this many servers of the group, the primary included;
+# by default, a majority of them (see majority())
+WRITE_QUORUM = 2
+# whether an update the replicas don't acknowledge in time to make up the write quorum is committed
+# on the primary alone, rather than failing the request that made it
+ALLOW_PRIMARY_ONLY = False
+
+# on startup, a server syncs its state from the other servers before serving clients. A server
+# answering a sync first reports whether it's ready (serving, with its state already reconciled)
+# or still starting up; a server only has to sync from one ready server to be up to date
+PEER_STARTING = 0
+PEER_READY = 1
+# how long a starting server keeps trying to reach the other servers when none of them is ready,
+# and how long it waits between attempts; servers that start later catch up on their own
+PEER_DISCOVERY_TIMEOUT = 5
+PEER_RETRY_INTERVAL = 0.2
 
 # *** HELPER FUNCTIONS ***
 # take a sender, recipient, and message body and return a string that represents
@@ -88,15 +304,80 @@ def parseSearchResults(result : str) -> str:
     results = result.split("|")
     return "\n".join(results)
 
+# encode a page of search results: the status code (SEARCH_OK_MORE if more pages follow, or
+# SEARCH_OK for the last page), a 2-byte header with the number of results in the page, a 2-byte
+# header with the length of the body in bytes, and then the body, the results separated by |s
+def formatSearchPage(status : int, results : List[str]) -> bytes:
+    body = bytes("|".join(results), 'ascii')
+    return (
+        status.to_bytes(CODE_LENGTH, "big") +
+        len(results).to_bytes(MSG_HEADER_LENGTH, "big") +
+        len(body).to_bytes(MSG_HEADER_LENGTH, "big") +
+        body
+    )
+
+# encode a chunk of unread messages, like a page of search results (see above): the status code,
+# a 2-byte header with the number of messages, a 2-byte header with the length of the body in
+# bytes, and then the body, the messages (each formatted as <sender>|<message>) separated by newlines
+def formatMessageChunk(status : int, messages : List[str]) -> bytes:
+    body = bytes("\n".join(messages), 'ascii')
+    return (
+        status.to_bytes(CODE_LENGTH, "big") +
+        len(messages).to_bytes(MSG_HEADER_LENGTH, "big") +
+        len(body).to_bytes(MSG_HEADER_LENGTH, "big") +
+        body
+    )
+
+# take a sender and a list of (recipients, message) pairs, where recipients is a list of usernames,
+# and return the encoding of a batch send: lines of the form <recipient>,<recipient>,...|<message>
+# following a line with the sender, so that a message sent to many users is only encoded once
+def formatSendBatch(sender : str, batch) -> str:
+    return "\n".join([sender] + [f"{','.join(recipients)}|{message}" for recipients, message in batch])
+
+# complementary to the above: parse a batch send into the sender and a list of (recipient,
+# message) pairs, one for each delivery, in order
+def parseSendBatch(batch : str):
+    lines = batch.split("\n")
+    deliveries = []
+    for line in lines[1:]:
+        recipients, message = line.split("|")
+        deliveries += [(recipient, message) for recipient in recipients.split(",")]
+    return lines[0], deliveries
+
+# take a page limit, a cursor (the last username of the previous page, or blank for the first
+# page), and a query, and return the encoding of a request for one page of search results
+def formatSearchPageRequest(limit : int, cursor : str, query : str):
+    return f"{limit}|{cursor}|{query}"
+
+# the smallest majority of a group of servers
+def majority(numServers : int) -> int:
+    return numServers // 2 + 1
+
+# read exactly the given number of bytes from a socket, which may take multiple reads; raises a
+# ConnectionError if the connection closes first
+def recvExactly(sock, length : int) -> bytes:
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return bytes(data)
+
+# compile a query into a regular expression matching whole usernames; compiled queries are
+# cached, since the same queries tend to be repeated
+@lru_cache(maxsize=1024)
+def compileQuery(query : str):
+    return re.compile(".*".join(map(re.escape, query.split("*"))))
+
 # given a list of total usernames and a query, returns the usernames matching
 # the query; note: wildcard search interprets * as ZERO or more of ANY character
 def searchUsernames(usernames : List[str], query : str):
     if len(usernames) == 0: return []
     if len(query) == 0:
         return usernames
-    q = "^" + query + "$"
-    q = q.replace("*", ".*")
-    return list(filter(lambda x: re.match(q, x), usernames))
+    q = compileQuery(query)
+    return [x for x in usernames if q.fullmatch(x)]
 
 # check if a username is valid: it must not be blank, be alphanumeric, and be
 # no more than 50 characters